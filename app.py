@@ -3,139 +3,395 @@ st.set_page_config(layout="wide")
 
 import pandas as pd
 import numpy as np
-from scipy.optimize import linprog, lsq_linear
+import altair as alt
+from blend_engine import SOLVER_METHODS, additive_contributions_g, increase_pct, judge_blend, plan_heats, scatter_pass_rate, select_materials, solve_blend, solve_blend_two_stage, split_urgent_targets
+from reference_data import encoding_report, load_composition, load_csv, reference_version
+from autosave import autosave_location, get_writer, load_autosave, remove_autosave
+from config_store import connect, delete_config, diff_configs, groups, import_json_dir, load_config, save_config, search_configs, store_path
+import hashlib
 import json
 import os
 from datetime import datetime
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.units import mm
+from instruction_pdf import BASE_MATERIALS, write_instruction_pdf
+from batch_replay import CALIBRATION_FILES, MANUAL_MATERIALS, TWO_STAGE_CONSTRAINTS, channel_indices, channel_problem, replay_channel, solver_constraints
+from material_library import build_library, load_library
+import inspect
 import io
+import time
 
-# CSV読み込み（エンコード: ANTI対応）
+# CSV読み込み（エンコード: ANTI対応、全セッション共通のキャッシュ経由）
 def read_csv_anti(filename, **kwargs):
-    encodings = ['cp932', 'utf-8', 'utf-8-sig', 'shift_jis']
-    for encoding in encodings:
-        try:
-            return pd.read_csv(filename, encoding=encoding, **kwargs)
-        except Exception:
-            continue
-    # 全て失敗した場合
-    st.error(f"CSVファイル '{filename}' の読み込みに失敗しました。")
-    return pd.DataFrame()
+    try:
+        return load_csv(filename, **kwargs)
+    except (OSError, ValueError):
+        # 全て失敗した場合
+        st.error(f"CSVファイル '{filename}' の読み込みに失敗しました。")
+        return pd.DataFrame()
 
 materials_df = read_csv_anti("materials.csv", index_col=0)
 additives_df = read_csv_anti("additives.csv", index_col=0)
 
 elements = ['C','Si','Mn','P','S','Ni','Cr','Mo','Ti','V','Cu','W','Sn','Al','Mg','Zn']  # Feは除外
 
+# 材料ライブラリ（名前・ロット・仕入先の検索と元素の含有率での絞り込み用。参照データの版ごとに1回だけ作成）
+try:
+    material_library = load_library("materials.csv", elements + ['Fe'], index_col=0)
+except (OSError, ValueError):
+    material_library = build_library(materials_df, elements + ['Fe'])
+# 材料の選択肢に一度に出す件数（選択済みの材料は件数に関係なく出す）
+MATERIAL_OPTION_LIMIT = 200
+
 
 
 st.title("合金配合計算システム")
 
+# 分析場所の検量線上限値ファイルにある Group
+def calibration_groups(analysis_location):
+    calibration_df = read_csv_anti(CALIBRATION_FILES.get(analysis_location, CALIBRATION_FILES["東分析"]))
+    if calibration_df.empty or 'Group' not in calibration_df.columns:
+        return []
+    return calibration_df['Group'].dropna().unique().tolist()
+
+# 分析場所を先に戻し、Group はその分析場所にあるときだけ戻す（自動保存の復元・LOADで使用）
+def restore_location_group(analysis_location, group):
+    if analysis_location in CALIBRATION_FILES:
+        st.session_state["analysis_location_common"] = analysis_location
+    if group in calibration_groups(st.session_state.get("analysis_location_common", "東分析")):
+        st.session_state["selected_group_common"] = group
+    else:
+        st.session_state.pop("selected_group_common", None)
+
 # 保存・読み込み機能
 save_dir = "saved_configs"
 if not os.path.exists(save_dir):
     os.makedirs(save_dir)
+config_store = store_path(save_dir)
+# 自動保存（入力中の設定を変更のたびにバックグラウンドで保存し、異常終了後に復元できるようにする）
+# 以前の場所（saved_configs/autosave.json）の自動保存は、JSONの取り込みより先に移して設定として取り込まないようにする
+autosave_path = autosave_location(save_dir)
+# 以前の保存形式（1件1ファイルのJSON）は初回だけストアに取り込む
+with connect(config_store) as conn:
+    import_json_dir(conn, save_dir)
+
+AUTOSAVE_PREFIXES = ("target_", "tol_", "selected_", "manual_", "additive_percent_", "mode_radio_", "total_weight_",
+                     "remaining_weight_", "tapping_temp_", "solver_method_", "use_capacity_")
+AUTOSAVE_KEYS = ("test_name_input_common", "analysis_location_common", "channel_count_common", "edit_channel")
+
+def autosave_session():
+    # 復元するかどうかを選ぶまでは、前回の自動保存を上書きしない
+    if not st.session_state.get("autosave_enabled", True) or st.session_state.get("autosave_offer"):
+        return
+    state = {
+        k: v for k, v in st.session_state.items()
+        if isinstance(k, str) and (k.startswith(AUTOSAVE_PREFIXES) or k in AUTOSAVE_KEYS)
+        and isinstance(v, (str, int, float, bool, list))
+    }
+    source = json.dumps(state, ensure_ascii=False, sort_keys=True, default=str)
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    if st.session_state.get("autosave_digest") != digest:
+        st.session_state["autosave_digest"] = digest
+        get_writer(autosave_path).submit({"timestamp": datetime.now().isoformat(), "state": state})
+
+# blending_ratio.csvから目標成分を読み込む
+def read_blending_ratio():
+    try:
+        df = load_csv("blending_ratio.csv", encoding='cp932', index_col=0)
+        return df
+    except Exception as e:
+        st.error(f"blending_ratio.csvの読み込みに失敗: {e}")
+        return pd.DataFrame()
+
+blending_ratio_df = read_blending_ratio()
+
+# チャンネル数（既定は blending_ratio.csv の ChN 行の最大の番号。5未満なら5）
+MAX_CHANNELS = 60
+
+def default_channel_count():
+    numbers = [int(name[2:]) for name in map(str, blending_ratio_df.index) if name.startswith("Ch") and name[2:].isdigit()]
+    return min(MAX_CHANNELS, max([5] + numbers))
+
+if "channel_count_common" not in st.session_state:
+    st.session_state["channel_count_common"] = default_channel_count()
+n_channels = int(st.session_state["channel_count_common"])
+
+# チャンネルごとの計算結果・キャッシュ・一覧用の要約は st.session_state["channels"][i] にまとめる
+# （入力ウィジェットの key は Streamlit の仕様で st.session_state の直下に置く必要があるため f"..._{i}" のまま）
+def channel_state(channel_index):
+    return st.session_state.setdefault("channels", {}).setdefault(channel_index, {})
+
+# 入力の初期値
+DEFAULT_TARGETS = {"C": 3.6, "Si": 2.4, "Mn": 0.4}
+ADDITIVE_DEFAULT_PERCENT = {"OGRC-4.5H": 1.3, "SカバーM": 0.8}
+FCD_ADDITIVES = ["OGRC-4.5H", "SカバーM"]
+INIT_MATERIALS = ["神鋼SP銑", "C粉", "Fe-Si", "Fe-Mn"]
+
+# blending_ratio.csv の ChN 行の目標値・判定方法と、初期選択する元素
+def blend_defaults(channel_index):
+    blend_targets = {}
+    blend_tolerance_types = {}  # 判定方法を保存
+    blend_name = f"Ch{channel_index+1}"
+    if blending_ratio_df is not None and blend_name in blending_ratio_df.index:
+        blend_row = blending_ratio_df.loc[blend_name]
+        for e in elements:
+            v = blend_row.get(e, 0.0)
+            tolerance_type = "±"  # デフォルトは±
+            try:
+                if isinstance(v, str) and v.startswith('<'):
+                    # "<0.02"のような形式の場合
+                    v = float(v[1:])  # "<"を除いて数値に変換
+                    tolerance_type = "以下"  # 判定方法を"以下"に設定
+                else:
+                    v = float(v)
+            except Exception:
+                v = 0.0
+            blend_targets[e] = v
+            blend_tolerance_types[e] = tolerance_type
+    # blending_ratio.csvで0以外が入力されている成分を自動で追加
+    blend_nonzero_elements = [e for e in elements if blend_targets.get(e, 0.0) not in (0, None) and not pd.isna(blend_targets.get(e, 0.0))]
+    # デフォルトは0以外の成分すべて（なければC,Si,Mn）
+    default_elements = blend_nonzero_elements[:]
+    if not default_elements:
+        default_elements = [e for e in ["C", "Si", "Mn"] if blend_targets.get(e, 0.0) != 0]
+        if not default_elements:
+            default_elements = ["C", "Si", "Mn"]
+    return blend_targets, blend_tolerance_types, default_elements
+
+# まだ画面に出していないチャンネルの入力値を、画面と同じ初期値で作る（一覧・指示票・保存で使う）
+def init_channel_state(channel_index):
+    state = channel_state(channel_index)
+    if state.get("initialized"):
+        return
+    ss = st.session_state
+    i = channel_index
+    blend_targets, blend_tolerance_types, default_elements = blend_defaults(i)
+    ss.setdefault(f"total_weight_{i}", 110.0)
+    ss.setdefault(f"remaining_weight_{i}", 0.0)
+    ss.setdefault(f"tapping_temp_{i}", 1450)
+    if not ss.get(f"selected_elements_{i}"):
+        ss[f"selected_elements_{i}"] = default_elements
+    for e in ss[f"selected_elements_{i}"]:
+        ss.setdefault(f"target_{e}_{i}", blend_targets.get(e, DEFAULT_TARGETS.get(e, 0.0)))
+        ss.setdefault(f"tol_{e}_{i}", 0.05 if e in ["C", "Si", "Mn"] else 0.01)
+        ss.setdefault(f"tol_type_{e}_{i}", blend_tolerance_types.get(e, "±"))
+    if f"selected_additives_{i}" not in ss:
+        mode = ss.get(f"mode_radio_{i}", "FCD")
+        ss[f"selected_additives_{i}"] = [a for a in additives_df.index if a in FCD_ADDITIVES] if mode == "FCD" else []
+    for j, additive in enumerate(ss[f"selected_additives_{i}"]):
+        ss.setdefault(f"additive_percent_{additive}_{i}_{j}", ADDITIVE_DEFAULT_PERCENT.get(additive, 0.0))
+    ss.setdefault(f"selected_materials_widget_{i}", sorted((m for m in INIT_MATERIALS if m in material_library), key=material_library.index.get))
+    state["initialized"] = True
+
+# 入力ウィジェットの値は表示しなかった再実行で消えるため、編集中以外のチャンネルの値も毎回入れ直して残す
+CHANNEL_WIDGET_PREFIXES = ("target_", "tol_", "selected_elements_", "selected_additives_", "selected_materials_widget_",
+                           "manual_", "additive_percent_", "mode_radio_", "total_weight_", "remaining_weight_",
+                           "tapping_temp_", "solver_method_", "use_capacity_")
+for key in [k for k in st.session_state.keys() if isinstance(k, str) and k.startswith(CHANNEL_WIDGET_PREFIXES)]:
+    st.session_state[key] = st.session_state[key]
+for i in range(n_channels):
+    init_channel_state(i)
+
+# 1チャンネル分の設定（保存ファイルの tabs["tab_{i}"] と同じ形）
+def channel_config(tab_idx):
+    tab_config = {}
+    # 基本設定
+    tab_config["mode"] = st.session_state.get(f"mode_radio_{tab_idx}", "FCD")
+    tab_config["tapping_temp"] = st.session_state.get(f"tapping_temp_{tab_idx}", 1450)
+    tab_config["total_weight"] = st.session_state.get(f"total_weight_{tab_idx}", 110.0)
+    tab_config["remaining_weight"] = st.session_state.get(f"remaining_weight_{tab_idx}", 0.0)
+    tab_config["solver_method"] = st.session_state.get(f"solver_method_{tab_idx}", "lstsq")
+    
+    # 選択された元素
+    tab_config["selected_elements"] = st.session_state.get(f"selected_elements_{tab_idx}", [])
+    
+    # 成分目標値、許容値、判定方法
+    tab_config["targets"] = {}
+    tab_config["tolerances"] = {}
+    tab_config["tolerance_types"] = {}
+    for e in elements:
+        tab_config["targets"][e] = st.session_state.get(f"target_{e}_{tab_idx}", 0.0)
+        tab_config["tolerances"][e] = st.session_state.get(f"tol_{e}_{tab_idx}", 0.01)
+        tab_config["tolerance_types"][e] = st.session_state.get(f"tol_type_{e}_{tab_idx}", "±")
+    
+    # 選択された添加材
+    tab_config["selected_additives"] = st.session_state.get(f"selected_additives_{tab_idx}", [])
+    
+    # 添加材の割合
+    tab_config["additive_percents"] = {}
+    selected_additives = tab_config["selected_additives"]
+    for i, additive in enumerate(selected_additives):
+        key = f"additive_percent_{additive}_{tab_idx}_{i}"
+        if key in st.session_state:
+            tab_config["additive_percents"][additive] = st.session_state[key]
+        else:
+            tab_config["additive_percents"][additive] = 0.0
+    
+    # 選択された材料
+    tab_config["selected_materials"] = st.session_state.get(f"selected_materials_widget_{tab_idx}", [])
+    
+    # 手動材料の量
+    tab_config["manual_materials"] = {}
+    for mat in MANUAL_MATERIALS:
+        tab_config["manual_materials"][mat] = st.session_state.get(f"manual_{mat}_{tab_idx}", 0.0)
+
+    # 計算方式の制約（装入量合計の上限、材料ごとの装入量の下限・上限（kg、上限なしは None））
+    tab_config["use_capacity"] = st.session_state.get(f"use_capacity_{tab_idx}", False)
+    bounds_df = channel_state(tab_idx).get("bounds", {}).get(charge_bounds_key(tab_idx, tab_config["selected_materials"]))
+    tab_config["charge_bounds"] = {}
+    if bounds_df is not None:
+        for mat, (lower, upper) in bounds_df[["下限(kg)", "上限(kg)"]].iterrows():
+            tab_config["charge_bounds"][mat] = [0.0 if pd.isna(lower) else float(lower), None if pd.isna(upper) else float(upper)]
+    return tab_config
+
+def charge_bounds_key(tab_idx, material_names):
+    return f"charge_bounds_{tab_idx}_{'_'.join(material_names)}"
+
+# 一覧・指示票で使う計算結果の要約（batch_replay.replay_channel と同じ形）。
+# 編集中のチャンネルは画面で計算した結果を使い、それ以外は保存済み設定の一括再計算と同じ手順で計算して、入力が変わるまで使い回す
+def channel_digest(tab_config, limits):
+    source = json.dumps([tab_config, limits], ensure_ascii=False, sort_keys=True, default=str)
+    source += repr(reference_version("materials.csv", "additives.csv"))
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+def channel_summary(channel_index, limits):
+    state = channel_state(channel_index)
+    tab_config = channel_config(channel_index)
+    digest = channel_digest(tab_config, limits)
+    for key in ("detail", "summary"):
+        if key in state and state[key][0] == digest:
+            return state[key][1]
+    try:
+        summary = replay_channel(tab_config, limits) or {}
+    except Exception as e:
+        summary = {"エラー": str(e)}
+    state["summary"] = (digest, summary)
+    return summary
 
 # 保存・読み込み機能
 with st.container(border=True):
     st.header("💾 設定ファイルの操作")
     
-    # 保存済み設定の選択とボタンを横並びに配置
-    saved_files = [f for f in os.listdir(save_dir) if f.endswith('.json')] if os.path.exists(save_dir) else []
+    # 新しいセッションの最初だけ、前回の自動保存があれば復元するかを聞く
+    if "autosave_offer" not in st.session_state:
+        st.session_state["autosave_offer"] = load_autosave(autosave_path)
+    autosave_offer = st.session_state["autosave_offer"]
+    if autosave_offer:
+        st.info(f"前回の作業中の設定が自動保存されています（{autosave_offer.get('timestamp', '')[:19].replace('T', ' ')}）")
+        restore_col, discard_col, _ = st.columns([1, 1, 6])
+        if restore_col.button("復元する", key="autosave_restore"):
+            restored = dict(autosave_offer["state"])
+            location = restored.pop("analysis_location_common", None)
+            group = restored.pop("selected_group_common", None)
+            for key, value in restored.items():
+                st.session_state[key] = value
+            restore_location_group(location, group)
+            st.session_state["autosave_offer"] = None
+            st.rerun()
+        if discard_col.button("破棄する", key="autosave_discard"):
+            # 破棄したら自動保存のファイルも消し、次に起動したときに同じ内容を聞かない
+            remove_autosave(autosave_path)
+            st.session_state["autosave_offer"] = None
+            st.rerun()
+    autosave_cols = st.columns([2, 6])
+    autosave_cols[0].checkbox("入力中の設定を自動保存する", value=True, key="autosave_enabled")
+    autosave_writer = get_writer(autosave_path)
+    if autosave_writer.last_error is not None:
+        autosave_cols[1].warning(f"自動保存エラー: {autosave_writer.last_error}")
+    elif autosave_writer.last_saved is not None:
+        autosave_cols[1].caption(f"自動保存: {datetime.fromtimestamp(autosave_writer.last_saved).strftime('%H:%M:%S')}")
     
-    title_col, select_col, col1, col2, col3 = st.columns([1, 3, 0.5, 0.5, 0.5])
+    # 保存済み設定の検索（新しい順に1ページずつ表示）
+    with connect(config_store) as conn:
+        group_options = groups(conn)
+    search_cols = st.columns([3, 1, 1, 1, 1])
+    name_prefix = search_cols[0].text_input("試験名（前方一致）", key="config_search_name")
+    group_filter = search_cols[1].selectbox("Group", ["すべて"] + group_options, key="config_search_group")
+    target_element = search_cols[2].selectbox("目標値で絞り込む元素", ["-"] + elements, key="config_search_element")
+    target_min = search_cols[3].number_input("目標値の下限（%）", min_value=0.0, value=0.0, key="config_search_min", disabled=target_element == "-")
+    target_max = search_cols[4].number_input("目標値の上限（%）", min_value=0.0, value=100.0, key="config_search_max", disabled=target_element == "-")
+    search_filters = {
+        "name_prefix": name_prefix.strip(),
+        "group": None if group_filter == "すべて" else group_filter,
+        "element": None if target_element == "-" else target_element,
+        "target_min": target_min,
+        "target_max": target_max,
+    }
+    # ページ送りは各ページの最後の行（保存日時, id）を積んでおく。条件が変わったら1ページ目に戻す
+    if st.session_state.get("config_search_filters") != search_filters:
+        st.session_state["config_search_filters"] = search_filters
+        st.session_state["config_page_cursors"] = []
+    page_cursors = st.session_state["config_page_cursors"]
+    with connect(config_store) as conn:
+        page_rows, has_next = search_configs(conn, after=page_cursors[-1] if page_cursors else None, **search_filters)
+    saved_configs = {row["id"]: row for row in page_rows}
+    config_label = lambda v: v if v == "選択してください" else f"{saved_configs[v]['name']}（{saved_configs[v]['selected_group'] or '-'}）"
+    
+    # 保存済み設定の選択とボタンを横並びに配置
+    title_col, select_col, prev_col, next_col, col1, col2, col3 = st.columns([1, 3, 0.4, 0.4, 0.5, 0.5, 0.5])
     
     with title_col:
-        st.markdown("**保存済み設定の選択**")
+        st.markdown(f"**保存済み設定の選択**（{len(page_cursors) + 1}ページ目）")
     
     with select_col:
-        if saved_files:
-            selected_file = st.selectbox("選択してください", ["選択してください"] + saved_files, label_visibility="collapsed")
-        else:
-            selected_file = st.selectbox("選択してください", ["選択してください"], label_visibility="collapsed")
+        selected_file = st.selectbox(
+            "選択してください",
+            ["選択してください"] + list(saved_configs),
+            format_func=config_label,
+            label_visibility="collapsed"
+        )
+    
+    with prev_col:
+        if st.button("◀", key="config_page_prev", disabled=not page_cursors):
+            page_cursors.pop()
+            st.rerun()
+    
+    with next_col:
+        if st.button("▶", key="config_page_next", disabled=not has_next):
+            page_cursors.append((page_rows[-1]["timestamp"], page_rows[-1]["id"]))
+            st.rerun()
     
     with col1:
         if st.button("SAVE"):
             # 全タブの設定を収集
-            current_test_name = st.session_state.get("test_name_input", "試験_001")
+            current_test_name = st.session_state.get("test_name_input_common", "試験_001")
             config_data = {
                 "test_name": current_test_name,
-                "analysis_location": st.session_state.get("analysis_location", "東分析"),
-                "selected_group": st.session_state.get("selected_group", ""),
+                "analysis_location": st.session_state.get("analysis_location_common", "東分析"),
+                "selected_group": st.session_state.get("selected_group_common", ""),
                 "timestamp": datetime.now().isoformat(),
                 "tabs": {}
             }
             
-            # 各タブの設定を保存
-            for tab_idx in range(5):
-                tab_config = {}
-                # 基本設定
-                tab_config["mode"] = st.session_state.get(f"mode_radio_{tab_idx}", "FCD")
-                tab_config["tapping_temp"] = st.session_state.get(f"tapping_temp_{tab_idx}", 1450)
-                tab_config["total_weight"] = st.session_state.get(f"total_weight_{tab_idx}", 110.0)
-                tab_config["remaining_weight"] = st.session_state.get(f"remaining_weight_{tab_idx}", 0.0)
-                
-                # 選択された元素
-                tab_config["selected_elements"] = st.session_state.get(f"selected_elements_{tab_idx}", [])
-                
-                # 成分目標値、許容値、判定方法
-                tab_config["targets"] = {}
-                tab_config["tolerances"] = {}
-                tab_config["tolerance_types"] = {}
-                for e in elements:
-                    tab_config["targets"][e] = st.session_state.get(f"target_{e}_{tab_idx}", 0.0)
-                    tab_config["tolerances"][e] = st.session_state.get(f"tol_{e}_{tab_idx}", 0.01)
-                    tab_config["tolerance_types"][e] = st.session_state.get(f"tol_type_{e}_{tab_idx}", "±")
-                
-                # 選択された添加材
-                tab_config["selected_additives"] = st.session_state.get(f"selected_additives_{tab_idx}", [])
-                
-                # 添加材の割合
-                tab_config["additive_percents"] = {}
-                selected_additives = tab_config["selected_additives"]
-                for i, additive in enumerate(selected_additives):
-                    key = f"additive_percent_{additive}_{tab_idx}_{i}"
-                    if key in st.session_state:
-                        tab_config["additive_percents"][additive] = st.session_state[key]
-                    else:
-                        tab_config["additive_percents"][additive] = 0.0
-                
-                # 選択された材料
-                tab_config["selected_materials"] = st.session_state.get(f"selected_materials_widget_{tab_idx}", [])
-                
-                # 手動材料の量
-                tab_config["manual_materials"] = {}
-                for mat in ["鋼屑", "神鋼ＳＰ銑", "故銑"]:
-                    tab_config["manual_materials"][mat] = st.session_state.get(f"manual_{mat}_{tab_idx}", 0.0)
-                
-                config_data["tabs"][f"tab_{tab_idx}"] = tab_config
+            # 各チャンネルの設定を保存
+            for tab_idx in range(n_channels):
+                config_data["tabs"][f"tab_{tab_idx}"] = channel_config(tab_idx)
             
-            filename = f"{save_dir}/{current_test_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(config_data, f, ensure_ascii=False, indent=2)
+            filename = f"{current_test_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            with connect(config_store) as conn:
+                save_config(conn, filename, config_data)
             # メッセージを列分割の外に表示するためにフラグを設定
             st.session_state['save_success'] = filename
             st.rerun()
     
     with col2:
-        if st.button("LOAD", disabled=(not saved_files or selected_file == "選択してください")):
+        if st.button("LOAD", disabled=(selected_file == "選択してください")):
             if selected_file != "選択してください":
-                with open(f"{save_dir}/{selected_file}", 'r', encoding='utf-8') as f:
-                    config_data = json.load(f)
+                with connect(config_store) as conn:
+                    config_data = load_config(conn, selected_file)
+                if config_data is None:
+                    # 別の画面で削除された
+                    st.error("選択した設定が見つかりません")
+                    st.stop()
                 
                 # 基本設定を復元
-                st.session_state["analysis_location"] = config_data.get("analysis_location", "東分析")
-                st.session_state["selected_group"] = config_data.get("selected_group", "")
+                st.session_state["test_name_input_common"] = config_data.get("test_name", "試験_001")
+                restore_location_group(config_data.get("analysis_location", "東分析"), config_data.get("selected_group", ""))
                 
                 # 各タブの設定を復元
                 if "tabs" in config_data:
-                    for tab_idx in range(5):
+                    tab_indices = [i for i in channel_indices(config_data) if i < MAX_CHANNELS]
+                    if tab_indices:
+                        st.session_state["channel_count_common"] = tab_indices[-1] + 1
+                    for tab_idx in tab_indices:
                         tab_key = f"tab_{tab_idx}"
                         if tab_key in config_data["tabs"]:
                             tab_config = config_data["tabs"][tab_key]
@@ -145,6 +401,7 @@ with st.container(border=True):
                             st.session_state[f"tapping_temp_{tab_idx}"] = tab_config.get("tapping_temp", 1450)
                             st.session_state[f"total_weight_{tab_idx}"] = tab_config.get("total_weight", 110.0)
                             st.session_state[f"remaining_weight_{tab_idx}"] = tab_config.get("remaining_weight", 0.0)
+                            st.session_state[f"solver_method_{tab_idx}"] = tab_config.get("solver_method", "lstsq")
                             
                             # 選択された元素
                             st.session_state[f"selected_elements_{tab_idx}"] = tab_config.get("selected_elements", [])
@@ -172,14 +429,24 @@ with st.container(border=True):
                             
                             # 手動材料の量
                             if "manual_materials" in tab_config:
-                                for mat in ["鋼屑", "神鋼ＳＰ銑", "故銑"]:
+                                for mat in MANUAL_MATERIALS:
                                     st.session_state[f"manual_{mat}_{tab_idx}"] = tab_config["manual_materials"].get(mat, 0.0)
+                            
+                            # 計算方式の制約
+                            st.session_state[f"use_capacity_{tab_idx}"] = tab_config.get("use_capacity", False)
+                            if tab_config.get("charge_bounds"):
+                                bounds = tab_config["charge_bounds"]
+                                materials = tab_config.get("selected_materials", [])
+                                channel_state(tab_idx).setdefault("bounds", {})[charge_bounds_key(tab_idx, materials)] = pd.DataFrame({
+                                    "下限(kg)": [bounds.get(m, [0.0, None])[0] for m in materials],
+                                    "上限(kg)": [np.nan if bounds.get(m, [0.0, None])[1] is None else bounds[m][1] for m in materials],
+                                }, index=materials)
                 
                 st.session_state['load_success'] = True
                 st.rerun()
     
     with col3:
-        if st.button("DELETE", disabled=(not saved_files or selected_file == "選択してください")):
+        if st.button("DELETE", disabled=(selected_file == "選択してください")):
             if selected_file != "選択してください":
                 # 確認ダイアログを表示
                 if 'delete_confirm' not in st.session_state:
@@ -188,11 +455,13 @@ with st.container(border=True):
 
     # 削除確認ダイアログ
     if st.session_state.get('delete_confirm', False):
-        st.warning(f"⚠️ 本当に '{selected_file}' を削除しますか？")
+        selected_name = saved_configs[selected_file]["name"] if selected_file in saved_configs else selected_file
+        st.warning(f"⚠️ 本当に '{selected_name}' を削除しますか？")
         col_yes, col_no, _ = st.columns([1, 1, 8])
         with col_yes:
             if st.button("✅ はい", key="delete_yes"):
-                os.remove(f"{save_dir}/{selected_file}")
+                with connect(config_store) as conn:
+                    delete_config(conn, selected_file)
                 st.session_state['delete_success'] = True
                 del st.session_state['delete_confirm']
                 st.rerun()
@@ -201,6 +470,28 @@ with st.container(border=True):
                 del st.session_state['delete_confirm']
                 st.rerun()
 
+    # 保存済み設定の比較（チャンネルごとの設定のハッシュが同じなら中身は読まない）
+    if selected_file in saved_configs:
+        with st.expander("🔍 保存済み設定の比較"):
+            compare_file = st.selectbox(
+                "比較する設定",
+                ["選択してください"] + [v for v in saved_configs if v != selected_file],
+                format_func=config_label,
+                key="config_compare"
+            )
+            if compare_file != "選択してください":
+                with connect(config_store) as conn:
+                    diff_rows = diff_configs(conn, selected_file, compare_file)
+                if diff_rows:
+                    diff_df = pd.DataFrame(diff_rows, columns=["チャンネル", "項目", saved_configs[selected_file]["name"], saved_configs[compare_file]["name"]])
+                    diff_df["チャンネル"] = diff_df["チャンネル"].map(lambda k: f"Ch{int(k.rsplit('_', 1)[-1]) + 1}" if k else "共通")
+                    # 値の型がそろわないので表示用の文字列にする
+                    for col in diff_df.columns[2:]:
+                        diff_df[col] = diff_df[col].map(lambda v: "" if v is None else json.dumps(v, ensure_ascii=False) if isinstance(v, list) else str(v))
+                    st.dataframe(diff_df, hide_index=True, use_container_width=True)
+                else:
+                    st.info("違いはありません")
+
     # メッセージを列分割の外で表示
     if 'save_success' in st.session_state:
         st.success(f"設定を保存しました: {st.session_state['save_success']}", icon="✅")
@@ -211,7 +502,7 @@ with st.container(border=True):
         del st.session_state['load_success']
     
     if 'delete_success' in st.session_state:
-        st.success("設定ファイルを削除しました", icon="✅")
+        st.success("設定を削除しました", icon="✅")
         del st.session_state['delete_success']
 
 # 共通設定
@@ -220,21 +511,21 @@ with st.container(border=True):
     
     # 試験名、分析場所、Groupを横並びに表示
     test_col, location_col, group_col = st.columns([2, 2, 2])
+    # 初期値（自動保存の復元・LOADで入れた値があればそれを使う）
+    st.session_state.setdefault("test_name_input_common", "試験_001")
+    st.session_state.setdefault("analysis_location_common", "東分析")
     
     with test_col:
         st.markdown("**試験名を入力**")
-        test_name = st.text_input("試験名を入力", value="試験_001", key="test_name_input_common", label_visibility="collapsed")
+        test_name = st.text_input("試験名を入力", key="test_name_input_common", label_visibility="collapsed")
     
     with location_col:
         st.markdown("**分析場所を選択**")
-        analysis_location = st.radio("分析場所を選択", ["東分析", "西分析"], horizontal=True, index=0, key="analysis_location_common", label_visibility="collapsed")
+        analysis_location = st.radio("分析場所を選択", list(CALIBRATION_FILES), horizontal=True, key="analysis_location_common", label_visibility="collapsed")
     
     with group_col:
         # 分析場所に応じてCSVファイルを読み込み
-        if analysis_location == "東分析":
-            calibration_df = read_csv_anti("Calibration_upper_limit_OES.csv")
-        else:
-            calibration_df = read_csv_anti("Calibration_upper_limit_XRF.csv")
+        calibration_df = read_csv_anti(CALIBRATION_FILES[analysis_location])
         
         # Group列をセレクトボックスで選択
         if not calibration_df.empty and 'Group' in calibration_df.columns:
@@ -270,7 +561,35 @@ with st.container(border=True):
                 display_df.index = [selected_group]
                 st.dataframe(display_df, use_container_width=True)
 
-# --- 5つの配合タブを作成 ---
+    # エンコードを判定できず総当たりで読み込んだファイル（大きいCSVでは読み込みが遅くなる）
+    fallback_files = [os.path.basename(path) for path, (_, method) in encoding_report().items() if method == "総当たり"]
+    if fallback_files:
+        st.info(f"エンコードを判定できず総当たりで読み込んだファイル: {', '.join(fallback_files)}")
+
+    # チャンネル数（増やしたチャンネルは blending_ratio.csv の ChN 行、なければ既定値から始まる）
+    count_col, _ = st.columns([1, 5])
+    with count_col:
+        st.markdown("**チャンネル数**")
+        st.number_input("チャンネル数", min_value=1, max_value=MAX_CHANNELS, step=1, key="channel_count_common", label_visibility="collapsed")
+
+    # 選択中のタブだけ表・CSVを作成する（st.tabs がタブの選択状態を返せるバージョンのみ）
+    if "on_change" in inspect.signature(st.tabs).parameters:
+        lazy_tabs = st.checkbox("選択中のタブだけ表を作成する（タブを切り替えると再実行）", value=True, key="lazy_tabs_common")
+    else:
+        lazy_tabs = False
+
+# 検量線上限値を取得（全チャンネル共通）
+group_limits = {}
+if selected_group and not calibration_df.empty:
+    group_data = calibration_df[calibration_df['Group'] == selected_group]
+    if not group_data.empty:
+        for e in elements + ['Fe']:
+            if e in calibration_df.columns:
+                val = group_data[e].iloc[0]
+                if pd.notna(val) and val != 0:
+                    group_limits[e] = float(val)
+
+# --- 配合・指示票・分析依頼票のタブを作成 ---
 # レスポンシブ対応CSS
 st.markdown("""
 <style>
@@ -336,1240 +655,1293 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-tab_names = [f"🧪 Ch{i+1}" for i in range(5)] + ["📝 指示票", "📈 分析依頼票"]
-tabs = st.tabs(tab_names)
+tab_names = ["🧪 配合", "📝 指示票", "📈 分析依頼票", "📦 在庫計画"]
+if lazy_tabs:
+    tabs = st.tabs(tab_names, key="main_tabs", on_change="rerun")
+else:
+    tabs = st.tabs(tab_names)
 
-# blending_ratio.csvから目標成分を読み込む
-def read_blending_ratio():
+# 指示票に載せるチャンネル（Cの目標値が0でないもの）の入力値と計算結果
+def instruction_channels():
+    channels = []
+    for i in range(n_channels):
+        if st.session_state.get(f"target_C_{i}", 0.0) <= 0:
+            continue
+        selected_materials = st.session_state.get(f"selected_materials_widget_{i}", [])
+        calc_results = channel_summary(i, group_limits).get("weights", {})
+        total_weight = st.session_state.get(f"total_weight_{i}", 110.0) * 1000
+        selected_additives = st.session_state.get(f"selected_additives_{i}", [])
+        additives = []
+        for j, additive in enumerate(selected_additives):
+            percent_key = f"additive_percent_{additive}_{i}_{j}"
+            if percent_key in st.session_state:
+                additives.append((additive, st.session_state[percent_key] / 100 * total_weight))
+        channels.append({
+            "index": i,
+            "total_weight_kg": st.session_state.get(f"total_weight_{i}", 110.0),
+            "remaining_weight_kg": st.session_state.get(f"remaining_weight_{i}", 0.0),
+            "mode": st.session_state.get(f"mode_radio_{i}", "FCD"),
+            "tapping_temp": st.session_state.get(f"tapping_temp_{i}", 1450),
+            "materials": {mat: calc_results[mat] for mat in selected_materials if mat in calc_results},
+            "additives": additives,
+        })
+    return channels
+
+# PDF生成関数（output はファイルパスまたは BytesIO）
+def generate_instruction_pdf(output, test_name, multiplier=0.95):
     try:
-        df = pd.read_csv("blending_ratio.csv", encoding='cp932', index_col=0)
-        return df
+        return write_instruction_pdf(output, test_name, instruction_channels(), multiplier)
+    except OSError:
+        raise
     except Exception as e:
-        st.error(f"blending_ratio.csvの読み込みに失敗: {e}")
-        return pd.DataFrame()
+        st.error(f"PDF生成エラー: {e}")
+        return None
 
-blending_ratio_df = read_blending_ratio()
+# 選択した成分調整する元素に色を付ける
+def highlight_selected_elements(row, selected_elements):
+    sel_color = "background-color: #ffe599"  # 薄い黄色
+    result = []
+    for col in row.index:
+        if col in selected_elements:
+            result.append(sel_color)
+        else:
+            result.append("")
+    return result
+
+# 判定表用のハイライト関数
+def highlight_selected_and_ng(row, selected_elements):
+    ng_color = "background-color: #f4cccc"  # 薄い赤
+    sel_color = "background-color: #ffe599"  # 薄い黄色
+    result = []
+    if row.name == "判定":
+        for col, val in zip(row.index, row.values):
+            if isinstance(val, str) and val.startswith("×") and col in selected_elements:
+                result.append(ng_color)
+            elif col in selected_elements:
+                result.append(sel_color)
+            else:
+                result.append("")
+    else:
+        for col in row.index:
+            if col in selected_elements:
+                result.append(sel_color)
+            else:
+                result.append("")
+    return result
+
+# これより小さい成分（%）は表示上 "0"
+ZERO_PCT = 1e-12
+
+# 有効数字3桁の表示用文字列（配列のまま変換）
+def format_sig3(values):
+    values = np.asarray(values, dtype=float)
+    return np.where(np.abs(values) < ZERO_PCT, "0", np.char.mod("%.3g", values)).astype(object)
+
+# カンマ区切りの整数の表示用文字列（配列のまま変換）
+def format_grams(values):
+    return np.vectorize(lambda v: f"{int(v):,}", otypes=[object])(values)
+
+# 材料の実効成分行列（fraction に歩留まり・元素ごとの歩留まりを掛けたもの）。参照データの版ごとに1回だけ作成
+def material_composition(mat_elements):
+    return load_composition("materials.csv", mat_elements, yield_column="歩留まり", index_col=0)
+
+# 成分増加量の表の列ごとの表示形式（必要添加量はカンマ区切りの整数、成分は有効数字3桁）
+def inc_table_formatters(columns):
+    formatters = {c: (lambda v: f"{v:.3g}" if v != 0 else "0") for c in columns}
+    formatters["必要添加量(g)"] = lambda v: f"{int(round(v)):,}"
+    return formatters
+
+# 成分増加量の表をCSV出力用の文字列にする
+def format_inc_table(inc_table):
+    formatters = inc_table_formatters(inc_table.columns)
+    return inc_table.apply(lambda col: col.map(formatters[col.name]))
+
+# 材料・添加材ごとの必要添加量による成分増加量（%）の表（数値のまま、最後の行が合計）
+def build_inc_table(material_inc, material_grams, additive_inc, additive_grams, index, mat_elements):
+    inc_table = pd.DataFrame(np.vstack([material_inc, additive_inc]), index=index, columns=mat_elements)
+    inc_table.insert(0, "必要添加量(g)", np.concatenate([material_grams, additive_grams]))
+    inc_table.loc["合計"] = inc_table.sum()
+    return inc_table
 
-# PDF生成関数
-def generate_instruction_pdf(test_name, multiplier=0.95):
+# 入力値のフィンガープリント（参照データの版を含む）。同じなら前回の計算結果を再利用する
+def channel_fingerprint(channel_inputs):
+    source = json.dumps(channel_inputs, ensure_ascii=False, sort_keys=True, default=str)
+    source += repr(reference_version("materials.csv", "additives.csv"))
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+# 1チャンネル分の配合計算と表の作成（Streamlitの表示は行わず、メッセージは messages に入れる）
+def calculate_channel(inputs, warm_start=None):
+    messages = []
+    material_names = inputs["material_names"]
+    mat_elements = inputs["mat_elements"]
+    manual_values = inputs["manual_values"]
+    total_weight_g = inputs["total_weight_g"]
+    selected_elements = inputs["selected_elements"]
+    target_composition = inputs["target_composition"]
+    tolerance_values = inputs["tolerance_values"]
+    tolerance_types = inputs["tolerance_types"]
+    urgent_analysis_target = inputs["urgent_analysis_target"]
+    post_analysis_addition = inputs["post_analysis_addition"]
+    additive_composition_pct = inputs["additive_composition_pct"]
+    additive_names = inputs["additive_names"]
+    additive_grams = np.array(inputs["additive_grams"], dtype=float)
+    solver_method = inputs["solver_method"]
+    # 自動計算対象のインデックス
+    auto_idx = [i for i, v in enumerate(manual_values) if v == 0.0]
+    # A: 材料の実効成分行列（歩留まり込み） shape=(元素数, 材料数)
+    A_full = material_composition(mat_elements).take(material_names)
+    additive_matrix = load_composition("additives.csv", elements + ['Fe'], index_col=0)
+    # 添加材による成分増加量（%） shape=(添加材数, 元素数)
+    additive_block = additive_matrix.take(additive_names)
+    additive_inc = increase_pct(additive_block[[additive_matrix.elements.index(e) for e in mat_elements]], additive_grams, total_weight_g)
+    # 材料1gあたりの成分増加量（%、歩留まり込み）。至急分析前と至急分析後を足した添加量の両方の表で使う
+    material_unit_inc = increase_pct(A_full, np.ones(len(material_names)), total_weight_g)
+    inc_index = material_names + additive_names
+
+    constraint_kwargs = channel_constraints(inputs, [[urgent_analysis_target[e] for e in mat_elements]], [total_weight_g], [additive_grams.sum()])
+    if solver_method not in ("lstsq", "cost") and warm_start:
+        # 前回の解を初期値として使う
+        constraint_kwargs["warm_start"] = [[warm_start.get(m, 0.0) for m in material_names]]
+
+    add_weights = None
+    post_analysis_weights = np.zeros(len(material_names))
+    # コスト最小化は許容範囲の制約で解くため、至急分析後の添加量は従来どおり含有量の最も多い材料で補う
+    two_stage = solver_method != "cost" and any(post_analysis_addition[e] > 0 for e in mat_elements)
+    solve_args = (
+        A_full,
+        [[urgent_analysis_target[e] for e in mat_elements]],
+        [total_weight_g],
+        np.ones((1, len(material_names)), dtype=bool),
+        [manual_values],
+        [[post_analysis_addition[e] for e in mat_elements]],
+    )
     try:
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-        from reportlab.lib.styles import ParagraphStyle
-        
-        # 日本語フォントを登録
-        try:
-            pdfmetrics.registerFont(TTFont('NotoSansCJK', 'NotoSansCJK-Regular.ttf'))
-            font_name = 'NotoSansCJK'
-        except:
-            try:
-                pdfmetrics.registerFont(TTFont('MSGothic', 'msgothic.ttc'))
-                font_name = 'MSGothic'
-            except:
-                font_name = 'Helvetica'
-        
-        from reportlab.lib.pagesizes import landscape
+        # 配合エンジンで解く（至急分析目標値を使用、1ヒート分のバッチとして計算）
+        solve_start = time.perf_counter()
+        if two_stage:
+            # 検量線上限値を超える元素があれば、至急分析前と至急分析後の添加量を同時に最適化する
+            two_stage_kwargs = {k: v for k, v in constraint_kwargs.items() if k in TWO_STAGE_CONSTRAINTS}
+            blend_result = solve_blend_two_stage(*solve_args, limit_pct=[inputs["calibration_limit_pct"]], **two_stage_kwargs)
+            messages.append(("caption", "至急分析後の添加量は、検量線上限値を至急分析前の制約として至急分析前の添加量と同時に計算しています。"))
+        else:
+            blend_result = solve_blend(*solve_args, method=solver_method, **constraint_kwargs)
+            if any(post_analysis_addition[e] > 0 for e in mat_elements):
+                messages.append(("caption", "コスト最小化では、至急分析後の添加量は含有量の最も多い材料で補う近似値です（至急分析前の添加量との同時最適化は行いません）。"))
+        solve_ms = (time.perf_counter() - solve_start) * 1000
+        add_weights = blend_result.weights[0]
+        post_analysis_weights = blend_result.post_weights[0]
+        if blend_result.rank_deficient[0]:
+            messages.append(("warning", "行列のランク不足のため、近似解を使用しています。"))
+        if solver_method == "cost":
+            additive_cost = 0.0
+            if "単価" in additives_df.columns:
+                additive_prices = additives_df[~additives_df.index.duplicated()]["単価"].reindex(additive_names).fillna(0.0)
+                additive_cost = float(np.dot(additive_grams, additive_prices.to_numpy(dtype=float)) / 1000)
+            messages.append(("caption", f"材料費: {blend_result.cost[0]:,.0f} 円 ／ 添加剤費: {additive_cost:,.0f} 円"))
+        if solver_method != "lstsq":
+            # 従来の最小二乗法との計算時間の比較
+            lstsq_start = time.perf_counter()
+            solve_blend(*solve_args)
+            lstsq_ms = (time.perf_counter() - lstsq_start) * 1000
+            warm_note = "（前回解を再利用）" if blend_result.warm_started is not None and blend_result.warm_started[0] else ""
+            messages.append(("caption", f"計算時間: {SOLVER_METHODS[solver_method]} {solve_ms:.2f} ms{warm_note} ／ {SOLVER_METHODS['lstsq']} {lstsq_ms:.2f} ms"))
+    except Exception as e:
+        messages.append(("error", f"計算エラー: {str(e)}"))
+        # フォールバック：単純な比例配分
+        add_weights = np.array(manual_values)
+        for idx in auto_idx:
+            add_weights[idx] = 1000.0 / len(auto_idx)  # 1kgを基準
+
+    # 至急分析目標値での成分増加量の表（成分の値がすべて0の列を非表示）
+    inc_table_urgent = build_inc_table(material_unit_inc * add_weights[:, None], add_weights, additive_inc, additive_grams, inc_index, mat_elements)
+    nonzero = inc_table_urgent.iloc[-1][mat_elements].to_numpy() != 0
+    inc_table_filtered = inc_table_urgent[["必要添加量(g)"] + [e for e, keep in zip(mat_elements, nonzero) if keep]]
+
+    # 添加する添加材だけ表示（0gでない、かつ選択されている添加材のみ抽出）
+    used_additives = [a for a, g in zip(additive_names, additive_grams) if g > 0]
+    additives_df_disp = None
+    additives_df_disp_str = None
+    if used_additives:
+        additives_df_disp = pd.DataFrame([[g for g in additive_grams if g > 0]], columns=used_additives)
+        additives_df_disp.index = ["必要添加量(g)"]
+        additives_df_disp_str = additives_df_disp.map(lambda x: f"{int(x):,}" if x != 0 else "0")
+
+    # 1e-3g以下は0として扱う
+    add_weights_masked = np.where(add_weights > 1e-3, add_weights, 0.0)
+    # 小数点以下四捨五入
+    rounded_weights = np.round(add_weights)
+
+    # 至急分析前添加量と至急分析後添加量を足した値で成分増加量の表を作成（CSV出力用）
+    total_weights = add_weights + post_analysis_weights
+    inc_table = build_inc_table(material_unit_inc * total_weights[:, None], total_weights, additive_inc, additive_grams, inc_index, mat_elements)
+
+    # 結果表に2行を追加
+    result_with_analysis = pd.DataFrame([
+        rounded_weights,
+        np.round(post_analysis_weights)
+    ], columns=material_names, index=["至急分析前添加量(g)", "至急分析後添加量(g)"])
+    result_with_analysis = result_with_analysis.loc[:, (result_with_analysis.iloc[0] > 1e-3) | (result_with_analysis.iloc[1] > 1e-3)]
+
+    # 表示用文字列（カンマ区切りの整数、至急分析後添加量の0は"-"）
+    grams = result_with_analysis.to_numpy()
+    grams_str = format_grams(grams)
+    grams_str[1] = np.where(grams[1] == 0, "-", grams_str[1])
+    result_with_analysis_str = pd.DataFrame(grams_str, index=result_with_analysis.index, columns=result_with_analysis.columns)
+
+    # --- ここから複合表の作成（元素ごとの配列でまとめて計算） ---
+    element_names = np.array(mat_elements)
+    target_pct = np.array([target_composition[e] for e in mat_elements])
+    additive_pct = np.array([additive_composition_pct[e] for e in mat_elements])
+    urgent_pct = np.array([urgent_analysis_target[e] for e in mat_elements])
+    # 目標値（Cのみインプット値、それ以外はtarget_composition）
+    target_row = target_pct.copy()
+    if inputs["user_c_input"] is not None:
+        target_row[element_names == "C"] = inputs["user_c_input"]
+    # 出湯前目標値（成分目標値から添加剤で増加する成分を引いた値、CはFCD +0.08 / FC +0.07）
+    c_offset = 0.08 if inputs["mode"] == "FCD" else 0.07
+    pre_tapping_target_row = np.maximum(0.0, target_pct + np.where(element_names == "C", c_offset, 0.0) - additive_pct)
+    # 配合計算成分（旧:実際の成分達成度）
+    achieved = np.dot(A_full, add_weights_masked)
+    achieved_pct = achieved / total_weight_g * 100
+    # 判定（Feと選択していない元素、目標値が0の元素は"-"）
+    judgement = judge_blend(
+        achieved_pct,
+        urgent_pct,
+        [tolerance_values.get(e, 0.01) for e in mat_elements],
+        [tolerance_types.get(e, "±") == "以下" for e in mat_elements],
+        [e in selected_elements and e != "Fe" for e in mat_elements],
+    )
+    # 第1の表：成分目標値・出湯前目標値・出湯後添加成分
+    table1_values = np.vstack([target_row, pre_tapping_target_row, additive_pct])
+    table1_disp = pd.DataFrame(format_sig3(table1_values), index=["成分目標値(%)", "出湯前目標値(%)", "出湯後添加成分(%)"], columns=mat_elements)
+    # 第2の表：至急分析目標値・配合計算成分・判定
+    table2_values = np.vstack([urgent_pct, achieved_pct])
+    table2_disp = pd.DataFrame(np.vstack([format_sig3(table2_values), judgement.labels()]), index=["至急分析目標値(%)", "配合計算成分(%)", "判定"], columns=mat_elements)
+    # 成分の値がすべて0の列を非表示（両方の表で共通）
+    cols_to_show = list(element_names[(np.abs(np.vstack([table1_values, table2_values])) >= ZERO_PCT).any(axis=0)])
+
+    # 最大誤差（至急分析目標値と比較）
+    target_achieved = np.array([urgent_analysis_target[e] / 100 * total_weight_g for e in mat_elements])
+    max_err = np.max(np.abs(achieved - target_achieved))
+
+    return {
+        "messages": messages,
+        "add_weights": add_weights,
+        "inc_table_filtered": inc_table_filtered,
+        "inc_table": inc_table,
+        "additives_df_disp": additives_df_disp,
+        "additives_df_disp_str": additives_df_disp_str,
+        "result_with_analysis": result_with_analysis,
+        "result_with_analysis_str": result_with_analysis_str,
+        "table1_filtered": table1_disp[cols_to_show],
+        "table2_filtered": table2_disp[cols_to_show],
+        "max_err": max_err,
+        "judgement": judgement,
+        "calc_results": dict(zip(material_names, add_weights)),
+    }
+
+# 計算方式ごとの制約（画面の設定、batch_replay.solver_constraints）。urgent_pct: (N, 元素数)、total_weight_g / additive_total_g: (N,)
+def channel_constraints(inputs, urgent_pct, total_weight_g, additive_total_g):
+    mat_elements = inputs["mat_elements"]
+    price = None
+    if inputs["solver_method"] == "cost":
+        price = materials_df.reindex(inputs["material_names"])["単価"].to_numpy(dtype=float) / 1000
+    return solver_constraints(
+        inputs["solver_method"],
+        urgent_pct,
+        np.asarray(total_weight_g, dtype=float) - np.asarray(additive_total_g, dtype=float),
+        np.array(inputs["lower_kg"], dtype=float) * 1000,
+        np.array(inputs["upper_kg"], dtype=float) * 1000,
+        inputs["use_capacity"],
+        price,
+        [inputs["tolerance_values"].get(e, 0.01) for e in mat_elements],
+        [inputs["tolerance_types"].get(e, "±") == "以下" for e in mat_elements],
+        [e in inputs["selected_elements"] and e != "Fe" for e in mat_elements],
+    )
+
+# 感度分析：1つまたは2つの入力を範囲で変えたときの必要添加量と判定
+# 検量線上限値を超える点は画面の計算（calculate_channel）と同じく至急分析前後の添加量を同時に最適化し、
+# それ以外の点はグリッド全体を1回のバッチ計算（最小二乗法）で解く
+# axes: [(種類 "weight" / "target" / "additive", 元素名・添加剤名, 値の配列), ...]
+def sweep_channel(inputs, calibration_limits, axes):
+    all_elements = elements + ['Fe']
+    material_names = inputs["material_names"]
+    mat_elements = inputs["mat_elements"]
+    additive_names = inputs["additive_names"]
+    grids = np.meshgrid(*[values for _, _, values in axes], indexing="ij")
+    n = grids[0].size
+    total_weight_g = np.full(n, float(inputs["total_weight_g"]))
+    target_pct = np.tile([inputs["target_composition"][e] for e in elements], (n, 1))
+    additive_percent = np.tile(np.array(inputs["additive_grams"], dtype=float) / inputs["total_weight_g"] * 100, (n, 1))
+    for (kind, name, _), grid in zip(axes, grids):
+        values = grid.ravel()
+        if kind == "weight":
+            total_weight_g = values * 1000
+        elif kind == "target":
+            # Cは自動加算（FCD +0.07 / FC +0.05）後の値を目標にする
+            c_offset = 0.07 if inputs["mode"] == "FCD" else 0.05
+            target_pct[:, elements.index(name)] = values + (c_offset if name == "C" else 0.0)
+        else:
+            additive_percent[:, additive_names.index(name)] = values
+    # Feの目標値は100%から他元素の合計を引いた値
+    target_pct = np.column_stack([target_pct, 100.0 - target_pct.sum(axis=1)])
+    # 添加材由来の成分（%）は 添加率（%）× 添加材成分（fraction）なので溶解重量によらない
+    additive_block = load_composition("additives.csv", all_elements, index_col=0).take(additive_names)
+    additive_pct = additive_percent @ additive_block.T
+    urgent_pct, post_pct = split_urgent_targets(target_pct, additive_pct, [calibration_limits.get(e, np.inf) for e in all_elements])
+    cols = [all_elements.index(e) for e in mat_elements]
+    urgent_pct, post_pct = urgent_pct[:, cols], post_pct[:, cols]
+    A_full = material_composition(mat_elements).take(material_names)
+    solve_args = (A_full, urgent_pct, total_weight_g, np.ones((n, len(material_names)), dtype=bool), np.tile(inputs["manual_values"], (n, 1)), post_pct)
+    weights = solve_blend(*solve_args).weights
+    two_stage = (post_pct > 0).any(axis=1)
+    if two_stage.any():
+        rows = np.flatnonzero(two_stage)
+        additive_total_g = additive_percent.sum(axis=1) / 100 * total_weight_g
+        two_stage_kwargs = {k: v[rows] for k, v in channel_constraints(inputs, urgent_pct, total_weight_g, additive_total_g).items() if k in TWO_STAGE_CONSTRAINTS}
+        limit_pct = np.tile([calibration_limits.get(e, np.inf) for e in mat_elements], (rows.size, 1))
+        weights[rows] = solve_blend_two_stage(*[arg if k == 0 else arg[rows] for k, arg in enumerate(solve_args)], limit_pct=limit_pct, **two_stage_kwargs).weights
+    achieved_pct = np.where(weights > 1e-3, weights, 0.0) @ A_full.T / total_weight_g[:, None] * 100
+    judgement = judge_blend(
+        achieved_pct,
+        urgent_pct,
+        [inputs["tolerance_values"].get(e, 0.01) for e in mat_elements],
+        [inputs["tolerance_types"].get(e, "±") == "以下" for e in mat_elements],
+        [e in inputs["selected_elements"] and e != "Fe" for e in mat_elements],
+    )
+    sweep_df = pd.DataFrame({f"入力{k + 1}": grid.ravel() for k, grid in enumerate(grids)})
+    for j, m in enumerate(material_names):
+        sweep_df[m] = weights[:, j] / 1000
+    sweep_df["判定"] = np.where(judgement.all_ok, "○", "×")
+    sweep_df.attrs["two_stage"] = int(two_stage.sum())
+    return sweep_df
+
+# 材料の自動選択の結果表示（種類, 文字列）。選んだ組で許容範囲内に入るかは、混合整数計画法の解ではなく
+# このチャンネルの計算方式で計算した判定（judgement）で決める
+def auto_select_message(selection, judgement=None, mat_elements=(), solver_method="lstsq"):
+    method_label = {"milp": "混合整数計画法", "greedy": "貪欲法"}[selection.method]
+    detail = f"{method_label}、候補 {selection.n_candidates} 件、{selection.elapsed * 1000:.0f} ms"
+    n = selection.columns.size
+    if not n:
+        return "warning", f"成分を供給できる材料がありません（{detail}）"
+    if judgement.all_ok[0]:
+        return "success", f"許容範囲内に入る {n} 種類の材料を選びました（{detail}）"
+    ng = " ".join(e for e, bad in zip(mat_elements, judgement.ng[0]) if bad)
+    if not selection.feasible:
+        return "warning", f"許容範囲内に入る組が見つからなかったため、最も近い {n} 種類の材料を選びました（{detail}、NG: {ng}）"
+    hint = "計算方式を線形計画法にすると許容範囲内の配合を探します。" if solver_method != "lp" else ""
+    return "warning", f"{n} 種類の材料を選びましたが、{SOLVER_METHODS[solver_method]}で計算した配合は許容範囲外です（NG: {ng}）。{hint}（{detail}）"
+
+# 1チャンネル分の画面。入力を変えたときはこのチャンネルだけ再実行する（指示票は全体の再実行で更新）
+@st.fragment
+def render_channel(current_tab_index, show_tables=True):
+    # タブ内の入力の変更（このタブだけの再実行）も自動保存する
+    autosave_session()
+    # Session Stateの初期化
+    if f"total_weight_{current_tab_index}" not in st.session_state:
+        st.session_state[f"total_weight_{current_tab_index}"] = 110.0
+    if f"remaining_weight_{current_tab_index}" not in st.session_state:
+        st.session_state[f"remaining_weight_{current_tab_index}"] = 0.0
+    if f"tapping_temp_{current_tab_index}" not in st.session_state:
+        st.session_state[f"tapping_temp_{current_tab_index}"] = 1450
+    # blending_ratio.csvから目標値を取得
+    blend_targets, blend_tolerance_types, default_elements = blend_defaults(current_tab_index)
+    # 以降、全てのstウィジェットのkeyに f"_{current_tab_index}" を付与して、タブごとに独立させる
+    # ---------------------------
+    # 基本設定
+    # ---------------------------
+    with st.container(border=True):
+        st.header("⚙️ 基本設定")
+        weight_col1, weight_col2, mode_col, temp_col = st.columns(4)
+        with weight_col1:
+            st.markdown("**溶解重量 (kg)**")
+            if f"total_weight_{current_tab_index}" not in st.session_state:
+                st.session_state[f"total_weight_{current_tab_index}"] = 110.0
+            total_weight_kg = st.number_input("溶解重量 (kg)", min_value=1.0, key=f"total_weight_{current_tab_index}", label_visibility="collapsed")
+        with weight_col2:
+            st.markdown("**残湯量 (kg)**")
+            if f"remaining_weight_{current_tab_index}" not in st.session_state:
+                st.session_state[f"remaining_weight_{current_tab_index}"] = 0.0
+            remaining_weight_kg = st.number_input("残湯量 (kg)", min_value=0.0, key=f"remaining_weight_{current_tab_index}", label_visibility="collapsed")
+        with mode_col:
+            st.markdown("**溶湯種別選択**")
+            mode = st.radio("溶湯種別選択", ["FCD", "FC"], horizontal=True, index=0, key=f"mode_radio_{current_tab_index}", label_visibility="collapsed")
+        with temp_col:
+            st.markdown("**出湯温度（℃）**")
+            if f"tapping_temp_{current_tab_index}" not in st.session_state:
+                st.session_state[f"tapping_temp_{current_tab_index}"] = 1450
+            tapping_temp = st.number_input("出湯温度（℃）", min_value=1300, max_value=1600, step=1, key=f"tapping_temp_{current_tab_index}", label_visibility="collapsed")
+    total_weight_g = total_weight_kg * 1000
+
+    # ---------------------------
+    # 目標成分
+    # ---------------------------
+    with st.container(border=True):
+        st.header("🎯 目標成分")
         
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), leftMargin=20, rightMargin=20)
-        styles = getSampleStyleSheet()
-        story = []
+        default_targets = DEFAULT_TARGETS
         
-        # タイトルスタイル
-        title_style = ParagraphStyle('JapaneseTitle', parent=styles['Title'], fontName=font_name, fontSize=12)
+        state_key = f"selected_elements_{current_tab_index}"
+        # セッションステートに未設定、または空リストなら初期化
+        if state_key not in st.session_state or st.session_state[state_key] == []:
+            st.session_state[state_key] = default_elements
+
+        st.markdown("**元素選択**")
+        selected_elements = st.multiselect(
+            "成分調整する元素を選択してください（複数可）",
+            options=elements,
+            key=state_key,
+            label_visibility="collapsed"
+        )
         
-        # 各チャンネルを個別のセクションとして表示
-        valid_channels = []
-        for i in range(5):
-            app_c_value = st.session_state.get(f"target_C_{i}", 0.0)
-            if app_c_value > 0:
-                valid_channels.append(i)
+        target_composition = {}
+        tolerance_values = {}
+        tolerance_types = {}
+        user_c_input = None
         
-        if valid_channels:
-            # タイトル
-            title = Paragraph(f"指示票 - {test_name}", title_style)
-            story.append(title)
-            story.append(Spacer(1, 10))
-            
-            # 全てのチャンネルを1行に表示
-            channel_tables = []
-            
-            for i in valid_channels:
-                    # チャンネル見出し
-                    ch_style = ParagraphStyle('ChannelHeader', parent=styles['Heading3'], fontName=font_name, fontSize=12, alignment=1)
-                    ch_header = Paragraph(f"Ch{i+1}", ch_style)
-                    
-                    # 基本情報
-                    total_weight_kg = st.session_state.get(f"total_weight_{i}", 110.0)
-                    remaining_weight_kg = st.session_state.get(f"remaining_weight_{i}", 0.0)
-                    mode = st.session_state.get(f"mode_radio_{i}", "FCD")
-                    tapping_temp = st.session_state.get(f"tapping_temp_{i}", 1450)
-                    
-                    # 基本情報テーブル
-                    basic_data = [
-                        ["溶湯重量", f"{total_weight_kg}kg"],
-                        ["残湯量", f"{remaining_weight_kg}kg"],
-                        ["溶湯種別", mode],
-                        ["出湯温度", f"{tapping_temp}℃"]
-                    ]
-                    
-                    basic_table = Table(basic_data, colWidths=[50, 50])
-                    basic_table.setStyle(TableStyle([
-                        ('FONTNAME', (0, 0), (-1, -1), font_name),
-                        ('FONTSIZE', (0, 0), (-1, -1), 9),
-                        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-                        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-                        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                        ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey)
-                    ]))
-                    
-                    # 材料データ
-                    base_material_names = ["神鋼SP銑", "故銑", "鋼屑"]
-                    selected_materials = st.session_state.get(f"selected_materials_widget_{i}", [])
-                    calc_results = st.session_state.get(f"calc_results_{i}", {})
-                    
-                    material_data = []
-                    for mat in base_material_names:
-                        if mat in selected_materials and mat in calc_results and calc_results[mat] > 0:
-                            adjusted_weight = calc_results[mat] * multiplier
-                            material_data.append([mat, f"{round(adjusted_weight/1000)}kg", "□"])
-                    
-                    material_table = None
-                    if material_data:
-                        material_title = Paragraph("材料", ParagraphStyle('SectionTitle', parent=styles['Normal'], fontName=font_name, fontSize=10, spaceAfter=3))
-                        material_table = Table(material_data, colWidths=[60, 60, 20])
-                        material_table.setStyle(TableStyle([
-                            ('FONTNAME', (0, 0), (-1, -1), font_name),
-                            ('FONTSIZE', (0, 0), (-1, -1), 9),
-                            ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-                            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-                            ('ALIGN', (2, 0), (2, -1), 'CENTER'),
-                            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-                        ]))
-                    
-                    # 合金データ
-                    alloy_data = []
-                    for mat in selected_materials:
-                        if mat not in base_material_names and mat in calc_results and calc_results[mat] > 0:
-                            adjusted_weight = calc_results[mat] * multiplier
-                            alloy_data.append([mat, f"{int(adjusted_weight):,}g", "□"])
-                    
-                    alloy_table = None
-                    if alloy_data:
-                        alloy_title = Paragraph("合金", ParagraphStyle('SectionTitle', parent=styles['Normal'], fontName=font_name, fontSize=10, spaceAfter=3))
-                        alloy_table = Table(alloy_data, colWidths=[60, 60, 20])
-                        alloy_table.setStyle(TableStyle([
-                            ('FONTNAME', (0, 0), (-1, -1), font_name),
-                            ('FONTSIZE', (0, 0), (-1, -1), 9),
-                            ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-                            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-                            ('ALIGN', (2, 0), (2, -1), 'CENTER'),
-                            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-                        ]))
-                    
-                    # 添加剤データ
-                    selected_additives = st.session_state.get(f"selected_additives_{i}", [])
-                    total_weight = st.session_state.get(f"total_weight_{i}", 110.0) * 1000
-                    
-                    additive_data = []
-                    for j, additive in enumerate(selected_additives):
-                        percent_key = f"additive_percent_{additive}_{i}_{j}"
-                        if percent_key in st.session_state:
-                            percent = st.session_state[percent_key]
-                            grams = percent / 100 * total_weight
-                            if grams > 0:
-                                additive_data.append([additive, f"{int(grams):,}g", "□"])
-                    
-                    additive_table = None
-                    if additive_data:
-                        additive_title = Paragraph("添加剤", ParagraphStyle('SectionTitle', parent=styles['Normal'], fontName=font_name, fontSize=10, spaceAfter=3))
-                        additive_table = Table(additive_data, colWidths=[60, 60, 20])
-                        additive_table.setStyle(TableStyle([
-                            ('FONTNAME', (0, 0), (-1, -1), font_name),
-                            ('FONTSIZE', (0, 0), (-1, -1), 9),
-                            ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-                            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-                            ('ALIGN', (2, 0), (2, -1), 'CENTER'),
-                            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-                        ]))
-                    
-                    # 全てのテーブルを結合
-                    channel_elements = [basic_table, Spacer(1, 8)]
-                    if material_table:
-                        channel_elements.extend([material_title, material_table, Spacer(1, 8)])
-                    if alloy_table:
-                        channel_elements.extend([alloy_title, alloy_table, Spacer(1, 8)])
-                    if additive_table:
-                        channel_elements.extend([additive_title, additive_table])
-                    
-                    # ヘッダーとコンテンツを組み合わせ
-                    channel_content = [[ch_header]]
-                    for element in channel_elements:
-                        channel_content.append([element])
-                    
-                    channel_wrapper = Table(channel_content, colWidths=[130])
-                    channel_wrapper.setStyle(TableStyle([
-                        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-                        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-                        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-                        ('TOPPADDING', (0, 0), (-1, -1), 2),
-                        ('BOTTOMPADDING', (0, 0), (-1, -1), 2)
-                    ]))
+        # 選択された元素の設定を表示
+        if selected_elements:
+            st.markdown("**目標値**")
+            # 元素を5列表示
+            element_cols = st.columns(min(5, len(selected_elements)))
+            for i, e in enumerate(selected_elements):
+                col = element_cols[i % len(element_cols)]
+                with col:
+                    # Cの場合は自動加算後の値をタイトルに表示
+                    if e == "C":
+                        default_val = blend_targets.get(e, default_targets.get(e, 0.0))
+                        # 一時的に計算してタイトル用の値を取得
+                        if mode == "FCD":
+                            calc_val_for_title = default_val + 0.07
+                        else:
+                            calc_val_for_title = default_val + 0.05
+                        expander_title = f"⚙️ {e}（自動加算後: {calc_val_for_title:.2f}%）"
+                    else:
+                        expander_title = f"⚙️ {e}"
                     
-                    channel_tables.append(channel_wrapper)
-                
-            # 全チャンネルを横並びに配置
-            if len(channel_tables) == 1:
-                story.append(channel_tables[0])
-            else:
-                row_table = Table([channel_tables], colWidths=[160] * len(channel_tables))
-                row_table.setStyle(TableStyle([
-                    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-                    ('LEFTPADDING', (0, 0), (-1, -1), 15),
-                    ('RIGHTPADDING', (0, 0), (-1, -1), 15)
-                ]))
-                story.append(row_table)
+                    with st.expander(expander_title, expanded=True):
+                        # blending_ratio.csv優先、なければデフォルト
+                        default_val = blend_targets.get(e, default_targets.get(e, 0.0))
+                        
+                        if e == "C":
+                            target_label_col, target_input_col = st.columns([1, 1])
+                            with target_label_col:
+                                st.markdown("**目標値（%）**")
+                            with target_input_col:
+                                if f"target_{e}_{current_tab_index}" not in st.session_state:
+                                    st.session_state[f"target_{e}_{current_tab_index}"] = default_val
+                                user_val = st.number_input(f"目標値（%）", min_value=0.0, key=f"target_{e}_{current_tab_index}", label_visibility="collapsed")
+                            user_c_input = user_val
+                            if mode == "FCD":
+                                calc_val = user_val + 0.07
+                            else:
+                                calc_val = user_val + 0.05
+                            target_composition[e] = calc_val
+                        else:
+                            target_label_col, target_input_col = st.columns([1, 1])
+                            with target_label_col:
+                                st.markdown("**目標値（%）**")
+                            with target_input_col:
+                                if f"target_{e}_{current_tab_index}" not in st.session_state:
+                                    st.session_state[f"target_{e}_{current_tab_index}"] = default_val
+                                target_composition[e] = st.number_input(f"目標値（%）", min_value=0.0, key=f"target_{e}_{current_tab_index}", label_visibility="collapsed")
+                        
+                        default_tol = 0.05 if e in ["C", "Si", "Mn"] else 0.01
+                        tol_label_col, tol_input_col = st.columns([1, 1])
+                        with tol_label_col:
+                            st.markdown("**許容値**")
+                        with tol_input_col:
+                            if f"tol_{e}_{current_tab_index}" not in st.session_state:
+                                st.session_state[f"tol_{e}_{current_tab_index}"] = default_tol
+                            tolerance_values[e] = st.number_input(f"許容値", min_value=0.0, step=0.01, key=f"tol_{e}_{current_tab_index}", label_visibility="collapsed")
+                        
+                        type_label_col, type_input_col = st.columns([1, 1])
+                        with type_label_col:
+                            st.markdown("**判定方法**")
+                        with type_input_col:
+                            default_tol_type = blend_tolerance_types.get(e, "±")
+                            if f"tol_type_{e}_{current_tab_index}" not in st.session_state:
+                                st.session_state[f"tol_type_{e}_{current_tab_index}"] = default_tol_type
+                            tolerance_types[e] = st.selectbox(f"判定方法", ["±", "以下"], key=f"tol_type_{e}_{current_tab_index}", label_visibility="collapsed")
         
-        doc.build(story)
-        buffer.seek(0)
-        return buffer
+        # 選択されていないものは0
+        for e in elements:
+            if e not in selected_elements:
+                target_composition[e] = 0.0
+                tolerance_values[e] = 0.01
+                tolerance_types[e] = blend_tolerance_types.get(e, "±")
         
-    except Exception as e:
-        st.error(f"PDF生成エラー: {e}")
-        return None
+        # Feの目標値は100%から他元素の合計を引いた値
+        fe_target = 100.0 - sum(target_composition.values())
+        target_composition['Fe'] = fe_target
 
-for tab_idx, tab in enumerate(tabs):
-    with tab:
-        if tab_idx == 5:  # 指示票タブの場合
-            st.markdown(f"<h2 style='text-align: center; background-color: #ffe6e6; padding: 10px; border-radius: 5px;'>{tab_names[tab_idx]}</h2>", unsafe_allow_html=True)
-        elif tab_idx == 6:  # 分析依頼票タブの場合
-            st.markdown(f"<h2 style='text-align: center; background-color: #f0f0f0; padding: 10px; border-radius: 5px;'>{tab_names[tab_idx]}</h2>", unsafe_allow_html=True)
+    # ---------------------------
+    # 添加剤設定
+    # ---------------------------
+    with st.container(border=True):
+        st.header("🧪 添加剤設定")
+        additive_list = list(additives_df.index)
+        # FCD/FCモードで初期選択を切り替え
+        if mode == "FCD":
+            default_additives = [a for a in additive_list if a in FCD_ADDITIVES]
         else:
-            st.markdown(f"<h2 style='text-align: center; background-color: #e6f3ff; padding: 10px; border-radius: 5px;'>{tab_names[tab_idx]}</h2>", unsafe_allow_html=True)
+            default_additives = []
+        st.markdown("**添加剤選択**")
+        if f"selected_additives_{current_tab_index}" not in st.session_state:
+            st.session_state[f"selected_additives_{current_tab_index}"] = default_additives
+        selected_additives = st.multiselect(
+            "添加材として使用するものを選択してください（複数可）",
+            options=additive_list,
+            key=f"selected_additives_{current_tab_index}",
+            label_visibility="collapsed"
+        )
         
-        # 新しいタブの処理
-        if tab_idx >= 5:  # 指示票、分析依頼票タブ
-            if tab_idx == 5:  # 指示票
-                st.markdown("<br>", unsafe_allow_html=True)
-                st.markdown("**設定倍率（材料、合金の添加量に反映）**")
-                multiplier = st.number_input("設定倍率", min_value=0.1, max_value=2.0, value=0.95, step=0.01, key="pdf_multiplier", label_visibility="collapsed")
-                
-                if st.button("📁 指示票PDFを保存", key="pdf_save"):
-                    pdf_buffer = generate_instruction_pdf(test_name, multiplier)
-                    if pdf_buffer:
-                        # デスクトップアプリ用にファイルを直接保存
-                        pdf_filename = f"{test_name}_指示票.pdf"
-                        try:
-                            with open(pdf_filename, 'wb') as f:
-                                f.write(pdf_buffer.getvalue())
-                            st.success(f"PDFファイルを保存しました: {pdf_filename}")
-                        except Exception as e:
-                            st.error(f"PDF保存エラー: {e}")
-                            # フォールバックとしてダウンロードボタンを表示
-                            st.download_button(
-                                label="📁 指示票PDFをダウンロード",
-                                data=pdf_buffer.getvalue(),
-                                file_name=pdf_filename,
-                                mime="application/pdf",
-                                key="pdf_download_fallback"
-                            )
-                
-                # blending_ratio.csvから値がすべて0でない配合を取得
-                if blending_ratio_df is not None and not blending_ratio_df.empty:
-                    instruction_data = []
-                    base_materials_data = []  # 神鋼SP銑、故銑、鋼屑のみのデータ
-                    
-                    for i in range(5):  # Ch1-5をチェック
-                        blend_name = f"Ch{i+1}"
-                        if blend_name in blending_ratio_df.index:
-                            blend_row = blending_ratio_df.loc[blend_name]
-                            # アプリでの入力値（C）が0でないかチェック
-                            app_c_value = st.session_state.get(f"target_C_{i}", 0.0)
-                            has_nonzero = app_c_value > 0
-                            if has_nonzero:
-                                # セッションステートから実際の計算結果を取得
-                                materials_info = {"配合名": blend_name}
-                                base_materials_info = {"配合名": blend_name}
-                                
-                                # 溶解重量を取得
-                                total_weight = st.session_state.get(f"total_weight_{i}", 110.0) * 1000
-                                
-                                # 添加剤の必要添加量を取得（g単位）
-                                selected_additives = st.session_state.get(f"selected_additives_{i}", [])
-                                for j, additive in enumerate(selected_additives):
-                                    percent_key = f"additive_percent_{additive}_{i}_{j}"
-                                    if percent_key in st.session_state:
-                                        percent = st.session_state[percent_key]
-                                        grams = percent / 100 * total_weight
-                                        materials_info[f"{additive}(g)"] = int(grams)
-                                    else:
-                                        materials_info[f"{additive}(g)"] = 0
-                                
-                                # 選択された材料の必要添加量を取得（計算結果から）
-                                selected_materials = st.session_state.get(f"selected_materials_widget_{i}", [])
-                                calc_results = st.session_state.get(f"calc_results_{i}", {})
-                                
-                                # 神鋼SP銑、故銑、鋼屑の重量のみを記録
-                                base_material_names = ["神鋼SP銑", "故銑", "鋼屑"]
-                                for mat in base_material_names:
-                                    if mat in selected_materials and mat in calc_results:
-                                        weight_g = calc_results[mat]
-                                        if weight_g > 0:  # 重量0gは表示しない
-                                            base_materials_info[f"{mat}(g)"] = int(weight_g)
-                                
-                                # その他の材料
-                                for mat in selected_materials:
-                                    if mat not in ["鋼屑", "神鋼ＳＰ銑", "故銑"]:
-                                        # 計算結果から実際の値を取得
-                                        if mat in calc_results:
-                                            materials_info[f"{mat}(g)"] = int(calc_results[mat])
-                                        else:
-                                            materials_info[f"{mat}(g)"] = 0
-                                
-                                instruction_data.append(materials_info)
-                                base_materials_data.append(base_materials_info)
-                    
-                    # 有効な配合を収集
-                    valid_blends = []
-                    for i in range(5):
-                        blend_name = f"Ch{i+1}"
-                        if blend_name in blending_ratio_df.index:
-                            blend_row = blending_ratio_df.loc[blend_name]
-                            has_nonzero = any(pd.notna(v) and v != 0 for v in blend_row.values)
-                            if has_nonzero:
-                                valid_blends.append(i)
-                    
-                    # 5列固定で表示
-                    cols = st.columns(5)
-                    for i in range(5):
-                        with cols[i]:
-                            blend_name = f"Ch{i+1}"
-                            if blend_name in blending_ratio_df.index:
-                                blend_row = blending_ratio_df.loc[blend_name]
-                                app_c_value = st.session_state.get(f"target_C_{i}", 0.0)
-                                has_nonzero = app_c_value > 0
-                                if has_nonzero:
-                                    with st.container(border=True):
-                                        st.markdown(f"<h3 style='text-align: center; background-color: #e6f3ff; padding: 8px; border-radius: 5px; margin-bottom: 10px;'>Ch{i+1}</h3>", unsafe_allow_html=True)
-                                        
-                                        # 基本情報を表形式で表示
-                                        total_weight_kg = st.session_state.get(f"total_weight_{i}", 110.0)
-                                        remaining_weight_kg = st.session_state.get(f"remaining_weight_{i}", 0.0)
-                                        mode = st.session_state.get(f"mode_radio_{i}", "FCD")
-                                        tapping_temp = st.session_state.get(f"tapping_temp_{i}", 1450)
-                                        
-                                        basic_info = pd.DataFrame({
-                                            "設定値": [f"{total_weight_kg}kg", f"{remaining_weight_kg}kg", mode, f"{tapping_temp}℃"]
-                                        }, index=["溶湯重量", "残湯量", "溶湯種別", "出湯温度"])
-                                        st.dataframe(basic_info, use_container_width=True, hide_index=False)
-                                        
-                                        st.markdown("---")
-                                        
-                                        # 神鋼SP銑、故銑、鋼屑のデータを取得（kg単位に変換）
-                                        base_data = base_materials_data[i] if i < len(base_materials_data) else {}
-                                        if len(base_data) > 1:
-                                            st.markdown("**材料**")
-                                            base_data_kg = {k.replace("(g)", ""): round(v/1000) for k, v in base_data.items() if k != "配合名"}
-                                            base_df = pd.DataFrame([base_data_kg]).T
-                                            base_df.columns = ["添加量（kg）"]
-                                            st.dataframe(base_df, use_container_width=True, hide_index=False)
-                                        
-                                        # その他の材料と添加剤を取得
-                                        all_data = instruction_data[i] if i < len(instruction_data) else {}
-                                        selected_additives = st.session_state.get(f"selected_additives_{i}", [])
-                                        base_material_names = ["神鋼SP銑", "故銑", "鋼屑"]
-                                        
-                                        # 材料データと添加剤データを分離
-                                        material_info = {}
-                                        additive_info = {}
-                                        
-                                        for key, value in all_data.items():
-                                            if key != "配合名":
-                                                if key.endswith("(g)") and not any(additive in key for additive in selected_additives) and not any(base_mat in key for base_mat in base_material_names):
-                                                    material_info[key.replace("(g)", "")] = value
-                                                elif key.endswith("(g)") and any(additive in key for additive in selected_additives):
-                                                    additive_info[key.replace("(g)", "")] = value
-                                        
-                                        if material_info:
-                                            st.markdown("**合金**")
-                                            materials_df = pd.DataFrame([material_info]).T
-                                            materials_df.columns = ["添加量（g）"]
-                                            st.dataframe(materials_df, use_container_width=True, hide_index=False)
-                                        
-                                        if additive_info:
-                                            st.markdown("---")
-                                            st.markdown("**添加剤**")
-                                            additives_df = pd.DataFrame([additive_info]).T
-                                            additives_df.columns = ["添加量（g）"]
-                                            st.dataframe(additives_df, use_container_width=True, hide_index=False)
-                    
-                    if not any(st.session_state.get(f"target_C_{i}", 0.0) > 0 for i in range(5)):
-                        st.info("表示する配合データがありません。")
-                else:
-                    st.warning("blending_ratio.csvが読み込まれていません。")
-            elif tab_idx == 6:  # 分析依頼票
-                st.markdown("📈 **分析依頼票の内容をここに表示します**")
-                st.info("分析依頼票の機能は開発中です。")
-            continue
+        additive_default_targets = ADDITIVE_DEFAULT_PERCENT
+        additive_inputs_percent = {}
+        additive_inputs_grams = {}
         
-        # タブインデックスを保存（他の場所でidxが使われるため）
-        current_tab_index = tab_idx
+        if selected_additives:
+            st.markdown("**選択された添加剤**")
+            cols = st.columns(min(5, len(selected_additives)))
+            # 選択順に左詰めで表示
+            for i, additive in enumerate(selected_additives):
+                col = cols[i % len(cols)]
+                default_val = additive_default_targets.get(additive, 0.0)
+                if f"additive_percent_{additive}_{current_tab_index}_{i}" not in st.session_state:
+                    st.session_state[f"additive_percent_{additive}_{current_tab_index}_{i}"] = default_val
+                percent = col.number_input(
+                    f"{additive}（%）",
+                    min_value=0.0,
+                    max_value=100.0,
+                    key=f"additive_percent_{additive}_{current_tab_index}_{i}"
+                )
+                additive_inputs_percent[additive] = percent
+                grams = percent / 100 * total_weight_g
+                additive_inputs_grams[additive] = grams
         
-        # Session Stateの初期化
-        if f"total_weight_{current_tab_index}" not in st.session_state:
-            st.session_state[f"total_weight_{current_tab_index}"] = 110.0
-        if f"remaining_weight_{current_tab_index}" not in st.session_state:
-            st.session_state[f"remaining_weight_{current_tab_index}"] = 0.0
-        if f"tapping_temp_{current_tab_index}" not in st.session_state:
-            st.session_state[f"tapping_temp_{current_tab_index}"] = 1450
-        # blending_ratio.csvから目標値を取得
-        blend_row = None
-        if blending_ratio_df is not None and f"Ch{current_tab_index+1}" in blending_ratio_df.index:
-            blend_row = blending_ratio_df.loc[f"Ch{current_tab_index+1}"]
-        # 以降、全てのstウィジェットのkeyに f"_{current_tab_index}" を付与して、タブごとに独立させる
-        # ---------------------------
-        # 基本設定
-        # ---------------------------
-        with st.container(border=True):
-            st.header("⚙️ 基本設定")
-            weight_col1, weight_col2, mode_col, temp_col = st.columns(4)
-            with weight_col1:
-                st.markdown("**溶解重量 (kg)**")
-                if f"total_weight_{current_tab_index}" not in st.session_state:
-                    st.session_state[f"total_weight_{current_tab_index}"] = 110.0
-                total_weight_kg = st.number_input("溶解重量 (kg)", min_value=1.0, key=f"total_weight_{current_tab_index}", label_visibility="collapsed")
-            with weight_col2:
-                st.markdown("**残湯量 (kg)**")
-                if f"remaining_weight_{current_tab_index}" not in st.session_state:
-                    st.session_state[f"remaining_weight_{current_tab_index}"] = 0.0
-                remaining_weight_kg = st.number_input("残湯量 (kg)", min_value=0.0, key=f"remaining_weight_{current_tab_index}", label_visibility="collapsed")
-            with mode_col:
-                st.markdown("**溶湯種別選択**")
-                mode = st.radio("溶湯種別選択", ["FCD", "FC"], horizontal=True, index=0, key=f"mode_radio_{current_tab_index}", label_visibility="collapsed")
-            with temp_col:
-                st.markdown("**出湯温度（℃）**")
-                if f"tapping_temp_{current_tab_index}" not in st.session_state:
-                    st.session_state[f"tapping_temp_{current_tab_index}"] = 1450
-                tapping_temp = st.number_input("出湯温度（℃）", min_value=1300, max_value=1600, step=1, key=f"tapping_temp_{current_tab_index}", label_visibility="collapsed")
-        total_weight_g = total_weight_kg * 1000
-
-        # ---------------------------
-        # 目標成分
-        # ---------------------------
-        with st.container(border=True):
-            st.header("🎯 目標成分")
-            
-            default_targets = {"C": 3.6, "Si": 2.4, "Mn": 0.4}
-            # blending_ratio.csvから成分値を取得
-            blend_targets = {}
-            blend_tolerance_types = {}  # 判定方法を保存
-            if blend_row is not None:
-                for e in elements:
-                    v = blend_row.get(e, 0.0)
-                    tolerance_type = "±"  # デフォルトは±
-                    try:
-                        if isinstance(v, str) and v.startswith('<'):
-                            # "<0.02"のような形式の場合
-                            v = float(v[1:])  # "<"を除いて数値に変換
-                            tolerance_type = "以下"  # 判定方法を"以下"に設定
-                        else:
-                            v = float(v)
-                    except Exception:
-                        v = 0.0
-                    blend_targets[e] = v
-                    blend_tolerance_types[e] = tolerance_type
-            # blending_ratio.csvの値をそのまま使用（デフォルト値は使わない）
-            
-            # blending_ratio.csvで0以外が入力されている成分を自動で追加
-            blend_nonzero_elements = [e for e in elements if blend_targets.get(e, 0.0) not in (0, None) and not pd.isna(blend_targets.get(e, 0.0))]
-            # デフォルトは0以外の成分すべて（なければC,Si,Mn）
-            default_elements = blend_nonzero_elements[:]
-            if not default_elements:
-                default_elements = [e for e in ["C", "Si", "Mn"] if blend_targets.get(e, 0.0) != 0]
-                if not default_elements:
-                    default_elements = ["C", "Si", "Mn"]
-            
-            state_key = f"selected_elements_{current_tab_index}"
-            # セッションステートに未設定、または空リストなら初期化
-            if state_key not in st.session_state or st.session_state[state_key] == []:
-                st.session_state[state_key] = default_elements
-
-            st.markdown("**元素選択**")
-            selected_elements = st.multiselect(
-                "成分調整する元素を選択してください（複数可）",
-                options=elements,
-                key=state_key,
-                label_visibility="collapsed"
+        # 選択されていないものは0
+        for additive in additive_list:
+            if additive not in selected_additives:
+                additive_inputs_percent[additive] = 0.0
+                additive_inputs_grams[additive] = 0.0
+
+    # ---------------------------
+    # 添加材の元素合計
+    # ---------------------------
+    # NaNを0にした添加材成分行列（参照データの版ごとに1回だけ作成）× 添加量（g）
+    additive_matrix = load_composition("additives.csv", elements + ['Fe'], index_col=0)
+    additive_names = list(dict.fromkeys(a for a in selected_additives if a in additive_matrix.index))
+    additive_grams = np.array([additive_inputs_grams[a] for a in additive_names], dtype=float)
+    additive_block = additive_matrix.take(additive_names)
+    additive_contributions = dict(zip(elements + ['Fe'], additive_contributions_g(additive_block, additive_grams)))
+
+    # 添加材によって供給された元素を % に変換（残り必要量計算のため）
+    additive_composition_pct = {
+        e: float(additive_contributions[e]) / total_weight_g * 100 for e in elements + ['Fe']
+    }
+
+    # 検量線上限値
+    calibration_limits = group_limits
+    
+    # ---------------------------
+    # 残り必要な成分量（目標値 － 添加材由来）
+    # 検量線上限値を超える分は至急分析後に添加する
+    # ---------------------------
+    all_elements = elements + ['Fe']
+    urgent_values, post_values = split_urgent_targets(
+        [target_composition[e] for e in all_elements],
+        [additive_composition_pct[e] for e in all_elements],
+        [calibration_limits.get(e, np.inf) for e in all_elements],
+    )
+    urgent_analysis_target = dict(zip(all_elements, urgent_values.tolist()))
+    post_analysis_addition = dict(zip(all_elements, post_values.tolist()))
+
+    # ---------------------------
+    # 材料配合
+    # ---------------------------
+    with st.container(border=True):
+        st.header("🧮 材料配合")
+        
+        # multiselectで材料選択
+        init_materials = sorted((m for m in INIT_MATERIALS if m in material_library), key=material_library.index.get)
+        if f"selected_materials_widget_{current_tab_index}" not in st.session_state:
+            st.session_state[f"selected_materials_widget_{current_tab_index}"] = init_materials
+        # 材料の自動選択（目標成分を許容範囲内に入れられる最も少ない材料の組を材料ライブラリ全体から選ぶ）
+        auto_col, auto_message_col = st.columns([1, 4])
+        with auto_col:
+            auto_select = st.button("🪄 材料を自動選択", key=f"auto_select_{current_tab_index}")
+        if auto_select:
+            auto_elements = [e for e in elements + ['Fe'] if e in materials_df.columns]
+            library_composition = material_composition(auto_elements)
+            selection = select_materials(
+                library_composition.matrix,
+                [urgent_analysis_target[e] for e in auto_elements],
+                total_weight_g,
+                [tolerance_values.get(e, 0.01) for e in auto_elements],
+                [tolerance_types.get(e, "±") == "以下" for e in auto_elements],
+                [e in selected_elements and e != "Fe" for e in auto_elements],
+                mass_row=auto_elements.index("Fe") if "Fe" in auto_elements else None,
             )
-            
-            target_composition = {}
-            tolerance_values = {}
-            tolerance_types = {}
-            user_c_input = None
-            
-            # 選択された元素の設定を表示
-            if selected_elements:
-                st.markdown("**目標値**")
-                # 元素を5列表示
-                element_cols = st.columns(min(5, len(selected_elements)))
-                for i, e in enumerate(selected_elements):
-                    col = element_cols[i % len(element_cols)]
-                    with col:
-                        # Cの場合は自動加算後の値をタイトルに表示
-                        if e == "C":
-                            default_val = blend_targets.get(e, default_targets.get(e, 0.0))
-                            # 一時的に計算してタイトル用の値を取得
-                            if mode == "FCD":
-                                calc_val_for_title = default_val + 0.07
-                            else:
-                                calc_val_for_title = default_val + 0.05
-                            expander_title = f"⚙️ {e}（自動加算後: {calc_val_for_title:.2f}%）"
-                        else:
-                            expander_title = f"⚙️ {e}"
-                        
-                        with st.expander(expander_title, expanded=True):
-                            # blending_ratio.csv優先、なければデフォルト
-                            default_val = blend_targets.get(e, default_targets.get(e, 0.0))
-                            
-                            if e == "C":
-                                target_label_col, target_input_col = st.columns([1, 1])
-                                with target_label_col:
-                                    st.markdown("**目標値（%）**")
-                                with target_input_col:
-                                    if f"target_{e}_{current_tab_index}" not in st.session_state:
-                                        st.session_state[f"target_{e}_{current_tab_index}"] = default_val
-                                    user_val = st.number_input(f"目標値（%）", min_value=0.0, key=f"target_{e}_{current_tab_index}", label_visibility="collapsed")
-                                user_c_input = user_val
-                                if mode == "FCD":
-                                    calc_val = user_val + 0.07
-                                else:
-                                    calc_val = user_val + 0.05
-                                target_composition[e] = calc_val
-                            else:
-                                target_label_col, target_input_col = st.columns([1, 1])
-                                with target_label_col:
-                                    st.markdown("**目標値（%）**")
-                                with target_input_col:
-                                    if f"target_{e}_{current_tab_index}" not in st.session_state:
-                                        st.session_state[f"target_{e}_{current_tab_index}"] = default_val
-                                    target_composition[e] = st.number_input(f"目標値（%）", min_value=0.0, key=f"target_{e}_{current_tab_index}", label_visibility="collapsed")
-                            
-                            default_tol = 0.05 if e in ["C", "Si", "Mn"] else 0.01
-                            tol_label_col, tol_input_col = st.columns([1, 1])
-                            with tol_label_col:
-                                st.markdown("**許容値**")
-                            with tol_input_col:
-                                if f"tol_{e}_{current_tab_index}" not in st.session_state:
-                                    st.session_state[f"tol_{e}_{current_tab_index}"] = default_tol
-                                tolerance_values[e] = st.number_input(f"許容値", min_value=0.0, step=0.01, key=f"tol_{e}_{current_tab_index}", label_visibility="collapsed")
-                            
-                            type_label_col, type_input_col = st.columns([1, 1])
-                            with type_label_col:
-                                st.markdown("**判定方法**")
-                            with type_input_col:
-                                default_tol_type = blend_tolerance_types.get(e, "±")
-                                if f"tol_type_{e}_{current_tab_index}" not in st.session_state:
-                                    st.session_state[f"tol_type_{e}_{current_tab_index}"] = default_tol_type
-                                tolerance_types[e] = st.selectbox(f"判定方法", ["±", "以下"], key=f"tol_type_{e}_{current_tab_index}", label_visibility="collapsed")
-            
-            # 選択されていないものは0
-            for e in elements:
-                if e not in selected_elements:
-                    target_composition[e] = 0.0
-                    tolerance_values[e] = 0.01
-                    tolerance_types[e] = blend_tolerance_types.get(e, "±")
-            
-            # Feの目標値は100%から他元素の合計を引いた値
-            fe_target = 100.0 - sum(target_composition.values())
-            target_composition['Fe'] = fe_target
-
-        # ---------------------------
-        # 添加剤設定
-        # ---------------------------
-        with st.container(border=True):
-            st.header("🧪 添加剤設定")
-            additive_list = list(additives_df.index)
-            # FCD/FCモードで初期選択を切り替え
-            if mode == "FCD":
-                default_additives = [a for a in additive_list if a in ["OGRC-4.5H", "SカバーM"]]
-            else:
-                default_additives = []
-            st.markdown("**添加剤選択**")
-            if f"selected_additives_{current_tab_index}" not in st.session_state:
-                st.session_state[f"selected_additives_{current_tab_index}"] = default_additives
-            selected_additives = st.multiselect(
-                "添加材として使用するものを選択してください（複数可）",
-                options=additive_list,
-                key=f"selected_additives_{current_tab_index}",
+            if selection.columns.size:
+                st.session_state[f"selected_materials_widget_{current_tab_index}"] = [library_composition.names[j] for j in selection.columns]
+            channel_state(current_tab_index)["auto_select"] = (list(st.session_state[f"selected_materials_widget_{current_tab_index}"]), selection)
+        # 自動選択した組のままのあいだだけ結果を表示する（判定はこのチャンネルの計算方式で計算した後に表示）
+        auto_selection = None
+        auto_result = channel_state(current_tab_index).get("auto_select")
+        if auto_result is not None and auto_result[0] == st.session_state[f"selected_materials_widget_{current_tab_index}"]:
+            auto_selection = auto_result[1]
+            if not auto_selection.columns.size:
+                auto_message_col.warning(auto_select_message(auto_selection)[1])
+        
+        # 選択肢は検索条件に合う材料（ロット単位で数千件あるときは絞り込んでから選ぶ）と選択済みの材料
+        search_col, search_element_col, search_min_col = st.columns([3, 1, 1])
+        with search_col:
+            material_query = st.text_input("材料を検索（名前・ロット・仕入先）", key=f"material_search_{current_tab_index}")
+        with search_element_col:
+            search_element = st.selectbox("含有元素", ["-"] + list(material_library.elements), key=f"material_search_element_{current_tab_index}")
+        with search_min_col:
+            search_min_pct = st.number_input("含有率の下限（%）", min_value=0.0, step=0.1, key=f"material_search_min_{current_tab_index}", disabled=(search_element == "-"))
+        matches, n_matches = material_library.search(material_query, None if search_element == "-" else search_element, search_min_pct, limit=MATERIAL_OPTION_LIMIT)
+        current_materials = st.session_state[f"selected_materials_widget_{current_tab_index}"]
+        all_materials = sorted(set(matches).union(current_materials), key=lambda m: material_library.index.get(m, -1))
+        if n_matches > len(matches):
+            st.caption(f"該当する材料 {n_matches:,} 件のうち先頭の {len(matches)} 件を表示しています。検索条件で絞り込んでください。")
+        selected_materials = st.multiselect(
+            "使用する材料を選択してください",
+            options=all_materials,
+            key=f"selected_materials_widget_{current_tab_index}",
+            label_visibility="collapsed"
+        )
+
+        # 材料ごとの必要添加量による成分増加量の表を表示
+        if selected_materials:
+            mat_elements_disp = [e for e in elements + ['Fe'] if e in materials_df.columns]
+            # 必要添加量（g）を取得（計算前は0になるので、計算後のadd_weightsを使う）
+            # ここでは、add_weightsが計算される前なので、下の計算後に表示するのが正しい
+            pass  # 表示は下のadd_weights計算後に移動
+
+        if len(selected_materials) == 0:
+            st.warning("1つ以上の材料を選択してください。")
+        else:
+            # 材料名リスト
+            material_names = selected_materials
+            # 鋼屑・神鋼SP銑・故銑の手動入力欄を作成
+            manual_input_dict = {}
+            manual_materials = [m for m in ["鋼屑", "神鋼SP銑", "故銑"] if m in material_names]
+            if manual_materials:
+                st.markdown("**材料配合（kg）** <span style='color:red'>・0（入力なし）で自動配合</span>", unsafe_allow_html=True)
+                manual_cols = st.columns(min(3, len(manual_materials)))
+                for mat_idx, mat in enumerate(manual_materials):
+                    col_idx = mat_idx % len(manual_cols)
+                    if f"manual_{mat}_{current_tab_index}" not in st.session_state:
+                        st.session_state[f"manual_{mat}_{current_tab_index}"] = 0.0
+                    manual_input_kg = manual_cols[col_idx].number_input(f"{mat}（kg）", min_value=0.0, step=0.1, key=f"manual_{mat}_{current_tab_index}")
+                    manual_input_dict[mat] = manual_input_kg * 1000
+            # 元素リスト（Fe含む）
+            mat_elements = [e for e in elements + ['Fe'] if e in materials_df.columns]
+            # 材料ごとの手動指定値（0は自動配合）
+            manual_values = [manual_input_dict.get(m, 0.0) for m in material_names]
+            # 自動計算対象のインデックス
+            auto_idx = [i for i, m in enumerate(material_names) if m not in manual_input_dict or manual_input_dict[m] == 0.0]
+            # ---------------------------
+            # 計算方式・制約条件
+            # ---------------------------
+            st.markdown("**計算方式**")
+            solver_method = st.radio(
+                "計算方式",
+                list(SOLVER_METHODS),
+                format_func=SOLVER_METHODS.get,
+                horizontal=True,
+                key=f"solver_method_{current_tab_index}",
                 label_visibility="collapsed"
             )
-            
-            additive_default_targets = {"OGRC-4.5H": 1.3, "SカバーM": 0.8}
-            additive_inputs_percent = {}
-            additive_inputs_grams = {}
-            
-            if selected_additives:
-                st.markdown("**選択された添加剤**")
-                cols = st.columns(min(5, len(selected_additives)))
-                # 選択順に左詰めで表示
-                for i, additive in enumerate(selected_additives):
-                    col = cols[i % len(cols)]
-                    default_val = additive_default_targets.get(additive, 0.0)
-                    if f"additive_percent_{additive}_{current_tab_index}_{i}" not in st.session_state:
-                        st.session_state[f"additive_percent_{additive}_{current_tab_index}_{i}"] = default_val
-                    percent = col.number_input(
-                        f"{additive}（%）",
-                        min_value=0.0,
-                        max_value=100.0,
-                        key=f"additive_percent_{additive}_{current_tab_index}_{i}"
+            # 単価（円/kg）列があればコスト最小化に使用
+            material_prices = materials_df.reindex(material_names)["単価"] if "単価" in materials_df.columns else pd.Series(np.nan, index=material_names)
+            if solver_method == "cost":
+                no_price = [m for i, m in enumerate(material_names) if i in auto_idx and pd.isna(material_prices.iloc[i])]
+                if "単価" not in materials_df.columns:
+                    st.warning("materials.csv に「単価」列（円/kg）がないため、最小二乗法で計算します。")
+                    solver_method = "lstsq"
+                elif no_price:
+                    st.warning(f"materials.csv の「単価」列（円/kg）が空欄の材料があるため、最小二乗法で計算します: {', '.join(no_price)}")
+                    solver_method = "lstsq"
+            use_capacity = False
+            lower_kg = [0.0] * len(material_names)
+            upper_kg = [np.inf] * len(material_names)
+            if solver_method in ("bounded", "lp"):
+                use_capacity = st.checkbox("材料の装入量合計を溶解重量（添加剤を除く）以下にする", key=f"use_capacity_{current_tab_index}")
+            if solver_method != "lstsq":
+                with st.expander("材料ごとの装入量の下限・上限（kg）"):
+                    # 表の編集内容は他のチャンネルを編集している間に消えるため、チャンネルの状態に残して次に表示するときの初期値にする
+                    bounds_key = charge_bounds_key(current_tab_index, material_names)
+                    bounds_state = channel_state(current_tab_index).setdefault("bounds", {})
+                    if bounds_key not in st.session_state:
+                        bounds_state["initial"] = bounds_state.get(bounds_key, pd.DataFrame({"下限(kg)": 0.0, "上限(kg)": np.nan}, index=material_names))
+                    bounds_df = st.data_editor(
+                        bounds_state["initial"],
+                        column_config={
+                            "下限(kg)": st.column_config.NumberColumn(min_value=0.0),
+                            "上限(kg)": st.column_config.NumberColumn(min_value=0.0),
+                        },
+                        use_container_width=True,
+                        key=bounds_key
                     )
-                    additive_inputs_percent[additive] = percent
-                    grams = percent / 100 * total_weight_g
-                    additive_inputs_grams[additive] = grams
-            
-            # 選択されていないものは0
-            for additive in additive_list:
-                if additive not in selected_additives:
-                    additive_inputs_percent[additive] = 0.0
-                    additive_inputs_grams[additive] = 0.0
-
-        # ---------------------------
-        # 添加材の元素合計
-        # ---------------------------
-        additive_contributions = {e: 0.0 for e in elements + ['Fe']}
-        for additive, weight_g in additive_inputs_grams.items():
-            for e in elements + ['Fe']:
-                percent = additives_df.at[additive, e] if e in additives_df.columns else 0.0
-                # NaNやSeries対応
-                try:
-                    percent = float(percent)
-                except Exception:
-                    percent = 0.0
-                if np.isnan(percent):
-                    percent = 0.0
-                additive_contributions[e] += weight_g * percent / 100  # gベース
-
-        # 添加材によって供給された元素を % に変換（残り必要量計算のため）
-        additive_composition_pct = {
-            e: float(additive_contributions[e]) / total_weight_g * 100 for e in elements + ['Fe']
-        }
+                    bounds_state[bounds_key] = bounds_df
+                lower_kg = bounds_df["下限(kg)"].fillna(0.0).tolist()
+                upper_kg = bounds_df["上限(kg)"].fillna(np.inf).tolist()
 
-        # ---------------------------
-        # 残り必要な成分量（目標値 － 添加材由来）
-        # ---------------------------
-        required_composition = {
-            e: max(0.0, target_composition[e] - additive_composition_pct[e]) for e in elements + ['Fe']
-        }
-        
-        # 検量線上限値を取得
-        calibration_limits = {}
-        if selected_group and not calibration_df.empty:
-            group_data = calibration_df[calibration_df['Group'] == selected_group]
-            if not group_data.empty:
-                for e in elements + ['Fe']:
-                    if e in calibration_df.columns:
-                        val = group_data[e].iloc[0]
-                        if pd.notna(val) and val != 0:
-                            calibration_limits[e] = float(val)
-        
-        # 成分目標値が検量線上限値を超える場合の処理
-        urgent_analysis_target = {}
-        post_analysis_addition = {}
-        for e in elements + ['Fe']:
-            # 入力された成分目標値で添加材の計算を行う
-            original_target = target_composition[e] - additive_composition_pct[e]
-            original_target = max(0.0, original_target)
-            
-            if e in calibration_limits and original_target > calibration_limits[e]:
-                urgent_analysis_target[e] = calibration_limits[e]
-                post_analysis_addition[e] = original_target - calibration_limits[e]
+            # 計算に使う入力値。前回と同じ（参照データも同じ）なら計算をやり直さない
+            channel_inputs = {
+                "material_names": material_names,
+                "mat_elements": mat_elements,
+                "manual_values": manual_values,
+                "total_weight_g": total_weight_g,
+                "mode": mode,
+                "selected_elements": selected_elements,
+                "target_composition": target_composition,
+                "user_c_input": user_c_input,
+                "tolerance_values": tolerance_values,
+                "tolerance_types": tolerance_types,
+                "urgent_analysis_target": urgent_analysis_target,
+                "post_analysis_addition": post_analysis_addition,
+                "calibration_limit_pct": [calibration_limits.get(e, np.inf) for e in mat_elements],
+                "additive_composition_pct": additive_composition_pct,
+                "additive_names": additive_names,
+                "additive_grams": additive_grams.tolist(),
+                "solver_method": solver_method,
+                "use_capacity": use_capacity,
+                "lower_kg": lower_kg,
+                "upper_kg": upper_kg,
+            }
+            fingerprint = channel_fingerprint(channel_inputs)
+            state = channel_state(current_tab_index)
+            cached = state.get("cache")
+            if cached is not None and cached[0] == fingerprint:
+                outputs = cached[1]
             else:
-                urgent_analysis_target[e] = original_target
-                post_analysis_addition[e] = 0.0
-
-        # ---------------------------
-        # 材料配合
-        # ---------------------------
-        with st.container(border=True):
-            st.header("🧮 材料配合")
-            
-            # multiselectで材料選択
-            all_materials = list(materials_df.index)
-            init_materials = [m for m in all_materials if m in ["神鋼SP銑", "C粉", "Fe-Si", "Fe-Mn"]]
-            if f"selected_materials_widget_{current_tab_index}" not in st.session_state:
-                st.session_state[f"selected_materials_widget_{current_tab_index}"] = init_materials
-            selected_materials = st.multiselect(
-                "使用する材料を選択してください",
-                options=all_materials,
-                key=f"selected_materials_widget_{current_tab_index}",
-                label_visibility="collapsed"
+                outputs = calculate_channel(channel_inputs, warm_start=state.get("warm_start"))
+                state["cache"] = (fingerprint, outputs)
+                if solver_method in ("bounded", "lp"):
+                    state["warm_start"] = dict(zip(material_names, outputs["add_weights"].tolist()))
+            # 計算結果の要約をチャンネルの状態に保存（一覧・指示票で使用）
+            judgement = outputs["judgement"]
+            state["detail"] = (channel_digest(channel_config(current_tab_index), calibration_limits), {
+                "溶湯種別": mode,
+                "溶解重量(kg)": total_weight_kg,
+                "計算方式": solver_method,
+                "判定": "○" if judgement.all_ok[0] else "×",
+                "NG元素": " ".join(e for e, ng in zip(mat_elements, judgement.ng[0]) if ng),
+                "最大誤差(g)": float(outputs["max_err"]),
+                "weights": outputs["calc_results"],
+            })
+            if auto_selection is not None and auto_selection.columns.size:
+                kind, text = auto_select_message(auto_selection, judgement, mat_elements, solver_method)
+                getattr(auto_message_col, kind)(text)
+            # 選択されていないタブは計算結果だけ保存し、表とCSVは作らない
+            if not show_tables:
+                return
+            for kind, text in outputs["messages"]:
+                getattr(st, kind)(text)
+
+            # 材料・添加材ごとの必要添加量による成分増加量の表を表示
+            inc_table_filtered = outputs["inc_table_filtered"]
+            st.markdown("**成分増加量（%）（至急分析目標値）**")
+            st.dataframe(
+                inc_table_filtered.style.format(inc_table_formatters(inc_table_filtered.columns)).apply(highlight_selected_elements, axis=1, selected_elements=selected_elements),
+                use_container_width=True
             )
+            additives_df_disp = outputs["additives_df_disp"]
+            st.markdown("**添加材ごとの必要添加量（g）**")
+            if additives_df_disp is not None:
+                additives_df_disp_str = outputs["additives_df_disp_str"]
+                # 列幅を文字数に合わせてフィット
+                col_widths = {c: st.column_config.Column(width=f"{max(80, len(str(c))*16)}px") for c in additives_df_disp_str.columns}
+                st.dataframe(additives_df_disp_str, use_container_width=True, hide_index=False, column_config=col_widths)
+            else:
+                st.write("（選択・入力された添加材はありません）")
 
-            # 材料ごとの必要添加量による成分増加量の表を表示
-            if selected_materials:
-                mat_elements_disp = [e for e in elements + ['Fe'] if e in materials_df.columns]
-                # 必要添加量（g）を取得（計算前は0になるので、計算後のadd_weightsを使う）
-                # ここでは、add_weightsが計算される前なので、下の計算後に表示するのが正しい
-                pass  # 表示は下のadd_weights計算後に移動
+            inc_table = outputs["inc_table"]
+            result_with_analysis = outputs["result_with_analysis"]
+            result_with_analysis_str = outputs["result_with_analysis_str"]
+            st.markdown("**材料ごとの必要添加量（g）**")
+            # 列幅を文字数に合わせてフィット
+            col_widths = {c: st.column_config.Column(width=f"{max(80, len(str(c))*16)}px") for c in result_with_analysis_str.columns}
+            st.dataframe(result_with_analysis_str, use_container_width=True, hide_index=False, column_config=col_widths)
 
-            if len(selected_materials) == 0:
-                st.warning("1つ以上の材料を選択してください。")
-            else:
-                # 材料名リスト
-                material_names = selected_materials
-                # 鋼屑・神鋼SP銑・故銑の手動入力欄を作成
-                manual_input_dict = {}
-                manual_materials = [m for m in ["鋼屑", "神鋼SP銑", "故銑"] if m in material_names]
-                if manual_materials:
-                    st.markdown("**材料配合（kg）** <span style='color:red'>・0（入力なし）で自動配合</span>", unsafe_allow_html=True)
-                    manual_cols = st.columns(min(3, len(manual_materials)))
-                    for mat_idx, mat in enumerate(manual_materials):
-                        col_idx = mat_idx % len(manual_cols)
-                        if f"manual_{mat}_{current_tab_index}" not in st.session_state:
-                            st.session_state[f"manual_{mat}_{current_tab_index}"] = 0.0
-                        manual_input_kg = manual_cols[col_idx].number_input(f"{mat}（kg）", min_value=0.0, step=0.1, key=f"manual_{mat}_{current_tab_index}")
-                        manual_input_dict[mat] = manual_input_kg * 1000
-                # 元素リスト（Fe含む）
-                mat_elements = [e for e in elements + ['Fe'] if e in materials_df.columns]
-                # 材料ごとの手動指定値
-                manual_values = [manual_input_dict.get(m, 0.0) for m in material_names]
-                # 自動計算対象のインデックス
-                auto_idx = [i for i, m in enumerate(material_names) if m not in manual_input_dict or manual_input_dict[m] == 0.0]
-                # 手動指定対象のインデックス
-                manual_idx = [i for i, m in enumerate(material_names) if m in manual_input_dict and manual_input_dict[m] > 0.0]
-                # A: 材料成分行列（各材料ごとに各元素の%） shape=(元素数, 材料数)
-                A_full = materials_df.loc[material_names, mat_elements].T.values / 100  # %→fraction
-                # b: 必要成分量（g） shape=(元素数,) - 至急分析目標値を使用
-                b_full = np.array([urgent_analysis_target[e] / 100 * total_weight_g for e in mat_elements])
-                # 手動指定分をbから引く
-                b = b_full.copy()
-                if manual_idx:
-                    for j, m_idx in enumerate(manual_idx):
-                        b -= A_full[:, m_idx] * manual_values[m_idx]
-
-                # --- ここから下を常に表示する ---
-                show_tables = True
-                add_weights = None
-                if auto_idx:
-                    A_auto = A_full[:, auto_idx]
-                    # 安全な最小二乗法で解く
-                    try:
-                        # まず通常の最小二乗法を試行
-                        x_unconstrained, residuals, rank, s = np.linalg.lstsq(A_auto, b, rcond=1e-10)
-                        x_constrained = np.maximum(x_unconstrained, 0)  # 負の値を0にクリップ
-                        add_weights = np.array(manual_values)
-                        for i, idx in enumerate(auto_idx):
-                            add_weights[idx] = x_constrained[i]
-                        if rank < A_auto.shape[1]:
-                            st.warning("行列のランク不足のため、近似解を使用しています。")
-                    except Exception as e:
-                        st.error(f"計算エラー: {str(e)}")
-                        # フォールバック：単純な比例配分
-                        total_needed = np.sum(np.abs(b))
-                        if total_needed > 1e-10:
-                            base_weight = 1000.0  # 1kgを基準
-                            add_weights = np.array(manual_values)
-                            for i, idx in enumerate(auto_idx):
-                                add_weights[idx] = base_weight / len(auto_idx)
-                        else:
-                            add_weights = np.array(manual_values)
-                else:
-                    # 全て手動指定の場合
-                    add_weights = np.array(manual_values)
-
-                if add_weights is not None:
-                    # 材料・添加材ごとの必要添加量による成分増加量の表を表示
-                    mat_elements_disp = [e for e in elements + ['Fe'] if e in materials_df.columns]
-                    add_weights_disp = add_weights
-                    # 歩留まり列があれば取得、なければ1.0で埋める
-                    if '歩留まり' in materials_df.columns:
-                        yield_rates = materials_df.loc[material_names, '歩留まり'].fillna(1.0).astype(float)
-                    else:
-                        yield_rates = pd.Series(1.0, index=material_names)
-                    mat_table = materials_df.loc[material_names, mat_elements_disp]
-                    # 添加材も同じ形式でまとめる
-                    additive_rows = []
-                    for a in selected_additives:
-                        grams = additive_inputs_grams[a]
-                        row = {"必要添加量(g)": f"{int(round(grams)):,}"}
-                        for e in mat_elements_disp:
-                            val = additives_df.at[a, e] if e in additives_df.columns else 0.0
-                            try:
-                                val = float(val)
-                            except Exception:
-                                val = 0.0
-                            if np.isnan(val):
-                                val = 0.0
-                            inc = val * grams / total_weight_g
-                            row[e] = f"{inc:.3g}" if inc != 0 else "0"
-                        additive_rows.append((a, row))
-                    # 材料分
-                    inc_table = pd.DataFrame(index=mat_table.index, columns=["必要添加量(g)"] + list(mat_table.columns))
-                    for m in mat_table.index:
-                        total_weight_for_material = add_weights_disp[material_names.index(m)]
-                        inc_table.at[m, "必要添加量(g)"] = f"{int(round(total_weight_for_material)):,}"
-                        y = yield_rates[m]
-                        for e in mat_table.columns:
-                            # 歩留まりを掛けて計算
-                            inc = mat_table.at[m, e] * y * total_weight_for_material / total_weight_g
-                            if inc == 0:
-                                inc_table.at[m, e] = "0"
-                            else:
-                                inc_table.at[m, e] = f"{inc:.3g}"
-                    # 添加材分を追加
-                    for a, row in additive_rows:
-                        inc_table.loc[a] = row
-                    # 合計行を追加
-                    sum_row = {"必要添加量(g)": "-"}
-                    total_weight_sum = 0
-                    for row_idx in inc_table.index:
-                        weight_str = inc_table.at[row_idx, "必要添加量(g)"]
-                        try:
-                            weight_val = float(weight_str.replace(",", ""))
-                            total_weight_sum += weight_val
-                        except Exception:
-                            pass
-                    sum_row["必要添加量(g)"] = f"{int(total_weight_sum):,}"
-                    for e in mat_elements_disp:
-                        vals = []
-                        for row_idx in inc_table.index:
-                            v = inc_table.at[row_idx, e]
-                            try:
-                                v = float(v.replace(",", ""))
-                            except Exception:
-                                v = 0.0
-                            vals.append(v)
-                        s = sum(vals)
-                        sum_row[e] = f"{s:.3g}" if s != 0 else "0"
-                    inc_table.loc["合計"] = sum_row
-                    
-                    # 選択した成分調整する元素に色を付ける
-                    def highlight_selected_elements_urgent(row):
-                        sel_color = "background-color: #ffe599"  # 薄い黄色
-                        result = []
-                        for col in row.index:
-                            if col in selected_elements:
-                                result.append(sel_color)
-                            else:
-                                result.append("")
-                        return result
-                    
-                    # 成分の値がすべて0の列を非表示
-                    cols_to_show = ["必要添加量(g)"]
-                    for e in mat_elements_disp:
-                        if float(sum_row[e]) != 0:
-                            cols_to_show.append(e)
-                    inc_table_filtered = inc_table[cols_to_show]
-                
-                    st.markdown("**成分増加量（%）（至急分析目標値）**")
-                    st.dataframe(
-                        inc_table_filtered.style.apply(highlight_selected_elements_urgent, axis=1),
-                        use_container_width=True
-                    )
-                    # 添加する添加材だけ表示
-                    # 0gでない、かつ選択されている添加材のみ抽出
-                    used_additives = [a for a in selected_additives if additive_inputs_grams[a] > 0]
-                    # ユニークな列名（重複対策）
-                    unique_additive_list = []
-                    seen = {}
-                    for name in used_additives:
-                        if name not in seen:
-                            unique_additive_list.append(name)
-                            seen[name] = 1
-                        else:
-                            seen[name] += 1
-                            unique_additive_list.append(f"{name}_{seen[name]}")
-                    additives_grams_list = [additive_inputs_grams[a] for a in used_additives]
-                    additives_df_disp = None  # 初期化
-                    if unique_additive_list:
-                        additives_df_disp = pd.DataFrame([additives_grams_list], columns=unique_additive_list)
-                        additives_df_disp.index = ["必要添加量(g)"]
-                        additives_df_disp_str = additives_df_disp.map(lambda x: f"{int(x):,}" if x != 0 else "0")
-                        st.markdown("**添加材ごとの必要添加量（g）**")
-                        # 列幅を文字数に合わせてフィット
-                        col_widths = {c: st.column_config.Column(width=f"{max(80, len(str(c))*16)}px") for c in additives_df_disp_str.columns}
-                        st.dataframe(additives_df_disp_str, use_container_width=True, hide_index=False, column_config=col_widths)
-                    else:
-                        st.markdown("**添加材ごとの必要添加量（g）**")
-                        st.write("（選択・入力された添加材はありません）")
-
-                    # 1e-3g以下は0として扱う
-                    add_weights_masked = np.where(add_weights > 1e-3, add_weights, 0.0)
-                # 材料名を列、必要添加量を値とした1行の表にする（小数点以下四捨五入）
-                rounded_weights = np.round(add_weights)
-                result_df = pd.DataFrame([rounded_weights], columns=material_names)
-                result_df = result_df.loc[:, result_df.iloc[0] > 1e-3]  # 1e-3g以下は非表示
-                result_df.index = ["必要添加量(g)"]
-                # 必要添加量の表をカンマ区切りで表示
-                # 至急分析後添加量を計算（検量線超過成分を個別に計算）
-                post_analysis_weights = np.zeros(len(material_names))
-                
-                # 検量線上限値が設定されている成分のみ個別処理
-                for e in mat_elements:
-                    if e in calibration_limits and required_composition[e] > calibration_limits[e] and auto_idx:
-                        # この成分を最も多く含む材料のみを使用
-                        element_idx = mat_elements.index(e)
-                        best_material_idx = None
-                        best_content = 0
-                        
-                        for i, auto_index in enumerate(auto_idx):
-                            content = A_full[element_idx, auto_index]
-                            if content > best_content:
-                                best_content = content
-                                best_material_idx = i
-                        
-                        if best_material_idx is not None and best_content > 0:
-                            needed_amount = post_analysis_addition[e] / 100 * total_weight_g / best_content
-                            post_analysis_weights[auto_idx[best_material_idx]] += needed_amount
-                
-                # 材料・添加材ごとの必要添加量による成分増加量の表を表示
-                mat_elements_disp = [e for e in elements + ['Fe'] if e in materials_df.columns]
-                # 至急分析前添加量と至急分析後添加量を足した値を使用
-                total_weights = add_weights + post_analysis_weights
-                add_weights_disp = total_weights
-                
-                # 歩留まり列があれば取得、なければ1.0で埋める
-                if '歩留まり' in materials_df.columns:
-                    yield_rates = materials_df.loc[material_names, '歩留まり'].fillna(1.0).astype(float)
-                else:
-                    yield_rates = pd.Series(1.0, index=material_names)
-                mat_table = materials_df.loc[material_names, mat_elements_disp]
-                # 添加材も同じ形式でまとめる
-                additive_rows = []
-                for a in selected_additives:
-                    grams = additive_inputs_grams[a]
-                    row = {"必要添加量(g)": f"{int(round(grams)):,}"}
-                    for e in mat_elements_disp:
-                        val = additives_df.at[a, e] if e in additives_df.columns else 0.0
-                        try:
-                            val = float(val)
-                        except Exception:
-                            val = 0.0
-                        if np.isnan(val):
-                            val = 0.0
-                        inc = val * grams / total_weight_g
-                        row[e] = f"{inc:.3g}" if inc != 0 else "0"
-                    additive_rows.append((a, row))
-                # 材料分
-                inc_table = pd.DataFrame(index=mat_table.index, columns=["必要添加量(g)"] + list(mat_table.columns))
-                for m in mat_table.index:
-                    total_weight_for_material = add_weights_disp[material_names.index(m)]
-                    inc_table.at[m, "必要添加量(g)"] = f"{int(round(total_weight_for_material)):,}"
-                    y = yield_rates[m]
-                    for e in mat_table.columns:
-                        # 歩留まりを掛けて計算
-                        inc = mat_table.at[m, e] * y * total_weight_for_material / total_weight_g
-                        if inc == 0:
-                            inc_table.at[m, e] = "0"
-                        else:
-                            inc_table.at[m, e] = f"{inc:.3g}"
-                # 添加材分を追加
-                for a, row in additive_rows:
-                    inc_table.loc[a] = row
-                # 合計行を追加
-                sum_row = {"必要添加量(g)": "-"}
-                total_weight_sum = 0
-                for row_idx in inc_table.index:
-                    weight_str = inc_table.at[row_idx, "必要添加量(g)"]
-                    try:
-                        weight_val = float(weight_str.replace(",", ""))
-                        total_weight_sum += weight_val
-                    except Exception:
-                        pass
-                sum_row["必要添加量(g)"] = f"{int(total_weight_sum):,}"
-                for e in mat_elements_disp:
-                    vals = []
-                    for row_idx in inc_table.index:
-                        v = inc_table.at[row_idx, e]
-                        try:
-                            v = float(v.replace(",", ""))
-                        except Exception:
-                            v = 0.0
-                        vals.append(v)
-                    s = sum(vals)
-                    sum_row[e] = f"{s:.3g}" if s != 0 else "0"
-                inc_table.loc["合計"] = sum_row
-                
+            table1_filtered = outputs["table1_filtered"]
+            table2_filtered = outputs["table2_filtered"]
+            # 第1の表表示
+            st.markdown("**成分目標値・出湯前目標値・出湯後添加成分**")
+            st.dataframe(
+                table1_filtered.astype(str).style.apply(
+                    highlight_selected_elements, axis=1, selected_elements=selected_elements
+                ),
+                use_container_width=True,
+                key=f"table1_{current_tab_index}_{'_'.join(selected_elements)}"
+            )
+            
+            # 第2の表表示
+            st.markdown("**至急分析目標値・配合計算成分・判定**")
+            st.dataframe(
+                table2_filtered.astype(str).style.apply(
+                    highlight_selected_and_ng, axis=1, selected_elements=selected_elements
+                ),
+                use_container_width=True,
+                key=f"table2_{current_tab_index}_{'_'.join(selected_elements)}"
+            )
+            # 最大誤差も表示（至急分析目標値と比較）
+            st.markdown(f"**最大誤差（g）: {outputs['max_err']:.3g}**")
 
-                
-                # 結果表に2行を追加
-                result_with_analysis = pd.DataFrame([
-                    rounded_weights,
-                    np.round(post_analysis_weights)
-                ], columns=material_names, index=["至急分析前添加量(g)", "至急分析後添加量(g)"])
-                result_with_analysis = result_with_analysis.loc[:, (result_with_analysis.iloc[0] > 1e-3) | (result_with_analysis.iloc[1] > 1e-3)]
-                
-                st.markdown("**材料ごとの必要添加量（g）**")
-                result_with_analysis_str = result_with_analysis.copy()
-                
-                result_with_analysis_str = result_with_analysis_str.astype(object)
-                for row in result_with_analysis_str.index:
-                    for col in result_with_analysis_str.columns:
-                        val = result_with_analysis_str.at[row, col]
-                        if val != "-" and isinstance(val, (int, float, np.integer, np.floating)):
-                            if row == "至急分析後添加量(g)" and val == 0:
-                                result_with_analysis_str.at[row, col] = "-"
-                            else:
-                                result_with_analysis_str.at[row, col] = f"{int(val):,}" if val != 0 else "0"
-                
-                # 列幅を文字数に合わせてフィット
-                col_widths = {c: st.column_config.Column(width=f"{max(80, len(str(c))*16)}px") for c in result_with_analysis_str.columns}
-                st.dataframe(result_with_analysis_str, use_container_width=True, hide_index=False, column_config=col_widths)
-
-                # --- ここから複合表の作成 ---
-                # 目標値
-                # Cのみインプット値、それ以外はtarget_composition
-                target_row = {}
-                for e in mat_elements:
-                    if e == "C" and user_c_input is not None:
-                        v = user_c_input
-                    else:
-                        v = target_composition[e]
-                    target_row[e] = v
-                
-                # 出湯前目標値（成分目標値から添加剤で増加する成分を引いた値）
-                pre_tapping_target_row = {}
-                for e in mat_elements:
-                    if e == "C":
-                        if mode == "FCD":
-                            base_value = target_composition[e] + 0.08
-                        else:
-                            base_value = target_composition[e] + 0.07
-                        v = base_value - additive_composition_pct[e]
-                    else:
-                        v = target_composition[e] - additive_composition_pct[e]
-                    pre_tapping_target_row[e] = max(0.0, v)
-                # 出湯後添加成分（旧:添加材由来）
-                after_tapping_additive_row = {e: additive_composition_pct[e] for e in mat_elements}
-                # 至急分析目標値（旧:残り目標成分）
-                urgent_analysis_target_row = {e: urgent_analysis_target[e] for e in mat_elements}
-                # 配合計算成分（旧:実際の成分達成度）
-                achieved = np.dot(A_full, add_weights_masked)
-                achieved_pct = achieved / total_weight_g * 100
-                blend_calc_row = {e: v for e, v in zip(mat_elements, achieved_pct)}
-                # 判定基準
-                judge = {}
-                for e in mat_elements:
-                    if e == "Fe" or e not in selected_elements:
-                        judge[e] = "-"
-                        continue
-                    # 判定用はfloatで取得
-                    target = float(urgent_analysis_target.get(e, 0.0))
-                    if target == 0.0:
-                        judge[e] = "-"
+            # ---------------------------
+            # 感度分析
+            # ---------------------------
+            with st.expander("🔍 感度分析（入力を範囲で変えたときの必要添加量と判定）"):
+                # 変える入力の候補：(種類, 元素名・添加剤名, 現在値)
+                sweep_options = {"溶解重量(kg)": ("weight", None, total_weight_kg)}
+                for e in selected_elements:
+                    sweep_options[f"目標値 {e}(%)"] = ("target", e, user_c_input if e == "C" else target_composition[e])
+                for a, g in zip(additive_names, additive_grams):
+                    sweep_options[f"添加剤 {a}(%)"] = ("additive", a, g / total_weight_g * 100)
+                axes = []
+                for axis_idx in range(2):
+                    label_col, min_col, max_col, steps_col = st.columns([2, 1, 1, 1])
+                    labels = list(sweep_options) if axis_idx == 0 else ["なし"] + list(sweep_options)
+                    label = label_col.selectbox(f"入力{axis_idx + 1}", labels, key=f"sweep_input_{axis_idx}_{current_tab_index}")
+                    if label == "なし" or any(label == axis_label for _, axis_label, _ in axes):
                         continue
-                    achieved_val = float(achieved_pct[mat_elements.index(e)])
-                    tol = tolerance_values.get(e, 0.01)
-                    tol_type = tolerance_types.get(e, "±")
-                    
-                    if tol_type == "±":
-                        if abs(achieved_val - target) <= tol:
-                            judge[e] = "○"
-                        else:
-                            judge[e] = f"× (許容範囲：±{tol})"
-                    else:  # 以下
-                        if achieved_val <= target + tol:
-                            judge[e] = "○"
-                        else:
-                            judge[e] = f"× (許容値：{target + tol}以下)"
-                # 判定行
-                judge_row = {e: judge[e] for e in mat_elements}
-                # 第1の表：成分目標値・出湯前目標値・出湯後添加成分
-                table1_df = pd.DataFrame([
-                    target_row,
-                    pre_tapping_target_row,
-                    after_tapping_additive_row
-                ], index=[
-                    "成分目標値(%)",
-                    "出湯前目標値(%)",
-                    "出湯後添加成分(%)"
-                ])
-                
-                # 第2の表：至急分析目標値・配合計算成分・判定
-                table2_df = pd.DataFrame([
-                    urgent_analysis_target_row,
-                    blend_calc_row,
-                    judge_row
-                ], index=[
-                    "至急分析目標値(%)",
-                    "配合計算成分(%)",
-                    "判定"
-                ])
-                # 第1の表の表示用文字列化
-                table1_disp = table1_df.astype(str)
-                for row in ["成分目標値(%)", "出湯前目標値(%)", "出湯後添加成分(%)"]:
-                    for e in mat_elements:
-                        val = table1_df.at[row, e]
-                        if isinstance(val, str):
-                            table1_disp.at[row, e] = val
-                        elif val == 0 or (isinstance(val, float) and abs(val) < 1e-12):
-                            table1_disp.at[row, e] = "0"
-                        else:
-                            table1_disp.at[row, e] = f"{val:.3g}"
-                
-                # 第2の表の表示用文字列化
-                table2_disp = table2_df.astype(str)
-                for row in ["至急分析目標値(%)", "配合計算成分(%)"]:
-                    for e in mat_elements:
-                        val = table2_df.at[row, e]
-                        if isinstance(val, str):
-                            table2_disp.at[row, e] = val
-                        elif val == 0 or (isinstance(val, float) and abs(val) < 1e-12):
-                            table2_disp.at[row, e] = "0"
-                        else:
-                            table2_disp.at[row, e] = f"{val:.3g}"
-                
-                # 成分の値がすべて0の列を非表示（両方の表で共通）
-                cols_to_show = []
-                for e in mat_elements:
-                    # 第1の表で0以外の値があるかチェック
-                    table1_has_value = any(table1_disp.at[row, e] != "0" for row in ["成分目標値(%)", "出湯前目標値(%)", "出湯後添加成分(%)"])
-                    # 第2の表で0以外の値があるかチェック
-                    table2_has_value = any(table2_disp.at[row, e] != "0" for row in ["至急分析目標値(%)", "配合計算成分(%)"])
-                    if table1_has_value or table2_has_value:
-                        cols_to_show.append(e)
-                
-                table1_filtered = table1_disp[cols_to_show]
-                table2_filtered = table2_disp[cols_to_show]
-                # 選択元素の背景色を付ける関数
-                def highlight_selected_elements_table(row):
-                    sel_color = "background-color: #ffe599"  # 薄い黄色
-                    result = []
-                    for col in row.index:
-                        if col in selected_elements:
-                            result.append(sel_color)
-                        else:
-                            result.append("")
-                    return result
-                
-                # 判定表用のハイライト関数
-                def highlight_selected_and_ng(row):
-                    ng_color = "background-color: #f4cccc"  # 薄い赤
-                    sel_color = "background-color: #ffe599"  # 薄い黄色
-                    result = []
-                    if row.name == "判定":
-                        for col, val in zip(row.index, row.values):
-                            if isinstance(val, str) and val.startswith("×") and col in selected_elements:
-                                result.append(ng_color)
-                            elif col in selected_elements:
-                                result.append(sel_color)
-                            else:
-                                result.append("")
+                    kind, name, current = sweep_options[label]
+                    lo = min_col.number_input("最小", min_value=0.0, value=round(float(current) * 0.9, 4), format="%.4g", key=f"sweep_min_{axis_idx}_{current_tab_index}_{label}")
+                    hi = max_col.number_input("最大", min_value=0.0, value=round(float(current) * 1.1, 4), format="%.4g", key=f"sweep_max_{axis_idx}_{current_tab_index}_{label}")
+                    steps = steps_col.number_input("分割数", min_value=2, max_value=200, value=31, key=f"sweep_steps_{axis_idx}_{current_tab_index}")
+                    axes.append(((kind, name, np.linspace(lo, hi, int(steps))), label, current))
+                if axes and st.checkbox("計算する", key=f"sweep_run_{current_tab_index}"):
+                    sweep_start = time.perf_counter()
+                    sweep_df = sweep_channel(channel_inputs, calibration_limits, [axis for axis, _, _ in axes])
+                    sweep_ms = (time.perf_counter() - sweep_start) * 1000
+                    axis_labels = [label for _, label, _ in axes]
+                    sweep_df.columns = axis_labels + list(sweep_df.columns[len(axes):])
+                    two_stage_note = f"、検量線上限値を超える {sweep_df.attrs['two_stage']:,} 通りは至急分析前後の同時最適化" if sweep_df.attrs["two_stage"] else ""
+                    st.caption(f"{len(sweep_df):,} 通りを {sweep_ms:.0f} ms で計算（最小二乗法{two_stage_note}）／ 判定○: {(sweep_df['判定'] == '○').sum():,} 通り")
+                    if solver_method == "cost" or (solver_method != "lstsq" and sweep_df.attrs["two_stage"] < len(sweep_df)):
+                        st.caption(f"感度分析の計算方式は画面の計算方式（{SOLVER_METHODS[solver_method]}）と異なるため、現在値の点でも必要添加量が一致しないことがあります。")
+                    for label in axis_labels:
+                        sweep_df[label] = sweep_df[label].round(4)
+                    if len(axes) == 1:
+                        # 入力1つ：材料ごとの必要添加量（kg）と判定を入力値に対して表示
+                        long_df = sweep_df.melt(id_vars=axis_labels + ["判定"], value_vars=material_names, var_name="材料", value_name="必要添加量(kg)")
+                        weight_chart = alt.Chart(long_df).mark_rect().encode(
+                            x=alt.X(f"{axis_labels[0]}:O"),
+                            y=alt.Y("材料:N", sort=material_names),
+                            color=alt.Color("必要添加量(kg):Q", scale=alt.Scale(scheme="blues")),
+                            tooltip=axis_labels + ["材料", alt.Tooltip("必要添加量(kg):Q", format=".3f"), "判定"],
+                        )
+                        judge_chart = alt.Chart(sweep_df).mark_rect().encode(
+                            x=alt.X(f"{axis_labels[0]}:O"),
+                            color=alt.Color("判定:N", scale=alt.Scale(domain=["○", "×"], range=["#b6d7a8", "#f4cccc"])),
+                            tooltip=axis_labels + ["判定"],
+                        ).properties(height=20)
+                        st.altair_chart(alt.vconcat(weight_chart, judge_chart), use_container_width=True)
                     else:
-                        for col in row.index:
-                            if col in selected_elements:
-                                result.append(sel_color)
-                            else:
-                                result.append("")
-                    return result
-                
-                # 第1の表表示
-                st.markdown("**成分目標値・出湯前目標値・出湯後添加成分**")
-                st.dataframe(
-                    table1_filtered.astype(str).style.apply(
-                        highlight_selected_elements_table, axis=1
-                    ),
-                    use_container_width=True,
-                    key=f"table1_{current_tab_index}_{'_'.join(selected_elements)}"
-                )
-                
-                # 第2の表表示
-                st.markdown("**至急分析目標値・配合計算成分・判定**")
-                st.dataframe(
-                    table2_filtered.astype(str).style.apply(
-                        highlight_selected_and_ng, axis=1
-                    ),
+                        # 入力2つ：選択した材料の必要添加量（kg）と判定のヒートマップ
+                        sweep_material = st.selectbox("表示する材料", material_names, key=f"sweep_material_{current_tab_index}")
+                        base = alt.Chart(sweep_df).encode(
+                            x=alt.X(f"{axis_labels[0]}:O"),
+                            y=alt.Y(f"{axis_labels[1]}:O", sort="descending"),
+                            tooltip=axis_labels + [alt.Tooltip(f"{sweep_material}:Q", format=".3f"), "判定"],
+                        )
+                        weight_chart = base.mark_rect().encode(
+                            color=alt.Color(f"{sweep_material}:Q", title=f"{sweep_material}(kg)", scale=alt.Scale(scheme="blues")),
+                        ).properties(title=f"{sweep_material} 必要添加量(kg)")
+                        judge_chart = base.mark_rect().encode(
+                            color=alt.Color("判定:N", scale=alt.Scale(domain=["○", "×"], range=["#b6d7a8", "#f4cccc"])),
+                        ).properties(title="判定")
+                        st.altair_chart(alt.hconcat(weight_chart, judge_chart), use_container_width=True)
+
+            # ---------------------------
+            # 成分ばらつきに対する合格確率
+            # ---------------------------
+            with st.expander("🎲 成分ばらつきに対する合格確率（モンテカルロ法）"):
+                st.caption("材料の成分を元素ごとの相対標準偏差でばらつかせ、いまの必要添加量のまま判定したときの合格確率")
+                sd_df = pd.DataFrame([[5.0] * len(mat_elements)], columns=mat_elements, index=["相対標準偏差(%)"])
+                sd_df = st.data_editor(
+                    sd_df,
+                    column_config={e: st.column_config.NumberColumn(min_value=0.0) for e in mat_elements},
                     use_container_width=True,
-                    key=f"table2_{current_tab_index}_{'_'.join(selected_elements)}"
+                    key=f"scatter_sd_{current_tab_index}_{'_'.join(mat_elements)}"
                 )
-                # 最大誤差も表示（至急分析目標値と比較）
-                target_achieved = np.array([urgent_analysis_target[e] / 100 * total_weight_g for e in mat_elements])
-                max_err = np.max(np.abs(achieved - target_achieved))
-                st.markdown(f"**最大誤差（g）: {max_err:.3g}**")
-                
-                # 計算結果をセッションステートに保存（指示票で使用）
-                calc_results = {}
-                for i, mat in enumerate(material_names):
-                    if add_weights is not None and i < len(add_weights):
-                        calc_results[mat] = add_weights[i]
-                st.session_state[f"calc_results_{current_tab_index}"] = calc_results
-                
-        # 変数の初期化（CSVダウンロード用）
-        if 'additives_df_disp' not in locals():
-            additives_df_disp = None
-        
-        # CSVダウンロード
-        st.markdown("---")
-        # 設定情報と表を統合してCSV出力
-        csv_parts = []
-        
-        # 0. 設定情報
-        csv_parts.append("設定情報")
-        csv_parts.append(f"溶湯種別,{mode}")
-        csv_parts.append(f"出湯温度（℃）,{tapping_temp}")
-        csv_parts.append(f"溶解重量（kg）,{total_weight_kg}")
-        if 'remaining_weight_kg' in locals():
-            csv_parts.append(f"残湯量（kg）,{remaining_weight_kg}")
-        else:
-            csv_parts.append(f"残湯量（kg）,0.0")
+                n_samples = st.number_input("試行回数", min_value=1000, max_value=200000, value=20000, step=1000, key=f"scatter_samples_{current_tab_index}")
+                if st.checkbox("計算する", key=f"scatter_run_{current_tab_index}"):
+                    scatter_start = time.perf_counter()
+                    pass_rate, all_pass_rate = scatter_pass_rate(
+                        material_composition(mat_elements).take(material_names),
+                        outputs["add_weights"],
+                        total_weight_g,
+                        [urgent_analysis_target[e] for e in mat_elements],
+                        [tolerance_values.get(e, 0.01) for e in mat_elements],
+                        [tolerance_types.get(e, "±") == "以下" for e in mat_elements],
+                        [e in selected_elements and e != "Fe" for e in mat_elements],
+                        sd_df.iloc[0].fillna(0.0).to_numpy(dtype=float) / 100,
+                        n_samples=int(n_samples),
+                    )
+                    scatter_ms = (time.perf_counter() - scatter_start) * 1000
+                    judged_elements = [e for e, rate in zip(mat_elements, pass_rate) if not np.isnan(rate)]
+                    if judged_elements:
+                        rate_df = pd.DataFrame([[f"{rate * 100:.1f}" for rate in pass_rate if not np.isnan(rate)]], columns=judged_elements, index=["合格確率(%)"])
+                        st.dataframe(rate_df, use_container_width=True)
+                        st.markdown(f"**すべての元素が合格する確率: {all_pass_rate * 100:.1f}%**")
+                    else:
+                        st.write("（判定の対象となる元素はありません）")
+                    st.caption(f"{int(n_samples):,} 回の試行を {scatter_ms:.0f} ms で計算")
+
+            
+    # 変数の初期化（CSVダウンロード用）
+    if 'additives_df_disp' not in locals():
+        additives_df_disp = None
+    
+    # CSVダウンロード
+    st.markdown("---")
+    # 設定情報と表を統合してCSV出力
+    csv_parts = []
+    
+    # 0. 設定情報
+    csv_parts.append("設定情報")
+    csv_parts.append(f"溶湯種別,{mode}")
+    csv_parts.append(f"出湯温度（℃）,{tapping_temp}")
+    csv_parts.append(f"溶解重量（kg）,{total_weight_kg}")
+    if 'remaining_weight_kg' in locals():
+        csv_parts.append(f"残湯量（kg）,{remaining_weight_kg}")
+    else:
+        csv_parts.append(f"残湯量（kg）,0.0")
+    csv_parts.append("")
+    
+    # 1. 材料・添加材ごとの必要添加量による成分増加量（%）
+    if 'inc_table' in locals():
+        csv_parts.append("材料・添加材ごとの必要添加量による成分増加量（%）")
+        csv_parts.append(format_inc_table(inc_table).to_csv(index=True))
         csv_parts.append("")
+    
+    # 2. 添加材ごとの必要添加量（g）
+    if 'additives_df_disp' in locals() and additives_df_disp is not None:
+        csv_parts.append("添加材ごとの必要添加量（g）")
+        csv_parts.append(additives_df_disp.to_csv(index=True))
+        csv_parts.append("")
+    
+    # 3. 材料ごとの必要添加量（g）
+    if 'result_with_analysis' in locals():
+        csv_parts.append("材料ごとの必要添加量（g）")
+        csv_parts.append(result_with_analysis.to_csv(index=True))
+        csv_parts.append("")
+    
+    # 4. 成分目標値・出湯前目標値・出湯後添加成分
+    if 'table1_filtered' in locals():
+        csv_parts.append("成分目標値・出湯前目標値・出湯後添加成分")
+        csv_parts.append(table1_filtered.to_csv(index=True))
+        csv_parts.append("")
+    
+    # 5. 至急分析目標値・配合計算成分・判定
+    if 'table2_filtered' in locals():
+        csv_parts.append("至急分析目標値・配合計算成分・判定")
+        csv_parts.append(table2_filtered.to_csv(index=True))
+    
+    # BOM付きUTF-8で出力
+    csv_string = "\n".join(csv_parts)
+    csv_data = '\ufeff' + csv_string
+    
+    # タブ番号を直接計算（ループのインデックスを保存）
+    tab_index = current_tab_index  # ループのインデックスを保存
+    current_tab_name = f"配合{tab_index + 1}"
+    # ユニークなキーを生成
+    key_source = f"{test_name}_{current_tab_name}_{len(selected_elements)}"
+    if 'selected_materials' in locals():
+        key_source += f"_{len(selected_materials)}"
+    dl_key = f"csv_download_{hashlib.md5(key_source.encode()).hexdigest()[:8]}"
+    # 試験名をファイル名に含める
+    safe_test_name = test_name.replace("/", "_").replace("\\", "_").replace(":", "_")
+    tab_number = current_tab_name.replace('配合', '')
+    file_name = f"{safe_test_name}_{current_tab_name}_結果.csv"
+    st.download_button(
+        label=f"📁 {file_name}をダウンロード",
+        data=csv_data,
+        file_name=file_name,
+        mime="text/csv",
+        key=dl_key
+    )
+
+# チャンネル一覧（要約だけを表示し、表や入力欄は編集中のチャンネルだけ作る）
+def render_overview(edit_channel):
+    rows = []
+    for i in range(n_channels):
+        summary = channel_summary(i, group_limits)
+        rows.append({
+            "チャンネル": f"Ch{i+1}",
+            "編集中": "✏️" if i == edit_channel else "",
+            "溶湯種別": st.session_state.get(f"mode_radio_{i}", "FCD"),
+            "溶解重量(kg)": st.session_state.get(f"total_weight_{i}", 110.0),
+            "C目標値(%)": st.session_state.get(f"target_C_{i}", 0.0),
+            "計算方式": SOLVER_METHODS.get(summary.get("計算方式"), ""),
+            "判定": summary.get("判定", "-"),
+            "NG元素": summary.get("NG元素", ""),
+            "最大誤差(g)": summary.get("最大誤差(g)"),
+            "エラー": summary.get("エラー", ""),
+        })
+    st.dataframe(
+        pd.DataFrame(rows),
+        column_config={"最大誤差(g)": st.column_config.NumberColumn(format="%.1f")},
+        hide_index=True,
+        use_container_width=True
+    )
+
+# 在庫計画（指示票に載せるチャンネルを1チャンネルあたり heats_per_channel ヒートずつ、材料の在庫の範囲でまとめて計算する）
+# 各チャンネルの計算方式・至急分析後の添加は使わず、判定の対象の元素と Fe の許容範囲を制約にした線形計画法で解く。
+# 材料ごとの装入量の下限・上限と装入量合計の上限は、チャンネルの計算方式で使っている場合だけ制約にする
+def render_inventory_plan():
+    problems = []
+    for i in range(n_channels):
+        if st.session_state.get(f"target_C_{i}", 0.0) <= 0:
+            continue
+        try:
+            problem = channel_problem(channel_config(i), group_limits)
+        except Exception as e:
+            st.error(f"Ch{i+1}: {e}")
+            continue
+        if problem is not None:
+            problems.append((i, problem))
+    if not problems:
+        st.info("Cの目標値を入力して材料を選択したチャンネルがありません。")
+        return
+
+    st.caption("各チャンネルの計算方式・至急分析後の添加量は使わず、許容範囲を制約にした線形計画法でまとめて計算します。"
+               "材料ごとの装入量の下限・上限と装入量合計の上限（溶解重量以下）は、チャンネルで設定していれば制約にします。")
+    st.markdown("**1チャンネルあたりのヒート数**")
+    heats_per_channel = st.number_input("1チャンネルあたりのヒート数", min_value=1, max_value=100, value=1, step=1, key="plan_heats_per_channel", label_visibility="collapsed")
+    material_names = list(dict.fromkeys(m for _, p in problems for m in p["material_names"]))
+
+    # 在庫（kg）。空欄の材料は在庫を考慮しない。表の編集内容は他のタブを開いている間に消えるため、セッションに残して次の初期値にする
+    st.markdown("**材料の在庫（kg、空欄は考慮しない）**")
+    inventory_state = st.session_state.setdefault("inventory_plan", {})
+    stock_kg = inventory_state.setdefault("stock_kg", {})
+    editor_key = f"inventory_editor_{'_'.join(material_names)}"
+    if editor_key not in st.session_state:
+        inventory_state["initial"] = pd.DataFrame({"在庫(kg)": [stock_kg.get(m, np.nan) for m in material_names]}, index=material_names)
+    inventory_df = st.data_editor(
+        inventory_state["initial"],
+        column_config={"在庫(kg)": st.column_config.NumberColumn(min_value=0.0)},
+        use_container_width=True,
+        key=editor_key
+    )
+    stock_kg.update(inventory_df["在庫(kg)"].to_dict())
+    inventory_g = inventory_df["在庫(kg)"].fillna(np.inf).to_numpy(dtype=float) * 1000
+
+    # ヒートごとの入力（チャンネルの順に heats_per_channel 回ずつ）
+    mat_elements = problems[0][1]["elements"]
+    column = {m: j for j, m in enumerate(material_names)}
+    heat_channels, urgent, total, selected, manual, tol, upper_only, judged = [], [], [], [], [], [], [], []
+    lower, upper, capacity = [], [], []
+    for i, p in problems:
+        cols = [column[m] for m in p["material_names"]]
+        row_selected = np.zeros(len(material_names), dtype=bool)
+        row_selected[cols] = True
+        row_manual = np.zeros(len(material_names))
+        row_manual[cols] = p["manual_g"]
+        # 下限・上限は最小二乗法以外、装入量合計はコスト最小化と「溶解重量以下」を選んだ有界最小二乗法・線形計画法で使う
+        row_lower = np.zeros(len(material_names))
+        row_upper = np.full(len(material_names), np.inf)
+        if p["solver_method"] != "lstsq":
+            row_lower[cols] = p["lower_g"]
+            row_upper[cols] = p["upper_g"]
+        row_capacity = p["charge_g"] if p["solver_method"] == "cost" or (p["solver_method"] != "lstsq" and p["use_capacity"]) else np.inf
+        for _ in range(heats_per_channel):
+            heat_channels.append(i)
+            urgent.append(p["urgent_pct"])
+            total.append(p["total_weight_g"])
+            selected.append(row_selected)
+            manual.append(row_manual)
+            tol.append(p["tol_pct"])
+            upper_only.append(p["upper_only"])
+            judged.append(p["judged"])
+            lower.append(row_lower)
+            upper.append(row_upper)
+            capacity.append(row_capacity)
+    plan_inputs = (heat_channels, urgent, total, selected, manual, tol, upper_only, judged, lower, upper, capacity, inventory_g)
+    plan_digest = hashlib.sha1(repr((plan_inputs, material_names, reference_version("materials.csv", "additives.csv"))).encode("utf-8")).hexdigest()
+
+    if st.button("📦 在庫の範囲で全ヒートを計算", key="plan_run"):
+        A = material_composition(mat_elements).take(material_names)
+        start = time.perf_counter()
+        try:
+            result = plan_heats(
+                A, urgent, total, selected, manual, tol_pct=tol, upper_only=upper_only, judged=judged,
+                inventory_g=inventory_g, lower_g=lower, upper_g=upper, capacity_g=capacity,
+                mass_row=mat_elements.index("Fe") if "Fe" in mat_elements else None,
+            )
+        except ValueError as e:
+            st.error(str(e))
+            return
+        judgement = judge_blend(result.achieved_pct(total), urgent, tol, upper_only, judged)
+        inventory_state["result"] = {
+            "digest": plan_digest,
+            "material_names": material_names,
+            "elements": mat_elements,
+            "heat_channels": heat_channels,
+            "inventory_g": inventory_g,
+            "result": result,
+            "judgement": judgement,
+            "elapsed": time.perf_counter() - start,
+        }
+    plan = inventory_state.get("result")
+    if plan is None:
+        return
+    if plan["digest"] != plan_digest:
+        st.warning("計算後に入力または在庫が変更されています。もう一度計算してください。")
+    result = plan["result"]
+    judgement = plan["judgement"]
+    plan_materials = plan["material_names"]
+    st.caption(f"{len(plan['heat_channels'])} ヒート・{len(plan_materials)} 材料を {plan['elapsed'] * 1000:.0f} ms で計算しました")
+
+    # 材料ごとの使用量と在庫。単独計算は各チャンネルを在庫を考慮せずに計算した結果（チャンネル一覧と同じ）
+    used_g = result.weights.sum(axis=0)
+    standalone_g = np.zeros(len(plan_materials))
+    for i in plan["heat_channels"]:
+        weights = channel_summary(i, group_limits).get("weights", {})
+        standalone_g += [weights.get(m, 0.0) for m in plan_materials]
+    stock_g = plan["inventory_g"]
+    st.markdown("**材料の使用量**")
+    st.dataframe(
+        pd.DataFrame({
+            "使用量(kg)": used_g / 1000,
+            "在庫(kg)": np.where(np.isfinite(stock_g), stock_g / 1000, np.nan),
+            "残り(kg)": np.where(np.isfinite(stock_g), (stock_g - used_g) / 1000, np.nan),
+            "単独計算の使用量(kg)": standalone_g / 1000,
+        }, index=plan_materials),
+        column_config={c: st.column_config.NumberColumn(format="%.2f") for c in ["使用量(kg)", "在庫(kg)", "残り(kg)", "単独計算の使用量(kg)"]},
+        use_container_width=True
+    )
+
+    # ヒートごとの判定と配合（kg）
+    n_ok = int(judgement.all_ok.sum())
+    if n_ok < len(plan["heat_channels"]):
+        st.warning(f"{len(plan['heat_channels']) - n_ok} ヒートが許容範囲に入りません（許容範囲外(g) は在庫の不足や材料の組合せのために許容範囲からはみ出した量）")
+    else:
+        st.success("すべてのヒートが在庫の範囲で許容範囲に入ります")
+    heats_df = pd.DataFrame({
+        "チャンネル": [f"Ch{i+1}" for i in plan["heat_channels"]],
+        "判定": np.where(judgement.all_ok, "○", "×"),
+        "NG元素": [" ".join(e for e, ng in zip(plan["elements"], row) if ng) for row in judgement.ng],
+        "許容範囲外(g)": result.window_excess_g,
+    }, index=pd.RangeIndex(1, len(plan["heat_channels"]) + 1, name="ヒート"))
+    weights_df = pd.DataFrame(result.weights / 1000, columns=plan_materials, index=heats_df.index)
+    st.dataframe(
+        pd.concat([heats_df, weights_df], axis=1),
+        column_config={"許容範囲外(g)": st.column_config.NumberColumn(format="%.1f"),
+                       **{m: st.column_config.NumberColumn(f"{m}(kg)", format="%.3f") for m in plan_materials}},
+        use_container_width=True
+    )
+
+for tab_idx, tab in enumerate(tabs):
+    with tab:
+        if tab_idx == 1:  # 指示票タブの場合
+            st.markdown(f"<h2 style='text-align: center; background-color: #ffe6e6; padding: 10px; border-radius: 5px;'>{tab_names[tab_idx]}</h2>", unsafe_allow_html=True)
+        elif tab_idx == 2:  # 分析依頼票タブの場合
+            st.markdown(f"<h2 style='text-align: center; background-color: #f0f0f0; padding: 10px; border-radius: 5px;'>{tab_names[tab_idx]}</h2>", unsafe_allow_html=True)
+        else:
+            st.markdown(f"<h2 style='text-align: center; background-color: #e6f3ff; padding: 10px; border-radius: 5px;'>{tab_names[tab_idx]}</h2>", unsafe_allow_html=True)
+        # 選択状態を返さない場合（lazy_tabs=False）は open が None になるので、すべてのタブを作成する
+        tab_open = getattr(tab, "open", None) is not False
         
-        # 1. 材料・添加材ごとの必要添加量による成分増加量（%）
-        if 'inc_table' in locals():
-            csv_parts.append("材料・添加材ごとの必要添加量による成分増加量（%）")
-            csv_parts.append(inc_table.to_csv(index=True))
-            csv_parts.append("")
-        
-        # 2. 添加材ごとの必要添加量（g）
-        if 'additives_df_disp' in locals() and additives_df_disp is not None:
-            csv_parts.append("添加材ごとの必要添加量（g）")
-            csv_parts.append(additives_df_disp.to_csv(index=True))
-            csv_parts.append("")
-        
-        # 3. 材料ごとの必要添加量（g）
-        if 'result_with_analysis' in locals():
-            csv_parts.append("材料ごとの必要添加量（g）")
-            csv_parts.append(result_with_analysis.to_csv(index=True))
-            csv_parts.append("")
-        
-        # 4. 成分目標値・出湯前目標値・出湯後添加成分
-        if 'table1_filtered' in locals():
-            csv_parts.append("成分目標値・出湯前目標値・出湯後添加成分")
-            csv_parts.append(table1_filtered.to_csv(index=True))
-            csv_parts.append("")
-        
-        # 5. 至急分析目標値・配合計算成分・判定
-        if 'table2_filtered' in locals():
-            csv_parts.append("至急分析目標値・配合計算成分・判定")
-            csv_parts.append(table2_filtered.to_csv(index=True))
-        
-        # BOM付きUTF-8で出力
-        csv_string = "\n".join(csv_parts)
-        csv_data = '\ufeff' + csv_string
-        
-        # タブ番号を直接計算（ループのインデックスを保存）
-        tab_index = current_tab_index  # ループのインデックスを保存
-        current_tab_name = f"配合{tab_index + 1}"
-        # ユニークなキーを生成
-        import hashlib
-        key_source = f"{test_name}_{current_tab_name}_{len(selected_elements)}"
-        if 'selected_materials' in locals():
-            key_source += f"_{len(selected_materials)}"
-        dl_key = f"csv_download_{hashlib.md5(key_source.encode()).hexdigest()[:8]}"
-        # 試験名をファイル名に含める
-        safe_test_name = test_name.replace("/", "_").replace("\\", "_").replace(":", "_")
-        tab_number = current_tab_name.replace('配合', '')
-        file_name = f"{safe_test_name}_{current_tab_name}_結果.csv"
-        st.download_button(
-            label=f"📁 {file_name}をダウンロード",
-            data=csv_data,
-            file_name=file_name,
-            mime="text/csv",
-            key=dl_key
-        )
\ No newline at end of file
+        if tab_idx == 0:  # 配合
+            if st.session_state.get("edit_channel", 0) >= n_channels:
+                st.session_state["edit_channel"] = 0
+            select_col, refresh_col, _ = st.columns([1, 2, 3])
+            with select_col:
+                st.markdown("**編集するチャンネル**")
+                edit_channel = st.selectbox("編集するチャンネル", list(range(n_channels)), format_func=lambda i: f"Ch{i+1}", key="edit_channel", label_visibility="collapsed")
+            with refresh_col:
+                # 編集中のチャンネルの入力変更はそのチャンネルだけ再実行されるため、一覧への反映はボタンで全体を再実行する
+                st.button("🔄 一覧を最新の計算結果で更新", key="overview_refresh")
+            overview = st.expander(f"📋 チャンネル一覧（{n_channels} チャンネル）", expanded=True)
+            st.markdown(f"<h3 style='text-align: center; background-color: #e6f3ff; padding: 8px; border-radius: 5px;'>Ch{edit_channel+1}</h3>", unsafe_allow_html=True)
+            render_channel(edit_channel, show_tables=tab_open)
+            # 一覧は編集中のチャンネルを計算したあとに作り、その結果をそのまま使う
+            if tab_open:
+                with overview:
+                    render_overview(edit_channel)
+        elif tab_idx == 1 and tab_open:  # 指示票
+            st.markdown("<br>", unsafe_allow_html=True)
+            st.markdown("**設定倍率（材料、合金の添加量に反映）**")
+            multiplier = st.number_input("設定倍率", min_value=0.1, max_value=2.0, value=0.95, step=0.01, key="pdf_multiplier", label_visibility="collapsed")
+            
+            if st.button("📁 指示票PDFを保存", key="pdf_save"):
+                # デスクトップアプリ用にファイルへ直接書き出す
+                pdf_filename = f"{test_name}_指示票.pdf"
+                try:
+                    if generate_instruction_pdf(pdf_filename, test_name, multiplier):
+                        st.success(f"PDFファイルを保存しました: {pdf_filename}")
+                except OSError as e:
+                    st.error(f"PDF保存エラー: {e}")
+                    pdf_buffer = generate_instruction_pdf(io.BytesIO(), test_name, multiplier)
+                    if pdf_buffer:
+                        # フォールバックとしてダウンロードボタンを表示
+                        st.download_button(
+                            label="📁 指示票PDFをダウンロード",
+                            data=pdf_buffer.getvalue(),
+                            file_name=pdf_filename,
+                            mime="application/pdf",
+                            key="pdf_download_fallback"
+                        )
+            
+            # 配合タブの入力変更はそのチャンネルだけ再実行されるため、ここへの反映はボタンで全体を再実行する
+            st.button("🔄 最新の計算結果で更新", key="instruction_refresh")
+            
+            if blending_ratio_df is None or blending_ratio_df.empty:
+                st.warning("blending_ratio.csvが読み込まれていません。")
+            # Cの目標値が0でないチャンネルを5列ずつ表示
+            channels = instruction_channels()
+            for row_start in range(0, len(channels), 5):
+                cols = st.columns(5)
+                for col, channel in zip(cols, channels[row_start:row_start + 5]):
+                    with col:
+                        with st.container(border=True):
+                            st.markdown(f"<h3 style='text-align: center; background-color: #e6f3ff; padding: 8px; border-radius: 5px; margin-bottom: 10px;'>Ch{channel['index']+1}</h3>", unsafe_allow_html=True)
+                            
+                            # 基本情報を表形式で表示
+                            basic_info = pd.DataFrame({
+                                "設定値": [f"{channel['total_weight_kg']}kg", f"{channel['remaining_weight_kg']}kg", channel["mode"], f"{channel['tapping_temp']}℃"]
+                            }, index=["溶湯重量", "残湯量", "溶湯種別", "出湯温度"])
+                            st.dataframe(basic_info, use_container_width=True, hide_index=False)
+                            
+                            st.markdown("---")
+                            
+                            # 神鋼SP銑、故銑、鋼屑はkg単位、その他の材料（合金）と添加剤はg単位
+                            materials = channel["materials"]
+                            base_data_kg = {mat: round(int(materials[mat]) / 1000) for mat in BASE_MATERIALS if materials.get(mat, 0) > 0}
+                            material_info = {mat: int(g) for mat, g in materials.items() if mat not in BASE_MATERIALS}
+                            additive_info = {additive: int(g) for additive, g in channel["additives"]}
+                            
+                            if base_data_kg:
+                                st.markdown("**材料**")
+                                base_df = pd.DataFrame([base_data_kg]).T
+                                base_df.columns = ["添加量（kg）"]
+                                st.dataframe(base_df, use_container_width=True, hide_index=False)
+                            
+                            if material_info:
+                                st.markdown("**合金**")
+                                alloy_df = pd.DataFrame([material_info]).T
+                                alloy_df.columns = ["添加量（g）"]
+                                st.dataframe(alloy_df, use_container_width=True, hide_index=False)
+                            
+                            if additive_info:
+                                st.markdown("---")
+                                st.markdown("**添加剤**")
+                                additive_df = pd.DataFrame([additive_info]).T
+                                additive_df.columns = ["添加量（g）"]
+                                st.dataframe(additive_df, use_container_width=True, hide_index=False)
+            
+            if not channels:
+                st.info("表示する配合データがありません。")
+        elif tab_idx == 2 and tab_open:  # 分析依頼票
+            st.markdown("📈 **分析依頼票の内容をここに表示します**")
+            st.info("分析依頼票の機能は開発中です。")
+        elif tab_idx == 3 and tab_open:  # 在庫計画
+            render_inventory_plan()
+
+autosave_session()
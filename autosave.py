@@ -0,0 +1,132 @@
+# 入力中の設定の自動保存（Streamlitに依存しない）
+# 画面の再実行では最新のスナップショットを渡すだけにし、ファイルへの書き込みは
+# バックグラウンドのスレッドが最後の変更から delay 秒たってから1回だけ行う。
+# 書き込みは一時ファイルに書いてから os.replace で置き換えるので、途中で落ちても前回の内容が残る。
+# 自動保存のファイルは保存済み設定（saved_configs/*.json）の glob に入らないように、サブディレクトリ .autosave に置く。
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+AUTOSAVE_FILENAME = "autosave.json"
+AUTOSAVE_DIRNAME = ".autosave"
+
+_lock = threading.Lock()
+_writers = {}  # パス -> AutosaveWriter
+
+
+def autosave_location(save_dir):
+    """自動保存のパス（save_dir/.autosave/autosave.json）。以前の場所（save_dir/autosave.json）のファイルは移す"""
+    directory = os.path.join(save_dir, AUTOSAVE_DIRNAME)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, AUTOSAVE_FILENAME)
+    legacy = os.path.join(save_dir, AUTOSAVE_FILENAME)
+    if os.path.exists(legacy):
+        if os.path.exists(path):
+            os.remove(legacy)
+        else:
+            os.replace(legacy, path)
+    return path
+
+
+def write_atomic(path, data):
+    """data をJSONで path に書き込む（一時ファイル → fsync → os.replace）"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".autosave_", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_autosave(path):
+    """自動保存の内容（{"timestamp": ..., "state": {...}}）。ないか読めなければ None"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) and isinstance(data.get("state"), dict) else None
+
+
+def remove_autosave(path):
+    get_writer(path).discard()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class AutosaveWriter:
+    """最新のスナップショットだけを保持し、変更が delay 秒止まったら書き込むスレッド"""
+
+    def __init__(self, path, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.last_saved = None   # 最後に書き込んだ時刻（time.time()）
+        self.last_error = None   # 最後の書き込みエラー（成功したら None）
+        self._cond = threading.Condition()
+        self._pending = None
+        self._due = 0.0
+        self._thread = threading.Thread(target=self._run, name=f"autosave:{path}", daemon=True)
+        self._thread.start()
+
+    def submit(self, snapshot):
+        """スナップショットを渡す（すぐに戻る）。delay 秒以内に次が来たら古い方は書かない"""
+        with self._cond:
+            self._pending = snapshot
+            self._due = time.monotonic() + self.delay
+            self._cond.notify()
+
+    def discard(self):
+        with self._cond:
+            self._pending = None
+
+    def flush(self):
+        """待っているスナップショットをすぐに書き込む（終了時用）"""
+        with self._cond:
+            snapshot, self._pending = self._pending, None
+        if snapshot is not None:
+            self._write(snapshot)
+
+    def _write(self, snapshot):
+        try:
+            write_atomic(self.path, snapshot)
+            self.last_saved = time.time()
+            self.last_error = None
+        except OSError as e:
+            self.last_error = e
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                remaining = self._due - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                snapshot, self._pending = self._pending, None
+            self._write(snapshot)
+
+
+def get_writer(path, delay=1.0):
+    """パスごとの書き込みスレッド（プロセスで1つ、全セッション共通）"""
+    path = os.path.abspath(path)
+    with _lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = AutosaveWriter(path, delay)
+            _writers[path] = writer
+            atexit.register(writer.flush)
+        return writer
@@ -0,0 +1,100 @@
+# 保存済み設定（saved_configs/configs.sqlite3 のストア）から指示票PDFを一括作成
+# 設定ごとに画面と同じ手順で配合を計算し直し（batch_replay.replay_channel）、
+# 試験ごとに1つのPDF、または全試験を1ページずつまとめた1つのPDFを作る。設定ごとに別プロセスで計算する。
+# 以前の保存形式（1件1ファイルのJSON）は --json で指定する。
+# 使い方: python batch_instruction_pdf.py
+#         python batch_instruction_pdf.py --name 試験_001 --output-dir 指示票 --multiplier 0.95
+#         python batch_instruction_pdf.py --group FC --combined 指示票_FC.pdf
+#         python batch_instruction_pdf.py --json "saved_configs/*_20250711_*.json"
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from batch_replay import add_source_arguments, calibration_limits, channel_indices, load_sources, replay_channel
+from instruction_pdf import write_instruction_pdf, write_instruction_pdfs
+
+
+def instruction_channels(config_data):
+    """設定ファイル1つ分の指示票のチャンネル（Cの目標値が0でないもの）。計算結果は至急分析前添加量"""
+    limits = calibration_limits(config_data.get("analysis_location", "東分析"), config_data.get("selected_group", ""))
+    channels = []
+    for tab_idx in channel_indices(config_data):
+        tab_config = config_data["tabs"][f"tab_{tab_idx}"]
+        if float(tab_config.get("targets", {}).get("C", 0.0)) <= 0:
+            continue
+        total_weight_kg = tab_config.get("total_weight", 110.0)
+        result = replay_channel(tab_config, limits)
+        additive_percents = tab_config.get("additive_percents", {})
+        channels.append({
+            "index": tab_idx,
+            "total_weight_kg": total_weight_kg,
+            "remaining_weight_kg": tab_config.get("remaining_weight", 0.0),
+            "mode": tab_config.get("mode", "FCD"),
+            "tapping_temp": tab_config.get("tapping_temp", 1450),
+            "materials": {} if result is None else {mat: float(w) for mat, w in result["weights"].items()},
+            "additives": [(a, float(additive_percents[a]) / 100 * total_weight_kg * 1000)
+                          for a in tab_config.get("selected_additives", []) if a in additive_percents],
+        })
+    return channels
+
+
+def load_sheet(config_data):
+    """設定1つ分の (試験名, チャンネル) を返す"""
+    return config_data.get("test_name", ""), instruction_channels(config_data)
+
+
+def export_sheet(source, output_dir, multiplier):
+    """設定1つ分の指示票PDFを書き出す。プロセスプールの作業単位。戻り値は (PDFのパス, エラー)"""
+    name, config_data, error = source
+    if config_data is None:
+        return None, f"{name}: {error}"
+    try:
+        test_name, channels = load_sheet(config_data)
+        pdf_path = os.path.join(output_dir, f"{os.path.splitext(name)[0]}_指示票.pdf")
+        write_instruction_pdf(pdf_path, test_name, channels, multiplier)
+        return pdf_path, None
+    except Exception as e:
+        return None, f"{name}: {e}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済み設定から指示票PDFを一括作成")
+    add_source_arguments(parser)
+    parser.add_argument("--output-dir", default=".", help="試験ごとのPDFの出力先")
+    parser.add_argument("--combined", default=None, help="指定すると全試験を1ページずつまとめた1つのPDFにする")
+    parser.add_argument("--multiplier", type=float, default=0.95, help="設定倍率（材料、合金の添加量に反映）")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数（既定はCPU数）")
+    args = parser.parse_args()
+
+    sources = load_sources(args)
+    if not sources:
+        raise SystemExit("保存済みの設定が見つかりません")
+    start = time.perf_counter()
+    chunksize = max(1, len(sources) // 64)
+    errors = [f"{name}: {error}" for name, config_data, error in sources if config_data is None]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        if args.combined:
+            # 計算だけを並列に行い、PDFは設定の順に1つにまとめる
+            sheets = []
+            futures = [(name, pool.submit(load_sheet, config_data)) for name, config_data, _ in sources if config_data is not None]
+            for name, future in futures:
+                try:
+                    sheets.append(future.result())
+                except Exception as e:
+                    errors.append(f"{name}: {e}")
+            write_instruction_pdfs(args.combined, sheets, args.multiplier)
+            written = [args.combined]
+        else:
+            os.makedirs(args.output_dir, exist_ok=True)
+            results = list(pool.map(partial(export_sheet, output_dir=args.output_dir, multiplier=args.multiplier), sources, chunksize=chunksize))
+            written = [pdf_path for pdf_path, _ in results if pdf_path]
+            errors = [error for _, error in results if error]
+    for error in errors:
+        print(f"エラー: {error}")
+    print(f"{len(sources)} 件の設定から {len(written)} 個のPDFを {time.perf_counter() - start:.1f} 秒で作成しました（エラー: {len(errors)} 件）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# 保存済み設定（saved_configs/configs.sqlite3 のストア）の一括再計算
+# 参照データ（materials.csv など）を更新したあとに、保存済みの配合を画面と同じ手順で計算し直して
+# 1つのCSVにまとめる。設定はストアから読み、設定ごとに別プロセスで計算する。
+# 以前の保存形式（1件1ファイルのJSON）は --json で指定する。
+# 使い方: python batch_replay.py
+#         python batch_replay.py --name 試験_ --group FC --output replay_results.csv --workers 4
+#         python batch_replay.py --json "saved_configs/試験_*.json"
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from blend_engine import additive_contributions_g, judge_blend, solve_blend, solve_blend_two_stage, split_urgent_targets
+from config_store import connect, iter_configs, store_path
+from reference_data import load_composition, load_csv
+
+ELEMENTS = ['C', 'Si', 'Mn', 'P', 'S', 'Ni', 'Cr', 'Mo', 'Ti', 'V', 'Cu', 'W', 'Sn', 'Al', 'Mg', 'Zn']  # Feは除外
+MANUAL_MATERIALS = ["鋼屑", "神鋼SP銑", "故銑"]
+CALIBRATION_FILES = {"東分析": "Calibration_upper_limit_OES.csv", "西分析": "Calibration_upper_limit_XRF.csv"}
+TWO_STAGE_CONSTRAINTS = ("lower_g", "upper_g", "capacity_g")  # 至急分析前後の同時最適化でも使う制約
+COLUMNS = ["ファイル", "試験名", "チャンネル", "溶湯種別", "溶解重量(kg)", "計算方式", "判定", "NG元素", "最大誤差(g)",
+           "材料", "至急分析前添加量(g)", "至急分析後添加量(g)", "エラー"]
+
+
+def calibration_limits(analysis_location, group):
+    """検量線上限値（%）。値が空または0の元素は含めない"""
+    if not group:
+        return {}
+    calibration_df = load_csv(CALIBRATION_FILES.get(analysis_location, CALIBRATION_FILES["東分析"]))
+    group_data = calibration_df[calibration_df['Group'] == group]
+    limits = {}
+    if not group_data.empty:
+        for e in ELEMENTS + ['Fe']:
+            if e in calibration_df.columns:
+                val = group_data[e].iloc[0]
+                if pd.notna(val) and val != 0:
+                    limits[e] = float(val)
+    return limits
+
+
+def channel_indices(config_data):
+    """設定ファイルのチャンネル番号（0始まり、昇順）。tabs のキーは tab_{番号}"""
+    return sorted(int(key.rsplit("_", 1)[-1]) for key in config_data.get("tabs", {}))
+
+
+def solver_constraints(solver_method, urgent_pct, charge_g, lower_g, upper_g, use_capacity, price, tol_pct, upper_only, judged):
+    """
+    計算方式ごとの制約（solve_blend の引数、画面の「計算方式・制約条件」と同じ）。
+    urgent_pct: (N, E) 至急分析目標値、charge_g: (N,) 材料の装入量合計（溶解重量から添加剤を引いた値）
+    lower_g / upper_g / price: (M,)、tol_pct / upper_only / judged: (E,)。price 以外はヒートごとの値にそろえて返す
+    """
+    urgent_pct = np.atleast_2d(np.asarray(urgent_pct, dtype=float))
+    n = urgent_pct.shape[0]
+    charge_g = np.broadcast_to(np.asarray(charge_g, dtype=float), (n,))
+    if solver_method == "lstsq":
+        return {}
+    constraints = {"lower_g": np.tile(np.asarray(lower_g, dtype=float), (n, 1)), "upper_g": np.tile(np.asarray(upper_g, dtype=float), (n, 1))}
+    if solver_method == "cost":
+        # 選択した元素を判定と同じ許容範囲に収め、材料の装入量合計は溶解重量（添加剤を除く）に合わせる
+        constraints["price"] = np.asarray(price, dtype=float)
+        constraints["tol_pct"] = np.tile(np.asarray(tol_pct, dtype=float), (n, 1))
+        constraints["upper_only"] = np.tile(np.asarray(upper_only, dtype=bool), (n, 1))
+        constraints["constrained"] = np.asarray(judged, dtype=bool) & (urgent_pct > 0)
+        constraints["charge_g"] = charge_g
+    elif use_capacity:
+        constraints["capacity_g"] = charge_g
+    return constraints
+
+
+def channel_problem(tab_config, limits):
+    """1チャンネル分の設定から配合計算の入力（元素は材料の成分にある元素の順）を画面と同じ手順で作る。材料を選択していなければ None"""
+    material_names = tab_config.get("selected_materials", [])
+    if not material_names:
+        return None
+    materials_df = load_csv("materials.csv", index_col=0)
+    total_weight_g = float(tab_config.get("total_weight", 110.0)) * 1000
+    mode = tab_config.get("mode", "FCD")
+    selected_elements = tab_config.get("selected_elements", [])
+    targets = tab_config.get("targets", {})
+    tolerances = tab_config.get("tolerances", {})
+    tolerance_types = tab_config.get("tolerance_types", {})
+
+    # 目標成分（Cは FCD +0.07 / FC +0.05、Feは100%から他元素の合計を引いた値）
+    target_composition = {}
+    for e in ELEMENTS:
+        v = float(targets.get(e, 0.0)) if e in selected_elements else 0.0
+        if e == "C" and e in selected_elements:
+            v += 0.07 if mode == "FCD" else 0.05
+        target_composition[e] = v
+    target_composition['Fe'] = 100.0 - sum(target_composition.values())
+
+    # 添加材の元素合計
+    all_elements = ELEMENTS + ['Fe']
+    additive_matrix = load_composition("additives.csv", all_elements, index_col=0)
+    additive_percents = tab_config.get("additive_percents", {})
+    additive_names = list(dict.fromkeys(a for a in tab_config.get("selected_additives", []) if a in additive_matrix.index))
+    additive_grams = np.array([float(additive_percents.get(a, 0.0)) / 100 * total_weight_g for a in additive_names])
+    additive_pct = additive_contributions_g(additive_matrix.take(additive_names), additive_grams) / total_weight_g * 100
+
+    # 至急分析目標値（検量線上限値を超える分は至急分析後に添加）
+    urgent_values, post_values = split_urgent_targets(
+        [target_composition[e] for e in all_elements],
+        additive_pct,
+        [limits.get(e, np.inf) for e in all_elements],
+    )
+    urgent = dict(zip(all_elements, urgent_values))
+    post = dict(zip(all_elements, post_values))
+
+    mat_elements = [e for e in all_elements if e in materials_df.columns]
+    manual_materials = tab_config.get("manual_materials", {})
+    manual_values = [float(manual_materials.get(m, 0.0)) * 1000 if m in MANUAL_MATERIALS else 0.0 for m in material_names]
+    A = load_composition("materials.csv", mat_elements, yield_column="歩留まり", index_col=0).take(material_names)
+    # 計算方式と制約（材料ごとの装入量の下限・上限（kg、上限の None はなし）、装入量合計の上限）
+    solver_method = tab_config.get("solver_method", "lstsq")
+    unique_df = materials_df[~materials_df.index.duplicated()]
+    price = (unique_df["単価"].reindex(material_names) if "単価" in unique_df.columns else pd.Series(np.nan, index=material_names)).to_numpy(dtype=float) / 1000
+    if solver_method == "cost" and np.isnan(price[np.array(manual_values) == 0.0]).any():
+        # 画面と同じく、自動配合する材料に単価のないものがあれば最小二乗法で計算する
+        solver_method = "lstsq"
+    charge_bounds = tab_config.get("charge_bounds", {})
+    lower_kg = [charge_bounds.get(m, [0.0, None])[0] or 0.0 for m in material_names]
+    upper_kg = [np.inf if charge_bounds.get(m, [0.0, None])[1] is None else charge_bounds[m][1] for m in material_names]
+    return {
+        "mode": mode,
+        "solver_method": solver_method,
+        "material_names": list(material_names),
+        "elements": mat_elements,
+        "A": A,
+        "total_weight_g": total_weight_g,
+        "urgent_pct": np.array([urgent[e] for e in mat_elements]),
+        "post_pct": np.array([post[e] for e in mat_elements]),
+        "limit_pct": np.array([limits.get(e, np.inf) for e in mat_elements]),
+        "manual_g": np.array(manual_values),
+        "tol_pct": np.array([tolerances.get(e, 0.01) if e in selected_elements else 0.01 for e in mat_elements]),
+        "upper_only": np.array([tolerance_types.get(e, "±") == "以下" for e in mat_elements]),
+        "judged": np.array([e in selected_elements and e != "Fe" for e in mat_elements]),
+        "lower_g": np.array(lower_kg, dtype=float) * 1000,
+        "upper_g": np.array(upper_kg, dtype=float) * 1000,
+        "use_capacity": bool(tab_config.get("use_capacity", False)),
+        "charge_g": total_weight_g - additive_grams.sum(),
+        "price": price,
+    }
+
+
+def replay_channel(tab_config, limits):
+    """1チャンネル分の設定を画面と同じ手順で計算する。材料を選択していなければ None"""
+    problem = channel_problem(tab_config, limits)
+    if problem is None:
+        return None
+    A = problem["A"]
+    total_weight_g = problem["total_weight_g"]
+    mat_elements = problem["elements"]
+    material_names = problem["material_names"]
+    solve_args = (
+        A,
+        problem["urgent_pct"][None, :],
+        [total_weight_g],
+        np.ones((1, len(material_names)), dtype=bool),
+        problem["manual_g"][None, :],
+        problem["post_pct"][None, :],
+    )
+    constraints = solver_constraints(
+        problem["solver_method"], solve_args[1], [problem["charge_g"]], problem["lower_g"], problem["upper_g"],
+        problem["use_capacity"], problem["price"], problem["tol_pct"], problem["upper_only"], problem["judged"],
+    )
+    if problem["solver_method"] != "cost" and np.any(problem["post_pct"] > 0):
+        # 画面と同じく、検量線上限値を超える元素があれば至急分析前後の添加量を同時に最適化する
+        two_stage_constraints = {k: v for k, v in constraints.items() if k in TWO_STAGE_CONSTRAINTS}
+        result = solve_blend_two_stage(*solve_args, limit_pct=problem["limit_pct"][None, :], **two_stage_constraints)
+    else:
+        result = solve_blend(*solve_args, method=problem["solver_method"], **constraints)
+    weights = result.weights[0]
+    achieved_pct = A @ np.where(weights > 1e-3, weights, 0.0) / total_weight_g * 100
+    judgement = judge_blend(achieved_pct, problem["urgent_pct"], problem["tol_pct"], problem["upper_only"], problem["judged"])
+    target_g = problem["urgent_pct"] / 100 * total_weight_g
+    return {
+        "溶湯種別": problem["mode"],
+        "溶解重量(kg)": total_weight_g / 1000,
+        "計算方式": problem["solver_method"],
+        "判定": "○" if judgement.all_ok[0] else "×",
+        "NG元素": " ".join(e for e, ng in zip(mat_elements, judgement.ng[0]) if ng),
+        "最大誤差(g)": float(np.max(np.abs(achieved_pct / 100 * total_weight_g - target_g))),
+        "weights": dict(zip(material_names, weights)),
+        "post_weights": dict(zip(material_names, result.post_weights[0])),
+    }
+
+
+def add_source_arguments(parser):
+    """保存済み設定の選び方（ストアの絞り込み、または --json で以前のJSONファイル）の引数"""
+    parser.add_argument("--store", default=store_path("saved_configs"), help="保存済み設定のストア")
+    parser.add_argument("--name", default="", help="試験名（前方一致）")
+    parser.add_argument("--group", default=None, help="Group")
+    parser.add_argument("--json", nargs="+", default=None, metavar="PATTERN",
+                        help="ストアの代わりに以前の保存形式のJSONファイルを使う（glob可）")
+
+
+def load_sources(args):
+    """
+    計算する設定の [(名前, 設定, エラー)]。ストアは保存日時の新しい順、JSONはパスの順。
+    名前はストアの保存名、またはJSONのファイル名。読めない・設定ではないJSONは設定を None にしてエラーを返す
+    """
+    if args.json:
+        sources = []
+        for path in sorted({p for pattern in args.json for p in glob.glob(pattern)}):
+            name = os.path.basename(path)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    config_data = json.load(f)
+            except (OSError, ValueError) as e:
+                sources.append((name, None, str(e)))
+                continue
+            if not isinstance(config_data, dict) or not isinstance(config_data.get("tabs"), dict):
+                sources.append((name, None, "設定ファイルではありません"))
+                continue
+            sources.append((name, config_data, None))
+        return sources
+    if not os.path.exists(args.store):
+        raise SystemExit(f"ストアが見つかりません: {args.store}（以前のJSONファイルは --json で指定）")
+    with connect(args.store) as conn:
+        return [(row["name"], config_data, None) for row, config_data in iter_configs(conn, name_prefix=args.name, group=args.group)]
+
+
+def replay_config(name, config_data):
+    """設定1つ分を計算し、結果の行（材料ごと）を返す。プロセスプールの作業単位"""
+    try:
+        limits = calibration_limits(config_data.get("analysis_location", "東分析"), config_data.get("selected_group", ""))
+        rows = []
+        for tab_idx in channel_indices(config_data):
+            tab_config = config_data["tabs"][f"tab_{tab_idx}"]
+            base = {"ファイル": name, "試験名": config_data.get("test_name", ""), "チャンネル": f"Ch{tab_idx + 1}"}
+            try:
+                channel = replay_channel(tab_config, limits)
+            except Exception as e:
+                rows.append({**base, "エラー": str(e)})
+                continue
+            if channel is None:
+                continue
+            weights = channel.pop("weights")
+            post_weights = channel.pop("post_weights")
+            for mat, w in weights.items():
+                rows.append({**base, **channel, "材料": mat,
+                             "至急分析前添加量(g)": round(float(w)), "至急分析後添加量(g)": round(float(post_weights[mat]))})
+        return rows
+    except Exception as e:
+        return [{"ファイル": name, "エラー": str(e)}]
+
+
+def replay_source(source):
+    """load_sources の1件を計算する。読めなかった設定はエラーの行だけ返す"""
+    name, config_data, error = source
+    if config_data is None:
+        return [{"ファイル": name, "エラー": error}]
+    return replay_config(name, config_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済み設定の一括再計算")
+    add_source_arguments(parser)
+    parser.add_argument("--output", default="replay_results.csv", help="結果のCSV（BOM付きUTF-8）")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数（既定はCPU数）")
+    args = parser.parse_args()
+
+    sources = load_sources(args)
+    if not sources:
+        raise SystemExit("保存済みの設定が見つかりません")
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        rows = [row for config_rows in pool.map(replay_source, sources, chunksize=max(1, len(sources) // 64)) for row in config_rows]
+    results = pd.DataFrame(rows, columns=COLUMNS)
+    results.to_csv(args.output, index=False, encoding="utf-8-sig")
+    n_ng = results.loc[results["判定"] == "×", ["ファイル", "チャンネル"]].drop_duplicates().shape[0]
+    n_err = results["エラー"].notna().sum()
+    print(f"{len(sources)} 件の設定を {time.perf_counter() - start:.1f} 秒で再計算しました: {args.output}（判定×: {n_ng} チャンネル、エラー: {n_err} 件）")
+
+
+if __name__ == "__main__":
+    main()
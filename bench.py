@@ -0,0 +1,390 @@
+# 配合計算エンジンのベンチマーク
+# 使い方: python bench.py solver --heats 1000
+#         python bench.py rerun --repeat 5
+#         python bench.py channels --channels 5 30
+#         python bench.py pdf --repeat 20
+#         python bench.py store --saves 10000
+#         python bench.py library --materials 500 5000
+#         python bench.py select --materials 20 5000
+#         python bench.py sparse --materials 20 5000 --elements 16 40
+#         python bench.py plan --heats 5 50 200
+import argparse
+import glob
+import io
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from blend_engine import SOLVER_METHODS, composition_matrix, judge_blend, plan_heats, select_materials, solve_blend
+from reference_data import CompositionMatrix
+
+ELEMENTS = ['C', 'Si', 'Mn', 'P', 'S', 'Ni', 'Cr', 'Mo', 'Ti', 'V', 'Cu', 'W', 'Sn', 'Al', 'Mg', 'Zn', 'Fe']
+
+
+def _timeit(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _random_heats(n_heats, n_mats, seed=0):
+    # Ch1 の既定値（C 3.67 / Si 1.81 / Mn 0.4 / P 0.03 / S 0.02）付近で目標値をばらつかせる
+    rng = np.random.default_rng(seed)
+    targets = np.zeros((n_heats, len(ELEMENTS)))
+    targets[:, 0] = 3.6 + rng.uniform(0.0, 0.2, n_heats)
+    targets[:, 1] = 1.7 + rng.uniform(0.0, 0.3, n_heats)
+    targets[:, 2] = 0.3 + rng.uniform(0.0, 0.3, n_heats)
+    targets[:, 3] = 0.03
+    targets[:, 4] = 0.02
+    targets[:, -1] = 100.0 - targets[:, :-1].sum(axis=1) - 1.5
+    total_weight_g = np.full(n_heats, 110000.0)
+    selected = np.ones((n_heats, n_mats), dtype=bool)
+    return targets, total_weight_g, selected
+
+
+def bench_solver(args):
+    materials_df = pd.read_csv("materials.csv", encoding="cp932", index_col=0)
+    names = ["神鋼SP銑", "鋼屑", "C粉", "Fe-Si", "Fe-Mn"]
+    A = composition_matrix(materials_df, names, ELEMENTS)
+    targets, total_weight_g, selected = _random_heats(args.heats, len(names))
+
+    print(f"ヒート数: {args.heats}, 材料数: {len(names)}")
+    for method in ("lstsq", "bounded", "lp"):
+        label = SOLVER_METHODS[method]
+        elapsed = _timeit(lambda: solve_blend(A, targets, total_weight_g, selected, method=method), args.repeat)
+        result = solve_blend(A, targets, total_weight_g, selected, method=method)
+        max_err = np.abs(result.achieved_g - result.target_g).max()
+        print(f"{label:<12} 1ヒートあたり {elapsed / args.heats * 1e6:9.1f} us  最大誤差 {max_err:10.3g} g")
+
+    # 前回解からのウォームスタート（目標値を少しだけ動かした再計算）
+    first = solve_blend(A, targets, total_weight_g, selected, method="bounded")
+    nudged = targets * 1.001
+    elapsed = _timeit(lambda: solve_blend(A, nudged, total_weight_g, selected, method="bounded", warm_start=first.weights), args.repeat)
+    warm = solve_blend(A, nudged, total_weight_g, selected, method="bounded", warm_start=first.weights)
+    print(f"{'有界（前回解あり）':<12} 1ヒートあたり {elapsed / args.heats * 1e6:9.1f} us  再利用率 {warm.warm_started.mean():.0%}")
+
+
+def bench_rerun(args):
+    # 5チャンネルすべてに配合がある状態（blending_ratio.csv の既定値）で画面全体の再実行時間を測る
+    from streamlit.testing.v1 import AppTest
+
+    def rerun_time(lazy):
+        at = AppTest.from_file("app.py", default_timeout=args.timeout)
+        at.run()
+        if not any(c.key == "lazy_tabs_common" for c in at.checkbox):
+            raise SystemExit("このバージョンのStreamlitは st.tabs の選択状態に対応していないため比較できません")
+        if at.checkbox(key="lazy_tabs_common").value != lazy:
+            at.checkbox(key="lazy_tabs_common").set_value(lazy)
+        at.run()
+        populated = sum("detail" in c or "summary" in c for c in at.session_state["channels"].values())
+        return _timeit(at.run, args.repeat), populated, len(at.dataframe)
+
+    eager, populated, eager_tables = rerun_time(False)
+    lazy, _, lazy_tables = rerun_time(True)
+    print(f"計算済みチャンネル数: {populated}")
+    print(f"{'全タブ作成':<12} 再実行 {eager * 1000:8.1f} ms  表 {eager_tables} 個")
+    print(f"{'選択中のタブのみ':<12} 再実行 {lazy * 1000:8.1f} ms  表 {lazy_tables} 個  短縮 {(eager - lazy) * 1000:.1f} ms")
+
+
+def bench_channels(args):
+    # チャンネル数を変えて画面全体の再実行時間を測る（詳細を作るのは編集中の1チャンネルだけ）
+    from streamlit.testing.v1 import AppTest
+
+    for n_channels in args.channels:
+        at = AppTest.from_file("app.py", default_timeout=args.timeout)
+        at.run()
+        at.number_input(key="channel_count_common").set_value(n_channels)
+        start = time.perf_counter()
+        at.run()
+        first = time.perf_counter() - start
+        populated = sum("detail" in c or "summary" in c for c in at.session_state["channels"].values())
+        rerun = _timeit(at.run, args.repeat)
+        print(f"{n_channels:>3} チャンネル  初回 {first * 1000:8.1f} ms  再実行 {rerun * 1000:8.1f} ms  計算済み {populated}  表 {len(at.dataframe)} 個")
+
+
+def _random_library(n_materials, seed=0):
+    # materials.csv の各行をロットごとに ±5% ばらつかせた材料ライブラリ（名前は「材料名 L00001」）
+    base = pd.read_csv("materials.csv", encoding="cp932", index_col=0).reindex(columns=ELEMENTS).fillna(0.0)
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(base), n_materials)
+    df = pd.DataFrame(base.to_numpy()[rows] * rng.uniform(0.95, 1.05, (n_materials, 1)), columns=ELEMENTS,
+                      index=[f"{base.index[r]} L{k:05d}" for k, r in enumerate(rows)])
+    df["ロット"] = [f"L{k:05d}" for k in range(n_materials)]
+    df["仕入先"] = rng.choice(["A製鉄", "B商事", "C金属"], n_materials)
+    return df
+
+
+def bench_library(args):
+    # 材料ライブラリの作成・検索・選択した材料の成分の取り出し（DataFrame をそのまま使う場合との比較）
+    from material_library import build_library
+
+    print(f"{'材料数':>6} {'作成':>9} {'名前検索':>9} {'(pandas)':>9} {'元素で絞込':>9} {'(pandas)':>9} {'取り出し':>9} {'(pandas)':>9}")
+    for n_materials in args.materials:
+        df = _random_library(n_materials)
+        start = time.perf_counter()
+        library = build_library(df, ELEMENTS)
+        build = time.perf_counter() - start
+        picked = list(df.index[:: max(1, n_materials // 6)][:6])
+        query = "b商事"
+        text = _timeit(lambda: library.search(query), args.repeat)
+        text_pd = _timeit(lambda: df.index[(df.index.str.casefold().str.contains(query, regex=False)
+                                            | df["ロット"].str.casefold().str.contains(query, regex=False)
+                                            | df["仕入先"].str.casefold().str.contains(query, regex=False)).to_numpy()], args.repeat)
+        element = _timeit(lambda: library.search(element="Si", min_pct=70.0), args.repeat)
+        element_pd = _timeit(lambda: df.index[(df["Si"] >= 70.0).to_numpy()], args.repeat)
+        take = _timeit(lambda: library.percent[library.rows(picked)], args.repeat)
+        take_pd = _timeit(lambda: df.loc[picked, ELEMENTS].to_numpy(), args.repeat)
+        ms = [v * 1000 for v in (build, text, text_pd, element, element_pd, take, take_pd)]
+        print(f"{n_materials:>9} " + " ".join(f"{v:9.3f}" for v in ms) + "  (ms)")
+
+
+def bench_select(args):
+    # 材料の自動選択（Ch2 の既定値: C/Si/Mn/P/S/Cr/Cu）をライブラリの大きさを変えて測る
+    urgent = dict(zip(["C", "Si", "Mn", "P", "S", "Cr", "Cu"], [3.67, 1.81, 0.5, 0.08, 0.02, 0.08, 0.15]))
+    urgent_pct = np.array([urgent.get(e, 0.0) for e in ELEMENTS])
+    urgent_pct[-1] = 92.0
+    tol_pct = np.array([0.05 if e in ("C", "Si", "Mn") else 0.01 for e in ELEMENTS])
+    judged = np.array([e in urgent for e in ELEMENTS])
+    upper_only = np.zeros(len(ELEMENTS), dtype=bool)
+    for n_materials in args.materials:
+        A = _random_library(n_materials)[ELEMENTS].to_numpy().T / 100
+        select = lambda: select_materials(A, urgent_pct, 110000.0, tol_pct, upper_only, judged, mass_row=len(ELEMENTS) - 1, time_limit=args.time_limit)
+        result = select()
+        elapsed = _timeit(select, args.repeat)
+        print(f"材料 {n_materials:>6}  候補 {result.n_candidates:>3}  選択 {result.columns.size} 種類  "
+              f"{'○' if result.feasible else '×'}  {result.method:<6} {elapsed * 1000:8.1f} ms")
+
+
+def _random_sparse_composition(n_materials, n_elements, seed=0):
+    # Fe と1〜2元素だけを含む材料（Fe-Si、Fe-Mn、純Ni のような合金鉄・純金属）の成分行列（fraction、CSC）。最後の行が Fe
+    rng = np.random.default_rng(seed)
+    rows, cols, data = [], [], []
+    for j in range(n_materials):
+        fe = rng.uniform(0.2, 0.99)
+        picked = rng.choice(n_elements - 1, rng.integers(1, 3), replace=False)
+        rows.extend(picked.tolist() + [n_elements - 1])
+        cols.extend([j] * (len(picked) + 1))
+        data.extend(((1 - fe) * rng.dirichlet(np.ones(len(picked)))).tolist() + [fe])
+    return sparse.csc_array((data, (rows, cols)), shape=(n_elements, n_materials))
+
+
+def bench_sparse(args):
+    # 成分行列を疎行列で持ったときの容量と、ライブラリ全体を使う計算（自動選択・全材料での配合計算）の時間
+    def nbytes(matrix):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+    print(f"{'材料':>6} {'元素':>4} {'密(KB)':>8} {'疎(KB)':>8} {'取出 密/疎(us)':>15} {'自動選択 密/疎(ms)':>19} "
+          f"{'lstsq':>8} {'bounded':>8} {'lp':>8} (ms)")
+    for n_elements in args.elements:
+        urgent_pct = np.zeros(n_elements)
+        urgent_pct[:5] = [3.6, 1.8, 0.4, 0.03, 0.02]
+        urgent_pct[-1] = 92.0
+        tol_pct = np.full(n_elements, 0.05)
+        judged = np.arange(n_elements) < 5
+        upper_only = np.zeros(n_elements, dtype=bool)
+        for n_materials in args.materials:
+            A_sparse = _random_sparse_composition(n_materials, n_elements)
+            A_dense = A_sparse.toarray()
+            picked = np.linspace(0, n_materials - 1, 6).astype(int).tolist()
+            take_dense = _timeit(lambda: A_dense[:, picked], args.repeat)
+            composition = CompositionMatrix(tuple(range(n_materials)), tuple(range(n_elements)), A_sparse, {j: j for j in range(n_materials)})
+            take_sparse = _timeit(lambda: composition.take(picked), args.repeat)
+            select = lambda A: select_materials(A, urgent_pct, 110000.0, tol_pct, upper_only, judged, mass_row=n_elements - 1)
+            select_dense = _timeit(lambda: select(A_dense), args.repeat)
+            select_sparse = _timeit(lambda: select(A_sparse), args.repeat)
+            selected = np.ones((1, n_materials), dtype=bool)
+            solves = [_timeit(lambda: solve_blend(A_sparse, [urgent_pct], [110000.0], selected, method=method), args.repeat)
+                      for method in ("lstsq", "bounded", "lp")]
+            print(f"{n_materials:>8} {n_elements:>5} {A_dense.nbytes / 1024:9.1f} {nbytes(A_sparse) / 1024:9.1f} "
+                  f"{take_dense * 1e6:8.1f}/{take_sparse * 1e6:<7.1f} {select_dense * 1000:9.1f}/{select_sparse * 1000:<9.1f} "
+                  + " ".join(f"{t * 1000:8.1f}" for t in solves))
+
+
+def bench_plan(args):
+    # 在庫計画（全ヒートを1つの線形計画法）と、ヒートごとに線形計画法で解いた場合の比較。
+    # 在庫は在庫を考慮しない計画の使用量に対して、神鋼SP銑を --stock 倍にする
+    materials_df = pd.read_csv("materials.csv", encoding="cp932", index_col=0)
+    names = ["神鋼SP銑", "鋼屑", "C粉", "Fe-Si", "Fe-Mn"]
+    A = composition_matrix(materials_df, names, ELEMENTS)
+    print(f"{'ヒート':>6} {'ヒートごと(ms)':>14} {'在庫なし(ms)':>12} {'在庫あり(ms)':>12} {'○/ヒート':>10}  神鋼SP銑 使用量/在庫(kg)")
+    for n_heats in args.heats:
+        targets, total_weight_g, selected = _random_heats(n_heats, len(names))
+        tol_pct = np.full(targets.shape, 0.05)
+        judged = np.zeros(targets.shape, dtype=bool)
+        judged[:, :5] = True
+        plan = lambda inventory_g: plan_heats(A, targets, total_weight_g, selected, tol_pct=tol_pct, judged=judged,
+                                              inventory_g=inventory_g, mass_row=len(ELEMENTS) - 1)
+        per_heat = _timeit(lambda: [solve_blend(A, targets[n:n + 1], total_weight_g[n:n + 1], selected[n:n + 1], method="lp")
+                                    for n in range(n_heats)], args.repeat)
+        free = _timeit(lambda: plan(None), args.repeat)
+        inventory_g = np.full(len(names), np.inf)
+        inventory_g[0] = plan(None).weights[:, 0].sum() * args.stock
+        limited = _timeit(lambda: plan(inventory_g), args.repeat)
+        result = plan(inventory_g)
+        n_ok = int(judge_blend(result.achieved_pct(total_weight_g), targets, tol_pct, False, judged).all_ok.sum())
+        print(f"{n_heats:>8} {per_heat * 1000:14.1f} {free * 1000:12.1f} {limited * 1000:12.1f} {n_ok:>5}/{n_heats:<5}  "
+              f"{result.weights[:, 0].sum() / 1000:.1f}/{inventory_g[0] / 1000:.1f}")
+
+
+def _sample_channels():
+    # 5チャンネル分の指示票（添加量は Ch1 の既定値程度）
+    return [{
+        "index": i,
+        "total_weight_kg": 110.0,
+        "remaining_weight_kg": 0.0,
+        "mode": "FCD" if i % 2 == 0 else "FC",
+        "tapping_temp": 1450,
+        "materials": {"神鋼SP銑": 98000.0 + 500 * i, "鋼屑": 8000.0, "C粉": 650.0, "Fe-Si": 2400.0, "Fe-Mn": 310.0},
+        "additives": [("接種剤", 220.0), ("球状化剤", 1320.0)],
+    } for i in range(5)]
+
+
+def bench_pdf(args):
+    import instruction_pdf
+    from reportlab.pdfbase.ttfonts import TTFError, TTFont
+
+    channels = _sample_channels()
+    path = os.path.join(tempfile.mkdtemp(), "指示票.pdf")
+
+    def legacy():
+        # 従来の手順: 毎回フォントファイルを読み直し、スタイルを作り直し、BytesIO に作ってからファイルへ書く
+        for font_name, font_path in instruction_pdf.FONT_CANDIDATES:
+            try:
+                TTFont(font_name, font_path)
+                break
+            except (OSError, TTFError):
+                continue
+        instruction_pdf.pdf_styles.cache_clear()
+        buffer = instruction_pdf.write_instruction_pdf(io.BytesIO(), "ベンチマーク", channels)
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
+
+    font_name = instruction_pdf.register_font()
+    instruction_pdf.write_instruction_pdf(path, "ベンチマーク", channels)
+    after = _timeit(lambda: instruction_pdf.write_instruction_pdf(path, "ベンチマーク", channels), args.repeat)
+    print(f"フォント: {font_name}, チャンネル数: {len(channels)}, PDF {os.path.getsize(path):,} bytes")
+    if font_name not in {name for name, _ in instruction_pdf.FONT_CANDIDATES}:
+        # 日本語フォントがないと従来の手順でもフォントファイルを読まないため、短縮の大部分（フォントの読み直し）が測れない
+        print(f"日本語フォントが見つかりません（{', '.join(p for _, p in instruction_pdf.FONT_CANDIDATES)}）。従来の手順との比較は行いません")
+        print(f"{'フォント・スタイル再利用':<12} 1枚 {after * 1000:8.1f} ms")
+        return
+    before = _timeit(legacy, args.repeat)
+    print(f"{'従来':<12} 1枚 {before * 1000:8.1f} ms")
+    print(f"{'フォント・スタイル再利用':<12} 1枚 {after * 1000:8.1f} ms  短縮 {(before - after) * 1000:.1f} ms")
+
+
+def _base_config():
+    # ベンチマークの元にする保存済みの設定（ストアの最新、なければ saved_configs/*.json のうち設定ファイルのもの）
+    import config_store
+
+    path = config_store.store_path("saved_configs")
+    if os.path.exists(path):
+        with config_store.connect(path) as conn:
+            rows, _ = config_store.search_configs(conn, limit=1)
+            if rows:
+                return config_store.load_config(conn, rows[0]["id"])
+    for path in sorted(glob.glob("saved_configs/*.json")):
+        with open(path, 'r', encoding='utf-8') as f:
+            config_data = json.load(f)
+        if isinstance(config_data, dict) and isinstance(config_data.get("tabs"), dict):
+            return config_data
+    raise SystemExit("保存済みの設定が見つかりません")
+
+
+def bench_store(args):
+    # 1回の保存で1チャンネルの目標値を1つだけ変える運用を想定し、JSONファイル1件ずつの保存とストアを比べる
+    import config_store
+
+    base = _base_config()
+    base["tabs"] = {f"tab_{i}": json.loads(json.dumps(base["tabs"].get("tab_0", {}))) for i in range(5)}
+    rng = np.random.default_rng(0)
+    work_dir = tempfile.mkdtemp()
+    json_dir = os.path.join(work_dir, "json")
+    os.makedirs(json_dir)
+    path = os.path.join(work_dir, "configs.sqlite3")
+    config = base
+    with config_store.connect(path) as conn:
+        for n in range(args.saves):
+            config = json.loads(json.dumps(config))
+            config["timestamp"] = f"2025-01-01T00:00:00.{n:06d}"
+            tab = config["tabs"][f"tab_{rng.integers(5)}"]
+            tab["targets"]["Si"] = round(float(rng.choice([2.2, 2.3, 2.4, 2.5])), 2)
+            with open(os.path.join(json_dir, f"試験_{n:06d}.json"), 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=2)
+            config_store.save_config(conn, f"試験_{n:06d}", config)
+        stats = config_store.storage_stats(conn)
+        ids = [row[0] for row in conn.execute("SELECT id FROM configs ORDER BY random() LIMIT 200")]
+    json_paths = sorted(glob.glob(os.path.join(json_dir, "*.json")))
+    json_bytes = sum(os.path.getsize(p) for p in json_paths)
+
+    def load_json():
+        for p in json_paths[:200]:
+            with open(p, 'r', encoding='utf-8') as f:
+                json.load(f)
+
+    def load_store():
+        with config_store.connect(path) as conn:
+            for config_id in ids:
+                config_store.load_config(conn, config_id)
+
+    print(f"保存数: {args.saves:,}  チャンネル設定: {stats['channel_refs']:,} 件中 {stats['blobs']:,} 件を保存")
+    print(f"{'JSONファイル':<12} {json_bytes:>14,} bytes  読み込み {_timeit(load_json, args.repeat) / 200 * 1e6:8.1f} us/件")
+    print(f"{'ストア':<12} {os.path.getsize(path):>14,} bytes  読み込み {_timeit(load_store, args.repeat) / 200 * 1e6:8.1f} us/件")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="配合計算のベンチマーク")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("solver", help="計算方式ごとの1ヒートあたりの計算時間")
+    p.add_argument("--heats", type=int, default=1000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_solver)
+    p = sub.add_parser("rerun", help="画面全体の再実行時間（全タブ作成と選択中のタブのみの比較）")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--timeout", type=float, default=120)
+    p.set_defaults(func=bench_rerun)
+    p = sub.add_parser("channels", help="チャンネル数ごとの画面全体の再実行時間")
+    p.add_argument("--channels", type=int, nargs="+", default=[5, 30, 60])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--timeout", type=float, default=300)
+    p.set_defaults(func=bench_channels)
+    p = sub.add_parser("library", help="材料ライブラリの作成・検索・取り出しの時間")
+    p.add_argument("--materials", type=int, nargs="+", default=[20, 500, 5000])
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_library)
+    p = sub.add_parser("select", help="材料の自動選択の計算時間（ライブラリの大きさごと）")
+    p.add_argument("--materials", type=int, nargs="+", default=[20, 500, 5000])
+    p.add_argument("--time-limit", type=float, default=0.1)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_select)
+    p = sub.add_parser("sparse", help="疎行列の成分行列の容量と、ライブラリ全体を使う計算の時間")
+    p.add_argument("--materials", type=int, nargs="+", default=[20, 200, 1000, 5000])
+    p.add_argument("--elements", type=int, nargs="+", default=[16, 40])
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_sparse)
+    p = sub.add_parser("plan", help="在庫計画（全ヒートを1つの線形計画法）の計算時間")
+    p.add_argument("--heats", type=int, nargs="+", default=[5, 50, 200])
+    p.add_argument("--stock", type=float, default=0.9)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_plan)
+    p = sub.add_parser("pdf", help="5チャンネル分の指示票PDFの作成時間（従来の手順との比較）")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_pdf)
+    p = sub.add_parser("store", help="保存済み設定の容量と読み込み時間（JSONファイルとストアの比較）")
+    p.add_argument("--saves", type=int, default=10000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_store)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
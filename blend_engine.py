@@ -0,0 +1,701 @@
+# 合金配合計算エンジン（Streamlitに依存しない）
+# app.py の各Chタブはこのモジュールを呼び出すだけにし、
+# 画面外（バッチ処理など）からも同じ計算を N ヒート分まとめて実行できるようにする。
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import Bounds, LinearConstraint, linprog, lsq_linear, milp, nnls
+
+# 計算方式（UIの選択肢）
+SOLVER_METHODS = {
+    "lstsq": "最小二乗法（従来）",
+    "bounded": "有界最小二乗法",
+    "lp": "線形計画法",
+    "cost": "コスト最小化",
+}
+
+
+@dataclass
+class BlendBatchResult:
+    """N ヒート分の配合計算結果（配列の先頭次元がヒート）"""
+    weights: np.ndarray          # (N, M) 至急分析前添加量（g）
+    post_weights: np.ndarray     # (N, M) 至急分析後添加量（g）
+    achieved_g: np.ndarray       # (N, E) 配合計算成分（g）
+    target_g: np.ndarray         # (N, E) 至急分析目標値（g）
+    auto_mask: np.ndarray        # (N, M) 自動配合の対象
+    rank: np.ndarray             # (N,) 自動配合部分の行列ランク
+    n_auto: np.ndarray           # (N,) 自動配合の材料数
+    warm_started: np.ndarray = None  # (N,) 前回解から再計算なしで求まったか（制約付き計算のみ）
+    cost: np.ndarray = None      # (N,) 材料費（コスト最小化のみ、単価×g）
+    window_excess_g: np.ndarray = None  # (N,) 許容範囲からのはみ出しの合計（g、在庫計画のみ）
+
+    @property
+    def rank_deficient(self):
+        return (self.n_auto > 0) & (self.rank < self.n_auto)
+
+    def achieved_pct(self, total_weight_g):
+        total = np.asarray(total_weight_g, dtype=float).reshape(-1, 1)
+        return self.achieved_g / total * 100
+
+
+@dataclass
+class Judgement:
+    """判定結果（配列は shape=(N, E)、N はチャンネルまたはヒート）"""
+    target_pct: np.ndarray       # 至急分析目標値（%）
+    achieved_pct: np.ndarray     # 配合計算成分（%）
+    tol_pct: np.ndarray          # 許容値（%）
+    upper_only: np.ndarray       # 「以下」判定か
+    judged: np.ndarray           # 判定の対象（選択した元素で目標値が0でない）
+    ok: np.ndarray               # 許容範囲内（判定の対象外は False）
+
+    @property
+    def ng(self):
+        return self.judged & ~self.ok
+
+    @property
+    def all_ok(self):
+        """(N,) 判定の対象がすべて許容範囲内か"""
+        return ~self.ng.any(axis=-1)
+
+    def labels(self):
+        """判定行の文字列（○ / × (許容範囲…) / -）。× は NG のセルだけ個別に作る"""
+        labels = np.where(self.judged, "○", "-").astype(object)
+        for idx in zip(*np.nonzero(self.ng)):
+            tol = float(self.tol_pct[idx])
+            if self.upper_only[idx]:
+                labels[idx] = f"× (許容値：{float(self.target_pct[idx]) + tol}以下)"
+            else:
+                labels[idx] = f"× (許容範囲：±{tol})"
+        return labels
+
+
+def composition_matrix(df, names, columns):
+    """DataFrame から成分行列（fraction）を作成する。shape=(元素数, 材料数)"""
+    table = df[~df.index.duplicated()].reindex(index=list(names), columns=list(columns))
+    values = table.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    return np.nan_to_num(values, nan=0.0).T / 100
+
+
+def split_urgent_targets(target_pct, additive_pct, limit_pct=None):
+    """
+    残り必要量（目標値 － 添加材由来）を至急分析目標値と至急分析後添加分に分ける。
+    limit_pct は検量線上限値（上限なしは np.inf）。すべて (..., 元素数) でブロードキャストする。
+    """
+    required = np.maximum(np.asarray(target_pct, dtype=float) - np.asarray(additive_pct, dtype=float), 0.0)
+    if limit_pct is None:
+        return required, np.zeros_like(required)
+    urgent = np.minimum(required, np.asarray(limit_pct, dtype=float))
+    return urgent, required - urgent
+
+
+def additive_contributions_g(B, grams_g):
+    """
+    添加材の元素合計（g）。
+    B: (E, K) 添加材成分行列（fraction）、grams_g: (K,) または全チャンネル分の (N, K) 添加量（g）
+    """
+    return np.asarray(grams_g, dtype=float) @ np.asarray(B, dtype=float).T
+
+
+def increase_pct(A, grams_g, total_weight_g, yield_rate=None):
+    """
+    材料・添加材ごとの成分増加量（%）。shape=(材料数, 元素数)
+    A: (E, M) 成分行列（fraction）、grams_g: (M,) 添加量（g）、yield_rate: (M,) 歩留まり（None は 1.0）
+    """
+    grams = np.asarray(grams_g, dtype=float)
+    if yield_rate is not None:
+        grams = grams * np.asarray(yield_rate, dtype=float)
+    return np.asarray(A, dtype=float).T * grams[:, None] / total_weight_g * 100
+
+
+def _batched_lstsq(A, b, rcond):
+    # np.linalg.lstsq と同じ最小ノルム解を、スタックしたSVDでまとめて求める
+    u, s, vt = np.linalg.svd(A, full_matrices=False)
+    cutoff = rcond * s.max(axis=-1, initial=0.0, keepdims=True)
+    large = s > cutoff
+    s_inv = np.where(large, 1.0 / np.where(large, s, 1.0), 0.0)
+    ub = np.einsum("nek,ne->nk", u, b)
+    x = np.einsum("nkm,nk->nm", vt, s_inv * ub)
+    return x, large.sum(axis=-1)
+
+
+def post_analysis_batch(A, auto_mask, post_pct, total_weight_g):
+    """
+    検量線上限値を超えた分（post_pct）を、その成分を最も多く含む自動配合材料で補う量（g）。
+    A: (N, E, M), auto_mask: (N, M), post_pct: (N, E), total_weight_g: (N,)
+    """
+    content = np.where(auto_mask[:, None, :], A, 0.0)
+    best = content.argmax(axis=-1)
+    best_content = np.take_along_axis(content, best[..., None], axis=-1)[..., 0]
+    need = (post_pct > 0) & (best_content > 0)
+    amount = np.where(need, post_pct / 100 * total_weight_g[:, None] / np.where(need, best_content, 1.0), 0.0)
+    onehot = best[..., None] == np.arange(A.shape[-1])
+    return np.einsum("ne,nem->nm", amount, onehot)
+
+
+def _prepare(A, urgent_pct, total_weight_g, selected, manual_g):
+    # 入力をヒート次元にそろえ、手動指定分を差し引いた必要成分量 b（g）を作る
+    urgent = np.atleast_2d(np.asarray(urgent_pct, dtype=float))
+    n_heats, n_elems = urgent.shape
+    # 疎行列（CompositionMatrix.matrix）を渡されたときは、ヒートごとの計算用に密にする（画面の計算は take で密にした選択列を渡す）
+    A = A.toarray() if sparse.issparse(A) else np.asarray(A, dtype=float)
+    n_mats = A.shape[-1]
+    A = np.broadcast_to(A, (n_heats, n_elems, n_mats))
+    total = np.broadcast_to(np.asarray(total_weight_g, dtype=float), (n_heats,))
+    selected = np.broadcast_to(np.asarray(selected, dtype=bool), (n_heats, n_mats))
+    if manual_g is None:
+        manual_g = 0.0
+    manual = np.where(selected, np.broadcast_to(np.asarray(manual_g, dtype=float), (n_heats, n_mats)), 0.0)
+    auto_mask = selected & ~(manual > 0.0)
+    target_g = urgent / 100 * total[:, None]
+    b = target_g - np.einsum("nem,nm->ne", A, manual)
+    return A, total, manual, auto_mask, target_g, b
+
+
+def _finish(A, total, weights, auto_mask, target_g, post_pct, rank, **extra):
+    if post_pct is None:
+        post_weights = np.zeros_like(weights)
+    else:
+        post = np.broadcast_to(np.asarray(post_pct, dtype=float), target_g.shape)
+        post_weights = post_analysis_batch(A, auto_mask, post, total)
+
+    # 1e-3g以下は0として扱う
+    masked = np.where(weights > 1e-3, weights, 0.0)
+    achieved_g = np.einsum("nem,nm->ne", A, masked)
+    return BlendBatchResult(
+        weights=weights,
+        post_weights=post_weights,
+        achieved_g=achieved_g,
+        target_g=target_g,
+        auto_mask=auto_mask,
+        rank=rank,
+        n_auto=auto_mask.sum(axis=-1),
+        **extra,
+    )
+
+
+def solve_blend_batch(A, urgent_pct, total_weight_g, selected, manual_g=None, post_pct=None, rcond=1e-10):
+    """
+    N ヒート分の材料配合をまとめて計算する（ヒートごとのPythonループなし）。
+
+    A: (E, M) または (N, E, M) 材料成分行列（fraction）。(E, M) は疎行列も可
+    urgent_pct: (N, E) 至急分析目標値（%）
+    total_weight_g: (N,) 溶解重量（g）
+    selected: (N, M) 使用する材料
+    manual_g: (N, M) 手動指定量（g）。0 の材料は自動配合
+    post_pct: (N, E) 至急分析後に追加する成分（%）
+    """
+    A, total, manual, auto_mask, target_g, b = _prepare(A, urgent_pct, total_weight_g, selected, manual_g)
+
+    # 自動配合の列だけを残した行列で最小二乗法を解き、負の値を0にクリップ
+    x, rank = _batched_lstsq(A * auto_mask[:, None, :], b, rcond)
+    weights = np.where(auto_mask, np.maximum(x, 0.0), manual)
+    return _finish(A, total, weights, auto_mask, target_g, post_pct, rank)
+
+
+def _active_set_warm_start(A, b, lb, ub, x0):
+    # 前回解の有効制約（上下限に張り付いた材料）をそのまま使い、残りを1回の最小二乗で解く。
+    # KKT条件を満たせばそれが最適解なので、lsq_linear の反復を省略できる。
+    scale = max(1.0, float(np.abs(A.T @ b).max(initial=0.0)))
+    tol = 1e-9 * max(1.0, float(np.abs(x0).max(initial=0.0)))
+    at_lb = x0 <= lb + tol
+    at_ub = ~at_lb & (x0 >= ub - tol)
+    free = ~(at_lb | at_ub)
+    if free.all():
+        # 有効制約がなければ lsq_linear も最初の最小二乗解で終わるので引き継ぐものがない
+        return None
+    x = np.where(at_lb, lb, np.where(at_ub, ub, x0))
+    if free.any():
+        rest = b - A[:, ~free] @ x[~free]
+        x_free = np.linalg.lstsq(A[:, free], rest, rcond=None)[0]
+        if np.any(x_free < lb[free] - tol) or np.any(x_free > ub[free] + tol):
+            return None
+        x[free] = x_free
+    grad = A.T @ (A @ x - b)
+    if np.any(grad[at_lb] < -1e-9 * scale) or np.any(grad[at_ub] > 1e-9 * scale):
+        return None
+    return x
+
+
+def _bounded_solve(A, b, lb, ub, capacity, x0):
+    if x0 is not None:
+        x = _active_set_warm_start(A, b, lb, ub, np.clip(x0, lb, ub))
+        if x is not None and x.sum() <= capacity * (1 + 1e-9):
+            return x, True
+    x = lsq_linear(A, b, bounds=(lb, ub), method="bvls").x
+    if x.sum() > capacity:
+        # 容量制約は凸問題なので、違反していれば最適解では等号で効いている。重み付きの行で等号を課して解き直す
+        w = 1e3 * max(1.0, float(np.abs(A).max(initial=0.0)))
+        A_cap = np.vstack([A, np.full((1, A.shape[1]), w)])
+        b_cap = np.append(b, w * capacity)
+        x = lsq_linear(A_cap, b_cap, bounds=(lb, ub), method="bvls").x
+    return x, False
+
+
+def _lp_solve(A, b, lb, ub, capacity):
+    # 偏差 |A x - b| の合計（g）を最小化する L1 フィット: 変数 [x, p, q], A x - p + q = b
+    # 制約行列は疎行列で組み立てる（成分行列の0と単位行列の非対角要素を持たない）
+    n_elems, n_auto = A.shape
+    c = np.concatenate([np.zeros(n_auto), np.ones(2 * n_elems)])
+    eye = sparse.identity(n_elems, format="csr")
+    A_eq = sparse.hstack([sparse.csr_array(A), -eye, eye], format="csr")
+    A_ub = b_ub = None
+    if np.isfinite(capacity):
+        A_ub = sparse.csr_array(np.concatenate([np.ones(n_auto), np.zeros(2 * n_elems)])[None, :])
+        b_ub = [capacity]
+    bounds = [(lo, None if np.isinf(hi) else hi) for lo, hi in zip(lb, ub)] + [(0, None)] * (2 * n_elems)
+    res = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b, bounds=bounds, method="highs")
+    if res.status != 0:
+        raise ValueError(f"線形計画法で解が得られませんでした: {res.message}")
+    return res.x[:n_auto]
+
+
+def solve_blend_constrained(A, urgent_pct, total_weight_g, selected, manual_g=None, post_pct=None,
+                            method="bounded", lower_g=None, upper_g=None, capacity_g=None, warm_start=None):
+    """
+    制約付きで材料配合を計算する。
+
+    method: "bounded"（有界最小二乗法 lsq_linear）または "lp"（偏差の合計を最小化する線形計画法 linprog）
+    lower_g / upper_g: (N, M) 材料ごとの装入量の下限・上限（g）。既定は 0 / 上限なし
+    capacity_g: (N,) 材料の装入量合計の上限（g）。手動指定分を含む
+    warm_start: (N, M) 前回の解。有界最小二乗法では有効制約を引き継いで反復を省略する
+    """
+    A, total, manual, auto_mask, target_g, b = _prepare(A, urgent_pct, total_weight_g, selected, manual_g)
+    n_heats, n_mats = auto_mask.shape
+    lower = np.broadcast_to(np.asarray(0.0 if lower_g is None else lower_g, dtype=float), (n_heats, n_mats))
+    upper = np.broadcast_to(np.asarray(np.inf if upper_g is None else upper_g, dtype=float), (n_heats, n_mats))
+    capacity = np.broadcast_to(np.asarray(np.inf if capacity_g is None else capacity_g, dtype=float), (n_heats,))
+    remaining = capacity - manual.sum(axis=-1)
+
+    if warm_start is not None:
+        warm_start = np.broadcast_to(np.asarray(warm_start, dtype=float), (n_heats, n_mats))
+    weights = manual.copy()
+    warm_started = np.zeros(n_heats, dtype=bool)
+    for n in range(n_heats):
+        idx = np.flatnonzero(auto_mask[n])
+        if idx.size == 0:
+            continue
+        lb = np.maximum(lower[n, idx], 0.0)
+        ub = np.maximum(np.minimum(upper[n, idx], max(remaining[n], 0.0)), lb)
+        A_auto = A[n][:, idx]
+        if method == "lp":
+            x = _lp_solve(A_auto, b[n], lb, ub, remaining[n])
+        else:
+            x0 = None if warm_start is None else warm_start[n, idx]
+            x, warm_started[n] = _bounded_solve(A_auto, b[n], lb, ub, remaining[n], x0)
+        weights[n, idx] = x
+    return _finish(A, total, weights, auto_mask, target_g, post_pct, auto_mask.sum(axis=-1), warm_started=warm_started)
+
+
+def solve_blend_two_stage(A, urgent_pct, total_weight_g, selected, manual_g=None, post_pct=None, limit_pct=None,
+                          lower_g=None, upper_g=None, capacity_g=None):
+    """
+    至急分析前（x）と至急分析後（y）の添加量を1つの線形計画法でまとめて計算する。
+
+    偏差 |A x - 至急分析目標値| と |A (x + y) - (至急分析目標値 + post_pct)| の合計（g）を最小化し、
+    至急分析前の成分は検量線上限値 limit_pct（(N, E)、上限なしは np.inf）以下を制約にする。
+    post_analysis_batch と違い、至急分析後の添加による他の元素の増加も含めて y を決める。
+    lower_g / upper_g: (N, M) 至急分析前の装入量の下限・上限（g）。上限は x + y にも課す
+    capacity_g: (N,) 材料の装入量合計（至急分析前後の合計、手動指定分を含む）の上限（g）
+    """
+    A, total, manual, auto_mask, target_g, b = _prepare(A, urgent_pct, total_weight_g, selected, manual_g)
+    n_heats, n_elems, n_mats = A.shape
+    post = np.zeros((n_heats, n_elems)) if post_pct is None else np.broadcast_to(np.asarray(post_pct, dtype=float), (n_heats, n_elems))
+    limit = np.broadcast_to(np.asarray(np.inf if limit_pct is None else limit_pct, dtype=float), (n_heats, n_elems))
+    lower = np.broadcast_to(np.asarray(0.0 if lower_g is None else lower_g, dtype=float), (n_heats, n_mats))
+    upper = np.broadcast_to(np.asarray(np.inf if upper_g is None else upper_g, dtype=float), (n_heats, n_mats))
+    capacity = np.broadcast_to(np.asarray(np.inf if capacity_g is None else capacity_g, dtype=float), (n_heats,))
+    b_final = b + post / 100 * total[:, None]
+    # 至急分析前の上限（g）から手動指定分を差し引く
+    ceiling = limit / 100 * total[:, None] - (target_g - b)
+
+    weights = manual.copy()
+    post_weights = np.zeros_like(weights)
+    for n in range(n_heats):
+        idx = np.flatnonzero(auto_mask[n])
+        if idx.size == 0:
+            continue
+        k = idx.size
+        A_auto = sparse.csr_array(A[n][:, idx])
+        eye = sparse.identity(n_elems, format="csr")
+        # 変数 [x, y, p1, q1, p2, q2]: A x - p1 + q1 = b, A x + A y - p2 + q2 = b_final
+        A_eq = sparse.block_array([
+            [A_auto, None, -eye, eye, None, None],
+            [A_auto, A_auto, None, None, -eye, eye],
+        ], format="csr")
+        b_eq = np.concatenate([b[n], b_final[n]])
+        # 至急分析後の添加量が少ない解を優先する（偏差1gに対して十分小さい重み）
+        c = np.concatenate([np.zeros(k), np.full(k, 1e-6), np.ones(4 * n_elems)])
+        rows = np.flatnonzero(np.isfinite(ceiling[n]))
+        blocks = [sparse.hstack([A_auto[rows], sparse.csr_array((rows.size, k + 4 * n_elems))])]
+        b_ub = [ceiling[n, rows]]
+        cols = np.flatnonzero(np.isfinite(upper[n, idx]))
+        if cols.size:
+            # x + y ≤ 上限
+            pick = sparse.csr_array((np.ones(cols.size), (np.arange(cols.size), cols)), shape=(cols.size, k))
+            blocks.append(sparse.hstack([pick, pick, sparse.csr_array((cols.size, 4 * n_elems))]))
+            b_ub.append(upper[n, idx[cols]])
+        if np.isfinite(capacity[n]):
+            blocks.append(sparse.csr_array(np.concatenate([np.ones(2 * k), np.zeros(4 * n_elems)])[None, :]))
+            b_ub.append([capacity[n] - manual[n].sum()])
+        lb = np.maximum(lower[n, idx], 0.0)
+        bounds = [(lo, None if np.isinf(hi) else hi) for lo, hi in zip(lb, np.maximum(upper[n, idx], lb))]
+        bounds += [(0, None)] * (k + 4 * n_elems)
+        res = linprog(c, A_ub=sparse.vstack(blocks, format="csr"), b_ub=np.concatenate(b_ub), A_eq=A_eq, b_eq=b_eq,
+                      bounds=bounds, method="highs")
+        if res.status != 0:
+            raise ValueError(f"検量線上限値を満たす配合が見つかりませんでした: {res.message}")
+        weights[n, idx] = res.x[:k]
+        post_weights[n, idx] = res.x[k:2 * k]
+    result = _finish(A, total, weights, auto_mask, target_g, None, auto_mask.sum(axis=-1))
+    result.post_weights = post_weights
+    return result
+
+
+def tolerance_window(urgent_pct, tol_pct, upper_only):
+    """判定と同じ許容範囲（%）。±は 目標値±許容値、以下は 0〜目標値＋許容値"""
+    urgent = np.asarray(urgent_pct, dtype=float)
+    tol = np.asarray(tol_pct, dtype=float)
+    lo = np.where(upper_only, 0.0, np.maximum(urgent - tol, 0.0))
+    return lo, urgent + tol
+
+
+def judge_blend(achieved_pct, target_pct, tol_pct, upper_only, selected):
+    """
+    配合計算成分を判定する（全元素・全チャンネル分をまとめて計算）。
+    ±は |配合計算成分－目標値| <= 許容値、以下は 配合計算成分 <= 目標値＋許容値。
+    selected: (N, E) 判定する元素（目標値が0の元素は対象外）
+    """
+    achieved = np.asarray(achieved_pct, dtype=float)
+    target = np.asarray(target_pct, dtype=float)
+    shape = np.broadcast_shapes(np.atleast_2d(achieved).shape, np.atleast_2d(target).shape)
+    achieved = np.broadcast_to(achieved, shape)
+    target = np.broadcast_to(target, shape)
+    tol = np.broadcast_to(np.asarray(tol_pct, dtype=float), target.shape)
+    upper_only = np.broadcast_to(np.asarray(upper_only, dtype=bool), target.shape)
+    judged = np.broadcast_to(np.asarray(selected, dtype=bool), target.shape) & (target != 0.0)
+    within = np.where(upper_only, achieved <= target + tol, np.abs(achieved - target) <= tol)
+    return Judgement(target, achieved, tol, upper_only, judged, judged & within)
+
+
+def scatter_pass_rate(A, weights_g, total_weight_g, target_pct, tol_pct, upper_only, selected, rel_sd,
+                      n_samples=20000, seed=0, chunk=5000):
+    """
+    材料成分のばらつきに対する判定の合格確率（モンテカルロ法）。
+    材料・元素ごとに独立に 成分＝公称値×(1＋rel_sd×標準正規乱数)（負は0）とし、配合量は固定のまま判定する。
+    A: (E, M) 公称の成分行列（fraction）、weights_g: (M,) 配合量（g）、rel_sd: (E,) 元素ごとまたは (E, M) の相対標準偏差
+    target_pct / tol_pct / upper_only / selected: (E,) 判定の条件（judge_blend と同じ）
+    戻り値: (元素ごとの合格確率 (E,)、判定の対象外は NaN, すべての元素が合格する確率)
+    """
+    A = np.asarray(A, dtype=float)
+    weights = np.asarray(weights_g, dtype=float)
+    weights = np.where(weights > 1e-3, weights, 0.0)
+    sd = np.asarray(rel_sd, dtype=float)
+    if sd.ndim == 1:
+        sd = sd[:, None]
+    sd = np.broadcast_to(sd, A.shape)
+    rng = np.random.default_rng(seed)
+    passed = np.zeros(A.shape[0])
+    all_passed = 0
+    judged = None
+    for start in range(0, n_samples, chunk):
+        n = min(chunk, n_samples - start)
+        samples = A * (1.0 + sd * rng.standard_normal((n,) + A.shape))
+        np.maximum(samples, 0.0, out=samples)
+        achieved_pct = samples @ weights / total_weight_g * 100
+        judgement = judge_blend(achieved_pct, target_pct, tol_pct, upper_only, selected)
+        passed += judgement.ok.sum(axis=0)
+        all_passed += int(judgement.all_ok.sum())
+        judged = judgement.judged[0]
+    return np.where(judged, passed / n_samples, np.nan), all_passed / n_samples
+
+
+def solve_blend_cost(A, urgent_pct, total_weight_g, selected, manual_g=None, post_pct=None, price=None,
+                     tol_pct=0.0, upper_only=False, constrained=True, lower_g=None, upper_g=None, charge_g=None):
+    """
+    許容範囲を制約として材料費を最小化する（線形計画法、制約行列は疎行列）。
+
+    price: (M,) 材料の単価（1gあたり）。自動配合する材料はすべて必要
+    tol_pct / upper_only / constrained: (N, E) 許容値、「以下」判定か、制約に含める元素か
+    charge_g: (N,) 材料の装入量合計（g）。手動指定分を含む。指定すると等式制約になる
+    """
+    A, total, manual, auto_mask, target_g, b = _prepare(A, urgent_pct, total_weight_g, selected, manual_g)
+    n_heats, n_elems, n_mats = A.shape
+    price = np.asarray(price, dtype=float)
+    missing = auto_mask & np.isnan(price)[None, :]
+    if missing.any():
+        raise ValueError(f"単価が設定されていない材料があります（材料番号: {sorted(set(np.nonzero(missing)[1].tolist()))}）")
+    lo_pct, hi_pct = tolerance_window(target_g / total[:, None] * 100, tol_pct, upper_only)
+    constrained = np.broadcast_to(np.asarray(constrained, dtype=bool), (n_heats, n_elems))
+    lower = np.broadcast_to(np.asarray(0.0 if lower_g is None else lower_g, dtype=float), (n_heats, n_mats))
+    upper = np.broadcast_to(np.asarray(np.inf if upper_g is None else upper_g, dtype=float), (n_heats, n_mats))
+    charge = None if charge_g is None else np.broadcast_to(np.asarray(charge_g, dtype=float), (n_heats,))
+    manual_g_elem = target_g - b
+
+    weights = manual.copy()
+    cost = (np.nan_to_num(price)[None, :] * manual).sum(axis=-1)
+    for n in range(n_heats):
+        idx = np.flatnonzero(auto_mask[n])
+        rows = np.flatnonzero(constrained[n])
+        if idx.size == 0:
+            continue
+        # 成分 lo ≤ A x + 手動分 ≤ hi を A_ub x ≤ b_ub の2本にする（0要素は持たない）
+        A_rows = sparse.csr_array(A[n][np.ix_(rows, idx)])
+        A_ub = sparse.vstack([A_rows, -A_rows], format="csr")
+        b_ub = np.concatenate([
+            hi_pct[n, rows] / 100 * total[n] - manual_g_elem[n, rows],
+            manual_g_elem[n, rows] - lo_pct[n, rows] / 100 * total[n],
+        ])
+        A_eq = b_eq = None
+        if charge is not None:
+            A_eq = sparse.csr_array(np.ones((1, idx.size)))
+            b_eq = [charge[n] - manual[n].sum()]
+        bounds = np.column_stack([np.maximum(lower[n, idx], 0.0), upper[n, idx]])
+        bounds = [(lo, None if np.isinf(hi) else hi) for lo, hi in bounds]
+        res = linprog(price[idx], A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method="highs")
+        if res.status != 0:
+            raise ValueError(f"許容範囲内に収まる配合が見つかりませんでした: {res.message}")
+        weights[n, idx] = res.x
+        cost[n] += res.fun
+    return _finish(A, total, weights, auto_mask, target_g, post_pct, auto_mask.sum(axis=-1), cost=cost)
+
+
+def solve_blend(A, urgent_pct, total_weight_g, selected, manual_g=None, post_pct=None, method="lstsq", **kwargs):
+    """method に応じて solve_blend_batch / solve_blend_constrained / solve_blend_cost を呼び分ける"""
+    if method == "lstsq":
+        return solve_blend_batch(A, urgent_pct, total_weight_g, selected, manual_g, post_pct)
+    if method == "cost":
+        return solve_blend_cost(A, urgent_pct, total_weight_g, selected, manual_g, post_pct, **kwargs)
+    return solve_blend_constrained(A, urgent_pct, total_weight_g, selected, manual_g, post_pct, method=method, **kwargs)
+
+
+def plan_heats(A, urgent_pct, total_weight_g, selected, manual_g=None, tol_pct=0.0, upper_only=False, judged=True,
+               inventory_g=None, lower_g=None, upper_g=None, capacity_g=None, mass_row=None, mass_tol_pct=1.0, penalty=1e3):
+    """
+    材料の在庫を考慮して N ヒート分の配合を1つの線形計画法でまとめて計算する（在庫計画）。
+
+    各ヒートは solve_blend_constrained(method="lp") と同じく偏差 |A x - b| の合計（g）を最小化し、
+    判定の対象（judged、目標値が0の元素は対象外）と Fe（mass_row、至急分析目標値±mass_tol_pct）の許容範囲を制約にする。
+    材料ごとの全ヒートの装入量の合計（手動指定分を含む）は inventory_g（(M,)、np.inf は在庫を考慮しない）以下。
+    lower_g / upper_g: (N, M) 材料ごとの装入量の下限・上限（g）、capacity_g: (N,) 装入量合計の上限（g、手動指定分を含む）。
+    solve_blend_constrained と同じく各ヒートの制約にする（下限と在庫が両立しなければ解が得られない）。
+    在庫が足りずに許容範囲に入らないヒートがあっても解が得られるように、許容範囲からのはみ出し（g）に penalty を掛けて最小化する。
+    制約行列はヒートごとのブロックと在庫の行を並べた疎行列で、ヒート数が増えても1回の linprog で解く
+    """
+    A, total, manual, auto_mask, target_g, b = _prepare(A, urgent_pct, total_weight_g, selected, manual_g)
+    n_heats, n_elems, n_mats = A.shape
+    lo_pct, hi_pct = tolerance_window(target_g / total[:, None] * 100, np.broadcast_to(tol_pct, target_g.shape), upper_only)
+    window = np.broadcast_to(np.asarray(judged, dtype=bool), (n_heats, n_elems)) & (target_g != 0.0)
+    if mass_row is not None:
+        window = window.copy()
+        window[:, mass_row] = True
+        mass_pct = target_g[:, mass_row] / total * 100
+        lo_pct[:, mass_row] = np.maximum(mass_pct - mass_tol_pct, 0.0)
+        hi_pct[:, mass_row] = mass_pct + mass_tol_pct
+    # 許容範囲の端の解が丸め誤差で判定（judge_blend）に落ちないように、範囲を 1e-6%（110kgで約0.001g）だけ狭める
+    lo_pct = np.minimum(lo_pct + 1e-6, target_g / total[:, None] * 100)
+    hi_pct = np.maximum(hi_pct - 1e-6, target_g / total[:, None] * 100)
+    manual_g_elem = target_g - b
+    lo_g = lo_pct / 100 * total[:, None] - manual_g_elem
+    hi_g = hi_pct / 100 * total[:, None] - manual_g_elem
+    inventory = np.broadcast_to(np.asarray(np.inf if inventory_g is None else inventory_g, dtype=float), (n_mats,))
+    stocked = np.flatnonzero(np.isfinite(inventory))
+    stock_row = np.full(n_mats, -1)
+    stock_row[stocked] = np.arange(stocked.size)
+    lower = np.broadcast_to(np.asarray(0.0 if lower_g is None else lower_g, dtype=float), (n_heats, n_mats))
+    upper = np.broadcast_to(np.asarray(np.inf if upper_g is None else upper_g, dtype=float), (n_heats, n_mats))
+    remaining = np.broadcast_to(np.asarray(np.inf if capacity_g is None else capacity_g, dtype=float), (n_heats,)) - manual.sum(axis=-1)
+
+    # ヒートごとの変数 [x, p, q, s_lo, s_hi]: A x - p + q = b（偏差）、lo - s_lo ≤ A x ≤ hi + s_hi（許容範囲の行のみ）
+    # 0要素を持たないように、行・列・値の組（COO）で全ヒート分を組み立てる
+    eq, ub, stock = ([], [], []), ([], [], []), ([], [], [])
+    b_ub, c, blocks, lb, hb = [], [], [], [], []
+    offset = ub_row = 0
+    for n in range(n_heats):
+        idx = np.flatnonzero(auto_mask[n])
+        rows = np.flatnonzero(window[n])
+        k, r = idx.size, rows.size
+        A_auto = A[n][:, idx]
+        i, j = np.nonzero(A_auto)
+        eq[0].extend([n * n_elems + i, n * n_elems + np.arange(n_elems), n * n_elems + np.arange(n_elems)])
+        eq[1].extend([offset + j, offset + k + np.arange(n_elems), offset + k + n_elems + np.arange(n_elems)])
+        eq[2].extend([A_auto[i, j], -np.ones(n_elems), np.ones(n_elems)])
+        s_lo = offset + k + 2 * n_elems
+        s_hi = s_lo + r
+        i, j = np.nonzero(A_auto[rows])
+        vals = A_auto[rows][i, j]
+        ub[0].extend([ub_row + i, ub_row + np.arange(r), ub_row + r + i, ub_row + r + np.arange(r)])
+        ub[1].extend([offset + j, s_hi + np.arange(r), offset + j, s_lo + np.arange(r)])
+        ub[2].extend([vals, -np.ones(r), -vals, -np.ones(r)])
+        b_ub.extend([hi_g[n, rows], -lo_g[n, rows]])
+        ub_row += 2 * r
+        if np.isfinite(remaining[n]):
+            # 装入量合計の上限（手動指定分を引いた残り）
+            ub[0].append(np.full(k, ub_row))
+            ub[1].append(offset + np.arange(k))
+            ub[2].append(np.ones(k))
+            b_ub.append([max(remaining[n], 0.0)])
+            ub_row += 1
+        x_lb = np.maximum(lower[n, idx], 0.0)
+        lb.extend([x_lb, np.zeros(2 * n_elems + 2 * r)])
+        hb.extend([np.maximum(np.minimum(upper[n, idx], max(remaining[n], 0.0)), x_lb), np.full(2 * n_elems + 2 * r, np.inf)])
+        limited = stock_row[idx] >= 0
+        stock[0].append(stock_row[idx][limited])
+        stock[1].append(offset + np.flatnonzero(limited))
+        stock[2].append(np.ones(int(limited.sum())))
+        c.extend([np.zeros(k), np.ones(2 * n_elems), np.full(2 * r, penalty)])
+        blocks.append((idx, offset, s_lo, r))
+        offset = s_hi + r
+
+    def assemble(triplets, n_rows):
+        rows, cols, vals = (np.concatenate(t) if t else np.zeros(0) for t in triplets)
+        return sparse.csr_array((vals, (rows.astype(np.intp), cols.astype(np.intp))), shape=(n_rows, offset))
+
+    A_eq = assemble(eq, n_heats * n_elems)
+    A_ub = sparse.vstack([assemble(ub, ub_row), assemble(stock, stocked.size)], format="csr")
+    b_ub.append(np.maximum(inventory[stocked] - manual[:, stocked].sum(axis=0), 0.0))
+    res = linprog(np.concatenate(c), A_ub=A_ub, b_ub=np.concatenate(b_ub), A_eq=A_eq, b_eq=b.ravel(),
+                  bounds=np.column_stack([np.concatenate(lb), np.concatenate(hb)]), method="highs")
+    if res.status != 0:
+        raise ValueError(f"在庫計画の線形計画法で解が得られませんでした: {res.message}")
+
+    weights = manual.copy()
+    excess = np.zeros(n_heats)
+    for n, (idx, start, s_lo, r) in enumerate(blocks):
+        weights[n, idx] = res.x[start:start + idx.size]
+        excess[n] = res.x[s_lo:s_lo + 2 * r].sum()
+    return _finish(A, total, weights, auto_mask, target_g, None, auto_mask.sum(axis=-1), window_excess_g=excess)
+
+
+@dataclass
+class MaterialSelection:
+    """材料の自動選択の結果"""
+    columns: np.ndarray          # 選んだ材料の列番号（A の列、昇順）
+    weights_g: np.ndarray        # 選んだ材料の装入量（g）
+    feasible: bool               # 判定の対象と Fe がすべて許容範囲内に入る配合か
+    method: str                  # "milp"（混合整数計画法）または "greedy"（貪欲法）
+    n_candidates: int            # 絞り込んだ候補の材料数
+    elapsed: float               # 計算時間（秒）
+
+
+def rank_candidates(A, need, per_element=4):
+    """
+    元素ごとに1gあたりの供給量 A[e, j] が大きい材料を per_element 件ずつ選んだ候補（列番号、昇順）。
+    A は密行列または疎行列（疎行列では各元素を含む材料の非ゼロ要素だけを見る）。
+    need: (E,) 供給が必要な元素。ライブラリ全体ではなく候補だけを組合せの探索に使う
+    """
+    A = sparse.csr_array(A)
+    top = []
+    for e in np.flatnonzero(need):
+        start, end = A.indptr[e], A.indptr[e + 1]
+        data, cols = A.data[start:end], A.indices[start:end]
+        positive = data > 0
+        data, cols = data[positive], cols[positive]
+        if data.size > per_element:
+            keep = np.argpartition(-data, per_element - 1)[:per_element]
+            data, cols = data[keep], cols[keep]
+        top.append(cols)
+    return np.unique(np.concatenate(top)).astype(np.intp) if top else np.zeros(0, dtype=np.intp)
+
+
+def _relaxed_support(A, lo, hi):
+    # 許容範囲の制約だけの線形計画法（装入量の合計を最小化）の解で使われる材料。
+    # 基底解なので材料数は制約の数以下になり、含有率の順位だけでは選ばれない母材（銑鉄など）も候補に入る
+    A = sparse.csr_array(A)
+    res = linprog(np.ones(A.shape[1]), A_ub=sparse.vstack([A, -A], format="csr"),
+                  b_ub=np.concatenate([hi, -lo]), bounds=(0, None), method="highs")
+    return np.zeros(0, dtype=np.intp) if res.status != 0 else np.flatnonzero(res.x > 1e-6)
+
+
+def _selection_window(urgent_pct, tol_pct, upper_only, judged, mass_row, mass_tol_pct):
+    # 判定と同じ許容範囲（%）。Fe（mass_row）は溶解重量を合わせるために ±mass_tol_pct を課す
+    lo, hi = tolerance_window(urgent_pct, tol_pct, upper_only)
+    rows = np.asarray(judged, dtype=bool).copy()
+    if mass_row is not None:
+        rows[mass_row] = True
+        lo[mass_row] = max(urgent_pct[mass_row] - mass_tol_pct, 0.0)
+        hi[mass_row] = urgent_pct[mass_row] + mass_tol_pct
+    return np.flatnonzero(rows), lo, hi
+
+
+def _greedy_select(A, target, lo, hi, max_materials, deadline):
+    # 許容範囲の幅で正規化した非負最小二乗法の残差が最も小さくなる材料を1つずつ加える
+    scale = 2.0 / np.maximum(hi - lo, 1e-9)
+    A_scaled = A * scale[:, None]
+    b_scaled = target * scale
+    chosen, x = [], np.zeros(0)
+    while len(chosen) < min(max_materials, A.shape[1]):
+        best = None
+        for j in range(A.shape[1]):
+            if j in chosen:
+                continue
+            cols = chosen + [j]
+            xj, residual = nnls(A_scaled[:, cols], b_scaled)
+            if best is None or residual < best[0]:
+                best = (residual, cols, xj)
+        _, chosen, x = best
+        achieved = A[:, chosen] @ x
+        if np.all((achieved >= lo - 1e-9) & (achieved <= hi + 1e-9)) or time.perf_counter() > deadline:
+            break
+    return np.array(chosen, dtype=np.intp), x
+
+
+def select_materials(A, urgent_pct, total_weight_g, tol_pct, upper_only, judged, mass_row=None,
+                     mass_tol_pct=1.0, max_materials=8, per_element=4, time_limit=0.1):
+    """
+    目標成分を許容範囲内に入れられる最も少ない材料の組を材料ライブラリ全体から選ぶ（1ヒート分）。
+
+    A: (E, M) 成分行列（fraction、歩留まり込み）。M はライブラリの全材料で、疎行列（CompositionMatrix.matrix）のまま渡せる
+    urgent_pct: (E,) 材料で満たす成分（%、至急分析目標値）
+    tol_pct / upper_only / judged: (E,) 許容値、「以下」判定か、判定の対象か
+    mass_row: Fe の行。至急分析目標値±mass_tol_pct に入れて装入量の合計を溶解重量に合わせる
+    元素ごとの供給量と線形計画法の緩和解で候補を絞り、材料数を最小化する混合整数計画法を time_limit 秒で解く。
+    時間内に解が得られなければ貪欲法（1つずつ加える）の結果を返す
+    """
+    start = time.perf_counter()
+    # ライブラリ全体は疎行列のまま扱い、密にするのは絞り込んだ候補の列だけ
+    A = sparse.csr_array(A, dtype=float)
+    urgent_pct = np.asarray(urgent_pct, dtype=float)
+    total = float(total_weight_g)
+    rows, lo_pct, hi_pct = _selection_window(urgent_pct, np.asarray(tol_pct, dtype=float), upper_only, judged, mass_row, mass_tol_pct)
+    need = np.zeros(len(urgent_pct), dtype=bool)
+    need[rows] = urgent_pct[rows] > 0
+    target = urgent_pct[rows] / 100 * total
+    lo = lo_pct[rows] / 100 * total
+    hi = hi_pct[rows] / 100 * total
+    A_rows = A[rows]
+    candidates = np.union1d(rank_candidates(A, need, per_element), _relaxed_support(A_rows, lo, hi)).astype(np.intp)
+    A_c = A_rows[:, candidates].toarray()
+    n_rows, k = A_c.shape
+
+    def finish(cols, x, method):
+        achieved = A_c[:, cols] @ x
+        feasible = bool(np.all((achieved >= lo - 1e-6) & (achieved <= hi + 1e-6)))
+        order = np.argsort(candidates[cols])
+        return MaterialSelection(candidates[cols][order], x[order], feasible, method, k, time.perf_counter() - start)
+
+    if k == 0:
+        return finish(np.zeros(0, dtype=np.intp), np.zeros(0), "greedy")
+    # 変数 [x (g), z (使うか), p, q]: lo ≤ A x ≤ hi, A x - p + q = 目標値, x ≤ 溶解重量 × z
+    # 目的は材料数、同数なら目標値からの偏差の合計が小さいもの（偏差の重みは材料1つより十分小さい）
+    eye_k = sparse.identity(k, format="csr")
+    eye_e = sparse.identity(n_rows, format="csr")
+    A_sp = sparse.csr_array(A_c)
+    constraints = [
+        LinearConstraint(sparse.hstack([A_sp, sparse.csr_array((n_rows, k + 2 * n_rows))], format="csr"), lo, hi),
+        LinearConstraint(sparse.hstack([A_sp, sparse.csr_array((n_rows, k)), -eye_e, eye_e], format="csr"), target, target),
+        LinearConstraint(sparse.hstack([eye_k, -total * eye_k, sparse.csr_array((k, 2 * n_rows))], format="csr"), -np.inf, 0.0),
+        LinearConstraint(sparse.hstack([sparse.csr_array((1, k)), sparse.csr_array(np.ones((1, k))), sparse.csr_array((1, 2 * n_rows))], format="csr"), 0, max_materials),
+    ]
+    c = np.concatenate([np.zeros(k), np.ones(k), np.full(2 * n_rows, 0.1 / total)])
+    integrality = np.concatenate([np.zeros(k), np.ones(k), np.zeros(2 * n_rows)])
+    upper = np.concatenate([np.full(k, total), np.ones(k), np.full(2 * n_rows, np.inf)])
+    res = milp(c, constraints=constraints, integrality=integrality, bounds=Bounds(0, upper),
+               options={"time_limit": max(time_limit - (time.perf_counter() - start), 1e-3)})
+    if res.x is not None:
+        cols = np.flatnonzero(res.x[k:2 * k] > 0.5)
+        return finish(cols, res.x[cols], "milp")
+    cols, x = _greedy_select(A_c, target, lo, hi, max_materials, start + 2 * time_limit)
+    return finish(cols, x, "greedy")
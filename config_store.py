@@ -0,0 +1,349 @@
+# 保存済み設定のストア（SQLite、Streamlitに依存しない）
+# 設定は1件1行で保存し、試験名・保存日時・Group・チャンネルごとの目標値に索引を張る。
+# 一覧は保存日時の新しい順にキー（保存日時, id）でページ送りするので、件数が増えても
+# 1ページ分の読み込みは索引の探索だけで済む（OFFSET は使わない）。
+# 目標値での絞り込みは (元素, 目標値) の索引で範囲に入る設定を先に集め、その中を保存日時の順に並べる。
+# 範囲に入る目標値が多いとき（範囲が広い）は、保存日時の順にたどってもすぐに1ページ分見つかるのでそちらを使う。
+# チャンネルごとの設定は内容のハッシュ（SHA-256）をキーにした圧縮済みの blob として1回だけ保存し、
+# configs.data には試験名などとチャンネルごとのハッシュだけの manifest を持つ。
+# 2つの保存の比較は、ハッシュが同じチャンネルを読まずに飛ばせる。
+# 使い方: python config_store.py import saved_configs
+#         python config_store.py export 出力先 --name 試験_001
+#         python config_store.py stats
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+from contextlib import closing, contextmanager
+
+DB_FILENAME = "configs.sqlite3"
+PAGE_SIZE = 20
+SELECTIVE_TARGETS = 5000  # 範囲に入る目標値がこれより少なければ索引から設定を集める
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS configs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    test_name TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    analysis_location TEXT,
+    selected_group TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS configs_timestamp ON configs (timestamp, id);
+CREATE INDEX IF NOT EXISTS configs_test_name ON configs (test_name, timestamp, id);
+CREATE INDEX IF NOT EXISTS configs_group ON configs (selected_group, timestamp, id);
+CREATE TABLE IF NOT EXISTS channel_targets (
+    config_id INTEGER NOT NULL REFERENCES configs (id) ON DELETE CASCADE,
+    channel INTEGER NOT NULL,
+    element TEXT NOT NULL,
+    target REAL NOT NULL,
+    PRIMARY KEY (config_id, element, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channel_targets_element ON channel_targets (element, target, config_id);
+CREATE TABLE IF NOT EXISTS channel_blobs (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS config_channels (
+    config_id INTEGER NOT NULL REFERENCES configs (id) ON DELETE CASCADE,
+    channel TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (config_id, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS config_channels_hash ON config_channels (hash);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def store_path(save_dir):
+    return os.path.join(save_dir, DB_FILENAME)
+
+
+@contextmanager
+def connect(path):
+    """ストアに接続する（なければ作成）。ブロックを抜けるとコミットして閉じる"""
+    with closing(sqlite3.connect(path)) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        with conn:
+            _migrate_blobs(conn)
+            yield conn
+
+
+def _migrate_blobs(conn):
+    # チャンネルごとの設定を configs.data に丸ごと持っていた行を blob + manifest に置き換える（1回だけ）
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'channel_blobs'").fetchone():
+        return
+    for row in conn.execute("SELECT name, data FROM configs").fetchall():
+        config_data = json.loads(row["data"])
+        if any(isinstance(tab, dict) for tab in config_data.get("tabs", {}).values()):
+            save_config(conn, row["name"], config_data)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('channel_blobs', '1')")
+
+
+def channel_hash(tab_config):
+    """チャンネル設定の内容のハッシュ（キーの順序によらない）"""
+    return hashlib.sha256(_canonical(tab_config)).hexdigest()
+
+
+def _canonical(tab_config):
+    return json.dumps(tab_config, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def _put_blob(conn, tab_config):
+    digest = channel_hash(tab_config)
+    conn.execute("INSERT OR IGNORE INTO channel_blobs (hash, data) VALUES (?, ?)", (digest, zlib.compress(_canonical(tab_config))))
+    return digest
+
+
+def _get_blobs(conn, hashes):
+    hashes = list(set(hashes))
+    if not hashes:
+        return {}
+    rows = conn.execute(f"SELECT hash, data FROM channel_blobs WHERE hash IN ({', '.join('?' * len(hashes))})", hashes)
+    return {row["hash"]: json.loads(zlib.decompress(row["data"])) for row in rows}
+
+
+def _prune_blobs(conn, hashes):
+    # どの保存からも参照されなくなった blob を消す
+    conn.executemany(
+        "DELETE FROM channel_blobs WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM config_channels WHERE hash = ?)",
+        [(h, h) for h in set(hashes)],
+    )
+
+
+def _channel_hashes(conn, config_id):
+    return [row["hash"] for row in conn.execute("SELECT hash FROM config_channels WHERE config_id = ?", (config_id,))]
+
+
+def _channel_targets(config_data):
+    # 目標値が0でない元素だけを索引に入れる
+    for tab_key, tab_config in config_data.get("tabs", {}).items():
+        channel = int(tab_key.rsplit("_", 1)[-1])
+        for element, target in tab_config.get("targets", {}).items():
+            if target:
+                yield channel, element, float(target)
+
+
+def save_config(conn, name, config_data):
+    """設定を保存して id を返す。同じ名前があれば上書き"""
+    hashes = {tab_key: _put_blob(conn, tab_config) for tab_key, tab_config in config_data.get("tabs", {}).items()}
+    manifest = {**config_data, "tabs": hashes}
+    row = conn.execute(
+        "INSERT INTO configs (name, test_name, timestamp, analysis_location, selected_group, data) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET test_name = excluded.test_name, timestamp = excluded.timestamp, "
+        "analysis_location = excluded.analysis_location, selected_group = excluded.selected_group, data = excluded.data "
+        "RETURNING id",
+        (name, config_data.get("test_name", ""), config_data.get("timestamp", ""),
+         config_data.get("analysis_location", ""), config_data.get("selected_group", ""),
+         json.dumps(manifest, ensure_ascii=False)),
+    ).fetchone()
+    config_id = row["id"]
+    replaced = _channel_hashes(conn, config_id)
+    conn.execute("DELETE FROM config_channels WHERE config_id = ?", (config_id,))
+    conn.executemany(
+        "INSERT INTO config_channels (config_id, channel, hash) VALUES (?, ?, ?)",
+        [(config_id, tab_key, digest) for tab_key, digest in hashes.items()],
+    )
+    _prune_blobs(conn, replaced)
+    conn.execute("DELETE FROM channel_targets WHERE config_id = ?", (config_id,))
+    conn.executemany(
+        "INSERT INTO channel_targets (config_id, channel, element, target) VALUES (?, ?, ?, ?)",
+        [(config_id, channel, element, target) for channel, element, target in _channel_targets(config_data)],
+    )
+    return config_id
+
+
+def load_manifest(conn, config_id):
+    """manifest（チャンネルの設定の代わりにハッシュを持つ dict）。なければ None"""
+    row = conn.execute("SELECT data FROM configs WHERE id = ?", (config_id,)).fetchone()
+    return None if row is None else json.loads(row["data"])
+
+
+def load_config(conn, config_id):
+    """設定（保存時の dict）。なければ None"""
+    manifest = load_manifest(conn, config_id)
+    if manifest is None:
+        return None
+    blobs = _get_blobs(conn, manifest.get("tabs", {}).values())
+    return {**manifest, "tabs": {tab_key: blobs[digest] for tab_key, digest in manifest.get("tabs", {}).items()}}
+
+
+def delete_config(conn, config_id):
+    hashes = _channel_hashes(conn, config_id)
+    conn.execute("DELETE FROM configs WHERE id = ?", (config_id,))
+    _prune_blobs(conn, hashes)
+
+
+def _flatten(value, prefix=""):
+    # {"targets": {"C": 3.6}} -> {"targets.C": 3.6}（リストはそのまま1項目）
+    if not isinstance(value, dict):
+        return {prefix: value}
+    items = {}
+    for key, item in value.items():
+        items.update(_flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    return items
+
+
+def diff_configs(conn, config_a, config_b):
+    """
+    2つの保存の差分 [(チャンネル, 項目, 値A, 値B)]。チャンネルは manifest のキー（tab_0 など）、共通の項目は ""。
+    ハッシュが同じチャンネルは blob を読まない
+    """
+    manifest_a, manifest_b = load_manifest(conn, config_a), load_manifest(conn, config_b)
+    if manifest_a is None or manifest_b is None:
+        raise KeyError("保存された設定が見つかりません")
+    rows = []
+    common_a = _flatten({k: v for k, v in manifest_a.items() if k != "tabs"})
+    common_b = _flatten({k: v for k, v in manifest_b.items() if k != "tabs"})
+    for key in sorted(common_a.keys() | common_b.keys()):
+        if common_a.get(key) != common_b.get(key):
+            rows.append(("", key, common_a.get(key), common_b.get(key)))
+    tabs_a, tabs_b = manifest_a.get("tabs", {}), manifest_b.get("tabs", {})
+    changed = [tab_key for tab_key in sorted(tabs_a.keys() | tabs_b.keys()) if tabs_a.get(tab_key) != tabs_b.get(tab_key)]
+    blobs = _get_blobs(conn, [tabs[k] for tabs in (tabs_a, tabs_b) for k in changed if k in tabs])
+    for tab_key in changed:
+        items_a = _flatten(blobs.get(tabs_a.get(tab_key), {}))
+        items_b = _flatten(blobs.get(tabs_b.get(tab_key), {}))
+        for key in sorted(items_a.keys() | items_b.keys()):
+            if items_a.get(key) != items_b.get(key):
+                rows.append((tab_key, key, items_a.get(key), items_b.get(key)))
+    return rows
+
+
+def storage_stats(conn):
+    """保存数、チャンネル設定の参照数と実際に保存している blob の数・圧縮後のバイト数"""
+    n_configs = conn.execute("SELECT COUNT(*) FROM configs").fetchone()[0]
+    n_refs = conn.execute("SELECT COUNT(*) FROM config_channels").fetchone()[0]
+    n_blobs, blob_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM channel_blobs").fetchone()
+    return {"configs": n_configs, "channel_refs": n_refs, "blobs": n_blobs, "blob_bytes": blob_bytes}
+
+
+def groups(conn):
+    """保存されている Group の一覧"""
+    return [row[0] for row in conn.execute("SELECT DISTINCT selected_group FROM configs ORDER BY selected_group") if row[0]]
+
+
+def search_configs(conn, name_prefix="", group=None, element=None, target_min=None, target_max=None,
+                   after=None, limit=PAGE_SIZE):
+    """
+    保存日時の新しい順に1ページ分の設定（id, name, test_name, timestamp, selected_group）を返す。
+    name_prefix: 試験名の前方一致、group: Group、element / target_min / target_max: いずれかのチャンネルの目標値の範囲
+    after: 前のページの最後の行の (timestamp, id)。次のページがあるかは limit+1 件目の有無で判定する
+    """
+    where, params = [], []
+    if name_prefix:
+        # 前方一致は範囲検索にして索引を使う
+        where.append("c.test_name >= ? AND c.test_name < ?")
+        params += [name_prefix, name_prefix + "\U0010ffff"]
+    if group:
+        where.append("c.selected_group = ?")
+        params.append(group)
+    if element:
+        target_range = [element, -1e300 if target_min is None else target_min, 1e300 if target_max is None else target_max]
+        n_targets = conn.execute(
+            "SELECT count(*) FROM (SELECT 1 FROM channel_targets WHERE element = ? AND target BETWEEN ? AND ? LIMIT ?)",
+            target_range + [SELECTIVE_TARGETS],
+        ).fetchone()[0]
+        if n_targets < SELECTIVE_TARGETS:
+            # 範囲に入る設定は channel_targets_element の索引だけで集める（設定を1件ずつ確かめない）
+            where.append("c.id IN (SELECT t.config_id FROM channel_targets t WHERE t.element = ? AND t.target BETWEEN ? AND ?)")
+        else:
+            # (設定, 元素) の主キーで目標値を確かめる（+ で目標値の索引を使わせない）
+            where.append("EXISTS (SELECT 1 FROM channel_targets t WHERE t.config_id = c.id AND t.element = ? AND +t.target BETWEEN ? AND ?)")
+        params += target_range
+    if after is not None:
+        where.append("(c.timestamp, c.id) < (?, ?)")
+        params += list(after)
+    sql = "SELECT c.id, c.name, c.test_name, c.timestamp, c.selected_group FROM configs c"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY c.timestamp DESC, c.id DESC LIMIT ?"
+    rows = [dict(row) for row in conn.execute(sql, params + [limit + 1])]
+    return rows[:limit], len(rows) > limit
+
+
+def import_json_dir(conn, directory, once=True):
+    """
+    saved_configs/*.json をストアに取り込み、取り込んだ件数を返す（名前はファイル名から .json を除いたもの）。
+    once=True なら2回目以降は何もしない（起動のたびにディレクトリを走査しないため）
+    """
+    if once and conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return 0
+    count = 0
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if conn.execute("SELECT 1 FROM configs WHERE name = ?", (name,)).fetchone():
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config_data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(config_data, dict) or not isinstance(config_data.get("tabs"), dict):
+            # 設定ファイル以外のJSON（以前の自動保存など）は取り込まない
+            continue
+        save_config(conn, name, config_data)
+        count += 1
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (str(count),))
+    return count
+
+
+def iter_configs(conn, **filters):
+    """search_configs と同じ条件のすべての設定を (一覧の行, 設定) で返す（保存日時の新しい順、500件ずつ読む）"""
+    after = None
+    while True:
+        rows, has_next = search_configs(conn, after=after, limit=500, **filters)
+        for row in rows:
+            yield row, load_config(conn, row["id"])
+        if not has_next:
+            return
+        after = (rows[-1]["timestamp"], rows[-1]["id"])
+
+
+def export_json(conn, output_dir, **filters):
+    """search_configs と同じ条件で設定をJSONファイルに書き出し、件数を返す"""
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    for row, config_data in iter_configs(conn, **filters):
+        with open(os.path.join(output_dir, f"{row['name']}.json"), 'w', encoding='utf-8') as f:
+            json.dump(config_data, f, ensure_ascii=False, indent=2)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済み設定のストア")
+    parser.add_argument("--store", default=store_path("saved_configs"), help="ストアのファイル")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("import", help="JSONファイルの取り込み（取り込み済みの名前は飛ばす）")
+    p.add_argument("directory", nargs="?", default="saved_configs")
+    p = sub.add_parser("export", help="JSONファイルへの書き出し")
+    p.add_argument("output_dir")
+    p.add_argument("--name", default="", help="試験名（前方一致）")
+    p.add_argument("--group", default=None)
+    sub.add_parser("stats", help="保存数と blob の重複排除の状況")
+    args = parser.parse_args()
+
+    with connect(args.store) as conn:
+        if args.command == "import":
+            print(f"{import_json_dir(conn, args.directory, once=False)} 件を取り込みました: {args.store}")
+        elif args.command == "export":
+            print(f"{export_json(conn, args.output_dir, name_prefix=args.name, group=args.group)} 件を書き出しました: {args.output_dir}")
+        else:
+            stats = storage_stats(conn)
+            print(f"保存数: {stats['configs']:,}  チャンネル設定: {stats['channel_refs']:,} 件中 {stats['blobs']:,} 件を保存"
+                  f"（{stats['blob_bytes']:,} bytes）  ファイル: {os.path.getsize(args.store):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
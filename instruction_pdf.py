@@ -0,0 +1,151 @@
+# 指示票PDFの作成（Streamlitに依存しない）
+# 日本語フォントの登録と表・段落のスタイルはプロセスごとに1回だけ作り、
+# PDFは BytesIO を経由せずに出力先のファイルへ直接書き出す。
+from functools import lru_cache
+from types import SimpleNamespace
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFError, TTFont
+from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+# 日本語フォント（上から順に登録できたものを使う）
+FONT_CANDIDATES = [("NotoSansCJK", "NotoSansCJK-Regular.ttf"), ("MSGothic", "msgothic.ttc")]
+# 「材料」欄に載せる材料（それ以外は「合金」欄）
+BASE_MATERIALS = ["神鋼SP銑", "故銑", "鋼屑"]
+
+
+@lru_cache(maxsize=None)
+def register_font():
+    """日本語フォントを登録してフォント名を返す（プロセスごとに1回）。見つからなければ Helvetica"""
+    for font_name, path in FONT_CANDIDATES:
+        if font_name in pdfmetrics.getRegisteredFontNames():
+            return font_name
+        try:
+            pdfmetrics.registerFont(TTFont(font_name, path))
+            return font_name
+        except (OSError, TTFError):
+            continue
+    return "Helvetica"
+
+
+@lru_cache(maxsize=None)
+def pdf_styles(font_name):
+    """指示票で使う段落・表のスタイル（フォントごとに1回だけ作る）"""
+    styles = getSampleStyleSheet()
+    item_commands = [
+        ('FONTNAME', (0, 0), (-1, -1), font_name),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+        ('ALIGN', (2, 0), (2, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ]
+    return SimpleNamespace(
+        title=ParagraphStyle('JapaneseTitle', parent=styles['Title'], fontName=font_name, fontSize=12),
+        channel=ParagraphStyle('ChannelHeader', parent=styles['Heading3'], fontName=font_name, fontSize=12, alignment=1),
+        section=ParagraphStyle('SectionTitle', parent=styles['Normal'], fontName=font_name, fontSize=10, spaceAfter=3),
+        basic=TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), font_name),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
+        ]),
+        items=TableStyle(item_commands),
+        wrapper=TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 8),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+        ]),
+        row=TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 15),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 15),
+        ]),
+    )
+
+
+def _section(title, data, style):
+    table = Table(data, colWidths=[60, 60, 20])
+    table.setStyle(style.items)
+    return [Paragraph(title, style.section), table]
+
+
+def channel_block(channel, style, multiplier=0.95):
+    """
+    1チャンネル分の表。channel は次のキーを持つ dict:
+    index（0始まり）, total_weight_kg, remaining_weight_kg, mode, tapping_temp,
+    materials（材料名 -> 必要添加量(g)、選択順）, additives（(添加剤名, g) のリスト）
+    """
+    basic_table = Table([
+        ["溶湯重量", f"{channel['total_weight_kg']}kg"],
+        ["残湯量", f"{channel['remaining_weight_kg']}kg"],
+        ["溶湯種別", channel['mode']],
+        ["出湯温度", f"{channel['tapping_temp']}℃"],
+    ], colWidths=[50, 50])
+    basic_table.setStyle(style.basic)
+
+    materials = channel["materials"]
+    # 材料はkg、合金はgで表示（設定倍率を掛ける）
+    material_data = [[mat, f"{round(materials[mat] * multiplier / 1000)}kg", "□"]
+                     for mat in BASE_MATERIALS if materials.get(mat, 0) > 0]
+    alloy_data = [[mat, f"{int(g * multiplier):,}g", "□"]
+                  for mat, g in materials.items() if mat not in BASE_MATERIALS and g > 0]
+    additive_data = [[additive, f"{int(g):,}g", "□"] for additive, g in channel["additives"] if g > 0]
+
+    channel_elements = [basic_table, Spacer(1, 8)]
+    if material_data:
+        channel_elements.extend(_section("材料", material_data, style) + [Spacer(1, 8)])
+    if alloy_data:
+        channel_elements.extend(_section("合金", alloy_data, style) + [Spacer(1, 8)])
+    if additive_data:
+        channel_elements.extend(_section("添加剤", additive_data, style))
+
+    # ヘッダーとコンテンツを縦に並べる
+    channel_content = [[Paragraph(f"Ch{channel['index'] + 1}", style.channel)]] + [[element] for element in channel_elements]
+    wrapper = Table(channel_content, colWidths=[130])
+    wrapper.setStyle(style.wrapper)
+    return wrapper
+
+
+def instruction_story(test_name, channels, multiplier=0.95):
+    """指示票1枚分の flowable のリスト（全チャンネルを横並び）"""
+    style = pdf_styles(register_font())
+    if not channels:
+        return []
+    story = [Paragraph(f"指示票 - {test_name}", style.title), Spacer(1, 10)]
+    channel_tables = [channel_block(channel, style, multiplier) for channel in channels]
+    if len(channel_tables) == 1:
+        story.append(channel_tables[0])
+    else:
+        row_table = Table([channel_tables], colWidths=[160] * len(channel_tables))
+        row_table.setStyle(style.row)
+        story.append(row_table)
+    return story
+
+
+def write_instruction_pdf(output, test_name, channels, multiplier=0.95):
+    """指示票PDFを output（ファイルパスまたは書き込み可能なファイルオブジェクト）へ書き出す"""
+    return write_instruction_pdfs(output, [(test_name, channels)], multiplier)
+
+
+def write_instruction_pdfs(output, sheets, multiplier=0.95):
+    """複数の指示票（(試験名, チャンネル) のリスト）を1枚ずつ改ページして1つのPDFに書き出す"""
+    story = []
+    for test_name, channels in sheets:
+        page = instruction_story(test_name, channels, multiplier)
+        if page:
+            story.extend(([PageBreak()] if story else []) + page)
+    doc = SimpleDocTemplate(output, pagesize=landscape(A4), leftMargin=20, rightMargin=20)
+    doc.build(story)
+    return output
@@ -0,0 +1,120 @@
+# 材料ライブラリ（Streamlitに依存しない）
+# materials.csv にロット（入荷ごとのミルシート）単位の材料を数千行登録しても画面と計算が遅くならないように、
+# 列ごとの配列・材料名 -> 行番号の辞書・元素ごとに含有率で並べた行番号を参照データの版ごとに1回だけ作る。
+# 名前・ロット・仕入先の検索と「元素Xを Y% 以上含む」の絞り込みは配列演算1回と二分探索で行い、
+# 計算に使う成分行列は選択した材料の列だけを取り出す（reference_data.CompositionMatrix.take）。
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from reference_data import file_fingerprint, load_csv
+
+LOT_COLUMN = "ロット"
+SUPPLIER_COLUMN = "仕入先"
+PRICE_COLUMN = "単価"
+
+_lock = threading.Lock()
+_libraries = {}  # (パス, 元素) -> (fingerprint, MaterialLibrary)
+
+
+def _read_only(values):
+    values.flags.writeable = False
+    return values
+
+
+@dataclass(frozen=True)
+class MaterialLibrary:
+    """材料ライブラリ。percent は成分（%、歩留まりを掛ける前）で shape=(材料数, 元素数)、行の順序は names"""
+    names: tuple
+    elements: tuple
+    percent: np.ndarray
+    lots: np.ndarray
+    suppliers: np.ndarray
+    prices: np.ndarray
+    index: dict = field(repr=False)
+    search_text: np.ndarray = field(repr=False)     # 検索用の「名前 ロット 仕入先」（casefold 済み）
+    element_order: dict = field(repr=False)         # 元素 -> (含有率の昇順の行番号, 昇順の含有率)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def rows(self, names):
+        """材料名の行番号（names の順）"""
+        return np.array([self.index[n] for n in names], dtype=np.intp)
+
+    def match(self, query="", element=None, min_pct=None):
+        """条件に合う行の真偽値の配列。query は名前・ロット・仕入先の部分一致（大文字小文字を区別しない）"""
+        mask = np.ones(len(self.names), dtype=bool)
+        if element is not None:
+            # min_pct 以上（0または未指定なら0より多く含むもの）
+            order, sorted_pct = self.element_order[element]
+            min_pct = min_pct or 0.0
+            start = np.searchsorted(sorted_pct, min_pct, side="left" if min_pct > 0 else "right")
+            mask[:] = False
+            mask[order[start:]] = True
+        query = query.strip().casefold()
+        if query:
+            mask &= np.char.find(self.search_text, query) >= 0
+        return mask
+
+    def search(self, query="", element=None, min_pct=None, limit=None):
+        """条件に合う材料名（ライブラリの順）と該当件数。limit を指定すると先頭 limit 件だけ返す"""
+        hits = np.flatnonzero(self.match(query, element, min_pct))
+        return [self.names[i] for i in hits[:limit]], len(hits)
+
+
+def _text_column(df, column):
+    if column not in df.columns:
+        return np.full(len(df), "", dtype=object)
+    return df[column].fillna("").astype(str).to_numpy(dtype=object)
+
+
+def build_library(df, elements):
+    """材料のDataFrame（行名が材料名）からライブラリを作る。重複した行名は最初の行を使う"""
+    df = df[~df.index.duplicated()]
+    elements = tuple(e for e in elements if e in df.columns)
+    names = tuple(str(n) for n in df.index)
+    percent = np.nan_to_num(df.reindex(columns=list(elements)).apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float), nan=0.0)
+    lots = _text_column(df, LOT_COLUMN)
+    suppliers = _text_column(df, SUPPLIER_COLUMN)
+    prices = pd.to_numeric(df[PRICE_COLUMN], errors="coerce").to_numpy(dtype=float) if PRICE_COLUMN in df.columns else np.full(len(df), np.nan)
+    search_text = np.array([f"{n}\t{lot}\t{supplier}".casefold() for n, lot, supplier in zip(names, lots, suppliers)], dtype=str)
+    element_order = {}
+    for j, e in enumerate(elements):
+        order = np.argsort(percent[:, j], kind="stable")
+        element_order[e] = (_read_only(order), _read_only(percent[order, j]))
+    return MaterialLibrary(
+        names=names,
+        elements=elements,
+        percent=_read_only(percent),
+        lots=_read_only(lots),
+        suppliers=_read_only(suppliers),
+        prices=_read_only(prices),
+        index={n: i for i, n in enumerate(names)},
+        search_text=_read_only(search_text),
+        element_order=element_order,
+    )
+
+
+def load_library(path, elements, **kwargs):
+    """CSVから材料ライブラリを作ってキャッシュする（ファイルが変わったときだけ作り直す）"""
+    elements = tuple(elements)
+    fingerprint = file_fingerprint(path)
+    key = (fingerprint[0], elements, tuple(sorted(kwargs.items())))
+    with _lock:
+        cached = _libraries.get(key)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint, build_library(load_csv(path, **kwargs), elements))
+        with _lock:
+            _libraries[key] = cached
+    return cached[1]
+
+
+def clear_cache():
+    with _lock:
+        _libraries.clear()
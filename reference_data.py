@@ -0,0 +1,199 @@
+# 参照データ（materials.csv などのCSV）のキャッシュ
+# プロセス全体（全セッション共通）で1回だけ読み込み、ファイルのパス・更新時刻・サイズが
+# 変わったときだけ読み直す。返すDataFrame・配列は読み取り専用。
+import codecs
+import os
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+ENCODINGS = ['cp932', 'utf-8', 'utf-8-sig', 'shift_jis']
+SNIFF_BYTES = 64 * 1024
+
+_lock = threading.RLock()
+_frames = {}        # (パス, 読み込みオプション) -> (fingerprint, DataFrame)
+_compositions = {}  # (パス, 元素, 読み込みオプション) -> (fingerprint, CompositionMatrix)
+_encodings = {}     # パス -> (fingerprint, エンコード, 判定方法)
+
+
+@dataclass(frozen=True)
+class CompositionMatrix:
+    """
+    成分行列（fraction）。shape=(元素数, 材料数)、列の順序は names。
+    ほとんどの材料は1〜2元素とFe以外が0なので、疎行列（CSC、列の取り出しが速い形式）で持つ
+    """
+    names: tuple
+    elements: tuple
+    matrix: sparse.csc_array
+    index: dict = field(repr=False)
+
+    @property
+    def values(self):
+        """全材料の密行列（ライブラリ全体を密にするので、計算には matrix か take を使う）"""
+        return self.matrix.toarray()
+
+    def columns(self, names):
+        return [self.index[n] for n in names]
+
+    def take(self, names):
+        """指定した材料の列だけを密行列で取り出す（選択した材料の非ゼロ要素数に比例）"""
+        # 選ぶ列は数個なので、scipy の列の取り出しを経由せずCSCの配列から直接書き込む
+        matrix = self.matrix
+        out = np.zeros((matrix.shape[0], len(names)))
+        for k, j in enumerate(self.columns(names)):
+            start, end = matrix.indptr[j], matrix.indptr[j + 1]
+            out[matrix.indices[start:end], k] = matrix.data[start:end]
+        return out
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def reference_version(*paths):
+    """参照データの版（ファイルの fingerprint の組）。存在しないファイルは None"""
+    version = []
+    for path in paths:
+        try:
+            version.append(file_fingerprint(path))
+        except OSError:
+            version.append((os.path.abspath(path), None))
+    return tuple(version)
+
+
+def detect_encoding(sample):
+    """先頭バイトからエンコードを判定する（BOM → UTF-8として正しいか → cp932として正しいか）"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    # 末尾で途切れたマルチバイト文字は無視する
+    for encoding in ('utf-8', 'cp932'):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def _sniff(filename):
+    fingerprint = file_fingerprint(filename)
+    with _lock:
+        cached = _encodings.get(fingerprint[0])
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+    with open(filename, 'rb') as f:
+        encoding = detect_encoding(f.read(SNIFF_BYTES))
+    with _lock:
+        _encodings[fingerprint[0]] = (fingerprint, encoding, "判定")
+    return encoding
+
+
+def read_csv_anti(filename, **kwargs):
+    """CSV読み込み（エンコード: ANTI対応）。どのエンコードでも読めなければ ValueError"""
+    if "encoding" in kwargs:
+        return pd.read_csv(filename, **kwargs)
+    encoding = _sniff(filename)
+    if encoding is not None:
+        try:
+            return pd.read_csv(filename, encoding=encoding, **kwargs)
+        except (UnicodeDecodeError, pd.errors.ParserError):
+            pass
+    # 判定できなかった・判定結果で読めなかった場合は従来どおり総当たり
+    for fallback in ENCODINGS:
+        if fallback == encoding:
+            continue
+        try:
+            df = pd.read_csv(filename, encoding=fallback, **kwargs)
+        except Exception:
+            continue
+        with _lock:
+            _encodings[os.path.abspath(filename)] = (file_fingerprint(filename), fallback, "総当たり")
+        return df
+    raise ValueError(f"CSVファイル '{filename}' の読み込みに失敗しました。")
+
+
+def encoding_report():
+    """ファイルごとのエンコードと判定方法（"判定" / "総当たり"）"""
+    with _lock:
+        return {path: (encoding, method) for path, (_, encoding, method) in _encodings.items()}
+
+
+def _read_only(df):
+    # 列ごとに書き込み不可の配列で組み直す（df.loc[...] = ... は ValueError になる）
+    columns = {}
+    for col in df.columns:
+        values = df[col].to_numpy(copy=True)
+        values.flags.writeable = False
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index, columns=df.columns, copy=False)
+
+
+def _cache_key(path, kwargs):
+    return (os.path.abspath(path), tuple(sorted(kwargs.items())))
+
+
+def load_csv(path, **kwargs):
+    """CSVをキャッシュ経由で読み込む。返すのは浅いコピーなので列の差し替えは他のセッションに影響しない"""
+    fingerprint = file_fingerprint(path)
+    key = _cache_key(path, kwargs)
+    with _lock:
+        cached = _frames.get(key)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, _read_only(read_csv_anti(path, **kwargs)))
+            _frames[key] = cached
+    return cached[1].copy(deep=False)
+
+
+def recovery_matrix(df, elements, yield_column):
+    """
+    元素ごとの歩留まり（回収率）。shape=(元素数, 材料数)
+    "{yield_column}_{元素}" 列（例: 歩留まり_C）があればその元素はその値、なければ yield_column 列、どちらも空なら 1.0
+    """
+    base = pd.to_numeric(df[yield_column], errors="coerce") if yield_column in df.columns else pd.Series(np.nan, index=df.index)
+    base = base.fillna(1.0)
+    rows = []
+    for e in elements:
+        column = f"{yield_column}_{e}"
+        if column in df.columns:
+            rows.append(pd.to_numeric(df[column], errors="coerce").fillna(base).to_numpy(dtype=float))
+        else:
+            rows.append(base.to_numpy(dtype=float))
+    return np.array(rows).reshape(len(elements), len(df))
+
+
+def load_composition(path, elements, yield_column=None, **kwargs):
+    """
+    CSVの成分（%）から成分行列を作ってキャッシュする。重複した行名は最初の行を使う。
+    yield_column を指定すると歩留まり（recovery_matrix）を掛けた実効成分行列にする
+    """
+    elements = tuple(elements)
+    fingerprint = file_fingerprint(path)
+    key = _cache_key(path, kwargs) + (elements, yield_column)
+    with _lock:
+        cached = _compositions.get(key)
+    if cached is None or cached[0] != fingerprint:
+        df = load_csv(path, **kwargs)
+        df = df[~df.index.duplicated()]
+        table = df.reindex(columns=list(elements)).apply(pd.to_numeric, errors="coerce")
+        values = np.nan_to_num(table.to_numpy(dtype=float), nan=0.0).T / 100
+        if yield_column is not None:
+            values = values * recovery_matrix(df, elements, yield_column)
+        matrix = sparse.csc_array(values)
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            array.flags.writeable = False
+        names = tuple(df.index)
+        cached = (fingerprint, CompositionMatrix(names, elements, matrix, {n: i for i, n in enumerate(names)}))
+        with _lock:
+            _compositions[key] = cached
+    return cached[1]
+
+
+def clear_cache():
+    with _lock:
+        _frames.clear()
+        _compositions.clear()
+        _encodings.clear()
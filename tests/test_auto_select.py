@@ -0,0 +1,43 @@
+# 材料の自動選択の結果表示が、選んだ組をチャンネルの計算方式で計算した判定と一致するかを確認する
+# 実行: python -m pytest tests
+import shutil
+from pathlib import Path
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # 保存先（saved_configs）を作業用のフォルダに作るため、アプリと参照データをコピーして実行する
+    for path in list(ROOT.glob("*.py")) + list(ROOT.glob("*.csv")):
+        shutil.copy(path, tmp_path)
+    monkeypatch.chdir(tmp_path)
+    at = AppTest.from_file(str(tmp_path / "app.py"), default_timeout=300)
+    at.run()
+    return at
+
+
+def auto_select(at, channel, solver_method):
+    at.selectbox(key="edit_channel").set_value(channel).run()
+    at.radio(key=f"solver_method_{channel}").set_value(solver_method).run()
+    at.button(key=f"auto_select_{channel}").click().run()
+    assert not at.exception
+    return at.session_state["channels"][channel]["detail"][1]
+
+
+@pytest.mark.parametrize("solver_method", ["lstsq", "bounded", "lp"])
+def test_auto_select_message_follows_channel_judgement(app, solver_method):
+    # Ch3 の初期値では、混合整数計画法で許容範囲内に入る組でも最小二乗法では Cu が許容範囲外になる
+    detail = auto_select(app, 2, solver_method)
+    success = [m.value for m in app.success if "材料を選びました" in m.value]
+    warning = [m.value for m in app.warning if "材料を選びました" in m.value]
+    if detail["判定"] == "○":
+        assert success and not warning
+    else:
+        assert warning and not success
+        assert detail["NG元素"] in warning[0]
+    if solver_method == "lp":
+        assert detail["判定"] == "○"